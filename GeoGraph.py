@@ -2,8 +2,11 @@ import torch
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch.nn.utils.rnn import pad_sequence
 from torch_geometric.utils import degree
+from misc import fp32
+from timing import region, timed
 
 
 class SelfAttn(nn.Module):
@@ -20,13 +23,15 @@ class SelfAttn(nn.Module):
         super(SelfAttn, self).__init__()
         self.multihead_attn = nn.MultiheadAttention(embed_dim, n_heads, batch_first=True)
 
-    def forward(self, sess_embed, sections):
+    def forward(self, sess_embed, sections, padding=None):
         """
         Forward pass of the SelfAttn module.
 
         Args:
             sess_embed (torch.Tensor): The input session embeddings.
             sections (List[int]): A list of section lengths for each session.
+            padding (torch.Tensor): Mask of the padded positions of each session, which are not attended to.
+                                    None attends to the zero padding, as in training.
 
         Returns:
             torch.Tensor: The output attention embeddings.
@@ -35,7 +40,7 @@ class SelfAttn(nn.Module):
         v_i = torch.split(sess_embed, sections)
         v_i_pad = pad_sequence(v_i, batch_first=True, padding_value=0.)
 
-        attn_output, _ = self.multihead_attn(v_i_pad, v_i_pad, v_i_pad)
+        attn_output, _ = self.multihead_attn(v_i_pad, v_i_pad, v_i_pad, key_padding_mask=padding)
 
         return attn_output
 
@@ -86,22 +91,30 @@ class GeoGraph(nn.Module):
         n_layers (int): Number of message passing nueral network layers.
         embed_dim (int): Dimension of the node embeddings.
         dist_edges (torch.Tensor): Tensor representing the edges in the graph, size (2, num_edges).
+                                   None when the POI encodings are always passed to forward (serving).
         dist_vec (np.ndarray): Array representing the distance of the edges, size (num_edges,).
         n_heads (int): Number of attention heads in the self-attention mechanism.
+        checkpoint (bool): Recompute the activations of the GCN layers in backward instead of keeping them,
+                           only the input of each layer is kept.
 
     """
 
-    def __init__(self, n_poi, n_layers, embed_dim, dist_edges, dist_vec, n_heads):
+    def __init__(self, n_poi, n_layers, embed_dim, dist_edges, dist_vec, n_heads, checkpoint=False):
         super(GeoGraph, self).__init__()
+        self.checkpoint = checkpoint
         
-        # add the reverse direction and self-loop to the distance edges
-        self.dist_edges = dist_edges
-        loop_index = torch.arange(0, n_poi).unsqueeze(0).repeat(2, 1)
-        self.dist_edges = torch.cat((self.dist_edges, self.dist_edges[[1, 0]], loop_index), dim=-1)
-        
-        # add the reverse direction and self-loop to the distance vector
-        dist_vec = np.concatenate((dist_vec, dist_vec, np.zeros(n_poi)))
-        self.dist_vec = torch.Tensor(dist_vec)
+        # the graph is registered as non-persistent buffers, so it follows the module to its device
+        # but is not part of the state dict
+        self.register_buffer('dist_edges', None, persistent=False)
+        self.register_buffer('dist_vec', None, persistent=False)
+        if dist_edges is not None:
+            # add the reverse direction and self-loop to the distance edges
+            loop_index = torch.arange(0, n_poi).unsqueeze(0).repeat(2, 1)
+            self.dist_edges = torch.cat((dist_edges, dist_edges[[1, 0]], loop_index), dim=-1)
+
+            # add the reverse direction and self-loop to the distance vector
+            dist_vec = np.concatenate((dist_vec, dist_vec, np.zeros(n_poi)))
+            self.dist_vec = torch.Tensor(dist_vec)
 
         # message passing neural network layers
         self.mpnn = nn.ModuleList()
@@ -127,36 +140,103 @@ class GeoGraph(nn.Module):
                     elif 'bias' in name:
                         nn.init.constant_(param.data, 0)
 
-    def forward(self, data, poi_embeds):
+    @timed('geo_gcn')
+    def encode(self, poi_embeds):
+        """
+        Apply the GCN layers to the whole POI graph.
+
+        Args:
+            poi_embeds: Embeddings of the points of interest (POIs).
+
+        Returns:
+            enc: Geographical encodings of all the POIs, size (n_poi, embed_dim).
+        """
+        if self.dist_edges is None:
+            raise ValueError('GeoGraph was built without the distance graph, pass poi_enc to forward instead.')
+
+        # the original embeddings of the POIs
+        enc = poi_embeds.weight
+        # the GCN layers stay in fp32 under bf16 autocast: the sparse product dominates and its bf16
+        # backward is slower on CPU, and F.normalize is kept in fp32
+        with fp32(enc):
+            enc = enc.float()
+            # apply GCN layers
+            for i in range(len(self.mpnn)):
+                if self.checkpoint and torch.is_grad_enabled():
+                    # the layers are deterministic, the random state need not be restored
+                    enc = checkpoint(self.mpnn[i], enc, self.dist_edges, self.dist_vec,
+                                     use_reentrant=False, preserve_rng_state=False)
+                else:
+                    enc = self.mpnn[i](enc, self.dist_edges, self.dist_vec)
+        return enc
+
+    def forward(self, data, poi_embeds, poi_enc=None, per_sample=False):
         """
         Forward pass of the model.
 
         Args:
             data: Input data.
             poi_embeds: Embeddings of the points of interest (POIs).
+            poi_enc: Precomputed output of encode(), or any table indexable by POI ids.
+                     The GCN layers are applied when it is None.
+            per_sample: Mask the padding of each sequence and average over its own length, so that the output
+                        of a sample does not depend on the other samples of the batch and equals that of the
+                        sample alone. Otherwise the sequences attend to and average over the padding up to
+                        the longest one, as in training.
 
         Returns:
             aggr_feat: Aggregated features obtained from self-attention mechanism.
             tar_embed: Embeddings of the target nodes.
         """
         
-        # the original embeddings of the POIs
-        enc = poi_embeds.embeds.weight
-        # apply GCN layers
-        for i in range(len(self.mpnn)):
-            enc = self.mpnn[i](enc, self.dist_edges, self.dist_vec)
+        enc = self.encode(poi_embeds) if poi_enc is None else poi_enc
         
         # geographical encoding for target poi
         tar_embed = enc[data.poi]
         
-        # get sequence lengths
-        _, seq_len = torch.unique(data.batch, return_counts=True)
-        sections = tuple(seq_len.cpu().numpy())
-        
-        # apply multihead self-attention
-        poi_embed_in_seq = enc[data.x.squeeze()] # embeddings for poi in the sequence
-        self_attn_feat = self.selfAttn(poi_embed_in_seq, sections)
-        # aggregate self-attention features to obtain semantic representation e_g,u
-        aggr_feat = torch.mean(self_attn_feat, dim=1)
+        with region('geo_attn'):
+            # get sequence lengths
+            _, seq_len = torch.unique(data.batch, return_counts=True)
+            sections = tuple(seq_len.cpu().numpy())
+
+            # apply multihead self-attention
+            poi_embed_in_seq = enc[data.x.view(-1)] # embeddings for poi in the sequence
+            padding = None
+            if per_sample:
+                seq_len = seq_len.to(poi_embed_in_seq.device)
+                padding = torch.arange(int(seq_len.max()), device=seq_len.device) >= seq_len.unsqueeze(1)
+            self_attn_feat = self.selfAttn(poi_embed_in_seq, sections, padding)
+            # aggregate self-attention features to obtain semantic representation e_g,u
+            if per_sample:
+                aggr_feat = (self_attn_feat * (~padding).unsqueeze(-1)).sum(dim=1) / seq_len.unsqueeze(1)
+            else:
+                aggr_feat = torch.mean(self_attn_feat, dim=1)
+
+        return aggr_feat, tar_embed
+
+    def forward_static(self, data, poi_enc):
+        """
+        forward on the padded inputs of dataset.static_inputs, with the POI encodings of encode().
+
+        The sequences are padded to the bucket length pad_len. The keys past the longest sequence of the batch
+        are masked and the mean is over the positions before it, which gives the output of forward.
+
+        Returns:
+            aggr_feat: Aggregated features of each padded sample.
+            tar_embed: Embeddings of the target nodes.
+        """
+        poi, max_len = data['poi'], data['max_len']
+        n_graphs, pad_len = poi.size(0), data['pad_len']
+        tar_embed = poi_enc[poi]
+
+        # the last row collects the padding nodes
+        enc = poi_enc[data['x']]
+        v_i_pad = enc.new_zeros(n_graphs + 1, pad_len, enc.size(1))
+        v_i_pad = v_i_pad.index_put((data['graph'], data['pos']), enc)[:n_graphs]
+
+        padding = torch.arange(pad_len, device=poi.device) >= max_len
+        attn_output, _ = self.selfAttn.multihead_attn(
+            v_i_pad, v_i_pad, v_i_pad, key_padding_mask=padding.expand(n_graphs, pad_len))
+        aggr_feat = (attn_output * (~padding).unsqueeze(-1)).sum(dim=1) / max_len
 
         return aggr_feat, tar_embed
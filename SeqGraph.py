@@ -1,6 +1,24 @@
 import torch
 import torch.nn as nn
 from torch_geometric.nn import MessagePassing
+from misc import fp32
+from timing import timed
+
+
+def masked_batch_norm(bn, x, mask):
+    '''Apply the BatchNorm1d bn to x, with the training statistics computed over the rows where mask is True.'''
+    if not bn.training:
+        return bn(x)
+    weight = mask.to(x.dtype).unsqueeze(1)
+    n = weight.sum()
+    mean = (x * weight).sum(dim=0) / n
+    var = ((x - mean) ** 2 * weight).sum(dim=0) / n
+    with torch.no_grad():
+        # the running variance is unbiased, as in BatchNorm1d
+        bn.running_mean.mul_(1 - bn.momentum).add_(bn.momentum * mean)
+        bn.running_var.mul_(1 - bn.momentum).add_(bn.momentum * var * n / (n - 1))
+        bn.num_batches_tracked.add_(1)
+    return (x - mean) / torch.sqrt(var + bn.eps) * bn.weight + bn.bias
 
 
 class SeqGraph(MessagePassing):
@@ -43,6 +61,7 @@ class SeqGraph(MessagePassing):
             if isinstance(m, nn.Linear):
                 nn.init.xavier_normal_(m.weight)
 
+    @timed('seq')
     def forward(self, data, poi_embeds):
         
         # adjacency matrix for hidden graphs
@@ -52,7 +71,7 @@ class SeqGraph(MessagePassing):
         adj_hidden_norm = adj_hidden_norm + torch.transpose(adj_hidden_norm, 1, 2)
         
         # get the features and adjacency matrix of the POIs
-        poi_feat = poi_embeds(data.x.squeeze())
+        poi_feat = poi_embeds(data.x.view(-1))
         poi_adj = data.edge_index
         graph_indicator = data.batch
         unique = torch.unique(graph_indicator)
@@ -81,9 +100,9 @@ class SeqGraph(MessagePassing):
             t = self.dropout(t)
             t = torch.mul(zx, t)
             
-            # sum the features and transpose
+            # sum the features and transpose, the sums are accumulated in fp32 under bf16 autocast
             t = torch.zeros(t.size(0), t.size(1), n_graphs,
-                            ).index_add_(2, graph_indicator, t)
+                            ).index_add_(2, graph_indicator, t.float())
             t = torch.sum(t, dim=1)
             t = torch.transpose(t, 0, 1)
             
@@ -92,9 +111,52 @@ class SeqGraph(MessagePassing):
             
         # concatenate the output and apply fully connected layers
         out = torch.cat(out, dim=1)
-        out = self.bn(out)
+        with fp32(out):
+            out = self.bn(out)
         out = self.relu(self.fc1(out))
         out = self.dropout(out)
         out = self.fc2(out)
         
         return out
+
+    def forward_static(self, data, poi_embeds):
+        '''forward on the padded inputs of dataset.static_inputs. All the shapes follow the buckets of the
+           inputs, so torch.compile builds one graph per bucket. The padded samples are excluded from the
+           BatchNorm statistics, their rows of the output are to be dropped.'''
+
+        # adjacency matrix for hidden graphs
+        adj_hidden_norm = torch.zeros(self.hidden_graph_num, self.hidden_graph_size, self.hidden_graph_size,
+                                      device=self.hidden_adj.device)
+        idx = torch.triu_indices(self.hidden_graph_size, self.hidden_graph_size, 1, device=self.hidden_adj.device)
+        adj_hidden_norm[:, idx[0], idx[1]] = self.relu(self.hidden_adj)
+        adj_hidden_norm = adj_hidden_norm + torch.transpose(adj_hidden_norm, 1, 2)
+
+        edge_index, graph_indicator = data['edge_index'], data['graph']
+        n_graphs = data['poi'].size(0)
+
+        x = self.sigmoid(self.fc(poi_embeds(data['x'])))
+        z = self.hidden_feat
+        zx = torch.einsum("abc,dc->abd", (z, x))
+
+        out = []
+        for i in range(self.max_step):
+            if i > 0:
+                # sum of the features of the predecessors, as propagate
+                x = torch.zeros_like(x).index_add_(0, edge_index[1], x[edge_index[0]])
+                z = torch.einsum("abc,acd->abd", (adj_hidden_norm, z))
+            t = torch.einsum("abc,dc->abd", (z, x))
+            t = self.dropout(t)
+            t = torch.mul(zx, t)
+
+            # sum the features of each sample, the last slot collects the padding nodes
+            t = torch.zeros(t.size(0), t.size(1), n_graphs + 1, device=t.device,
+                            ).index_add_(2, graph_indicator, t.float())[:, :, :n_graphs]
+            t = torch.sum(t, dim=1)
+            out.append(torch.transpose(t, 0, 1))
+
+        out = torch.cat(out, dim=1)
+        with fp32(out):
+            out = masked_batch_norm(self.bn, out, data['valid'])
+        out = self.relu(self.fc1(out))
+        out = self.dropout(out)
+        return self.fc2(out)
@@ -0,0 +1,86 @@
+import argparse
+import pickle
+import random
+import time
+import torch
+from ann import IVFIndex, retrieve_and_rerank
+from dataset import load_dist_graph
+from ranking import Ranker
+from serving import ServingModel
+
+
+ARG = argparse.ArgumentParser()
+ARG.add_argument('--tables', type=str, default=None,
+                 help='Directory exported by serving.py. Either --tables or --ckpt is needed.')
+ARG.add_argument('--ckpt', type=str, default=None,
+                 help='Checkpoint written by main.py --ckpt.')
+ARG.add_argument('--data', type=str, default='nyc',
+                 help='Dataset of the model. nyc or tky.')
+ARG.add_argument('--n_users', type=int, default=200,
+                 help='Num of validation users used as queries.')
+ARG.add_argument('--k', type=int, default=10,
+                 help='Num of POIs returned per user.')
+ARG.add_argument('--n_lists', type=int, default=256,
+                 help='Num of inverted lists of the index.')
+ARG.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64],
+                 help='Num of inverted lists scanned per query.')
+ARG.add_argument('--n_candidates', type=int, nargs='+', default=[100, 300, 1000],
+                 help='Num of POIs retrieved for re-ranking.')
+ARG.add_argument('--index', type=str, default=None,
+                 help='Path to save the built index.')
+ARG.add_argument('--seed', type=int, default=42,
+                 help='Random seed.')
+
+ARG = ARG.parse_args()
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    random.seed(ARG.seed)
+    torch.manual_seed(ARG.seed)
+
+    if ARG.tables is not None:
+        ranker = Ranker.from_serving(ServingModel(ARG.tables))
+    elif ARG.ckpt is not None:
+        dist_edges, dist_vec = load_dist_graph(f'./processed_data/{ARG.data}')
+        ranker = Ranker.from_checkpoint(ARG.ckpt, dist_edges, dist_vec)
+    else:
+        raise ValueError('Either --tables or --ckpt is needed.')
+
+    # histories of the validation users, one per user
+    with open(f'./processed_data/{ARG.data}/raw/val.pkl', 'rb') as f:
+        histories = list({uid: seq for uid, _, seq, _, _ in pickle.load(f)}.values())
+    histories = random.sample(histories, min(ARG.n_users, len(histories)))
+
+    index, build_time = timed(IVFIndex.from_ranker, ranker, n_lists=ARG.n_lists, seed=ARG.seed)
+    print(f'#POIs: {ranker.n_poi}, #lists: {index.centroids.size(0)}, index build: {build_time:.2f}s')
+    if ARG.index is not None:
+        torch.save(index.state_dict(), ARG.index)
+
+    # exhaustive scoring of the whole catalogue is the reference, both timings include the encoders
+    exact, exact_time = timed(ranker.rank, histories, ARG.k)
+    exact_scores = exact
+    exact = [pois for pois, _ in exact]
+    exact_ms = exact_time / len(histories) * 1e3
+    print(f'exhaustive: {exact_ms:.3f} ms/user')
+
+    # the top-K of a user does not depend on the other histories of the batch
+    single = [ranker.rank([seq], ARG.k)[0] for seq in histories]
+    diff = max((scores - batched[1]).abs().max().item() for (_, scores), batched in zip(single, exact_scores))
+    mismatches = sum(not torch.equal(pois, ref) for (pois, _), ref in zip(single, exact))
+    print(f'batched vs single-user: {mismatches} different top-K lists, max abs score difference {diff:.3g}')
+
+    print(f'{"nprobe":>8}{"n_cand":>8}{"recall@" + str(ARG.k):>12}{"ms/user":>10}{"speedup":>10}')
+    for nprobe in ARG.nprobe:
+        for n_candidates in ARG.n_candidates:
+            results, ann_time = timed(retrieve_and_rerank, ranker, index, histories,
+                                      ARG.k, n_candidates, nprobe)
+            hits = [len(set(pois.tolist()) & set(ref.tolist())) for (pois, _), ref in zip(results, exact)]
+            recall = sum(hits) / (len(histories) * min(ARG.k, ranker.n_poi))
+            ann_ms = ann_time / len(histories) * 1e3
+            print(f'{nprobe:>8}{n_candidates:>8}{recall:>12.4f}{ann_ms:>10.3f}{exact_ms / ann_ms:>10.2f}')
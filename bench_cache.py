@@ -0,0 +1,115 @@
+import argparse
+import json
+import pickle
+import random
+import time
+import numpy as np
+import torch
+from dataset import load_dist_graph
+from ranking import Ranker
+from result_cache import CachedRanker, ResultCache
+from serving import ServingModel
+
+
+ARG = argparse.ArgumentParser(
+    description='Latency of ranking requests with and without the result cache on a simulated traffic: '
+                'each request is for --users random validation users, each of whom checks in somewhere new '
+                'beforehand with probability --check_in_rate.')
+ARG.add_argument('--tables', type=str, default=None,
+                 help='Directory exported by serving.py. Either --tables or --ckpt is needed.')
+ARG.add_argument('--ckpt', type=str, default=None,
+                 help='Checkpoint written by main.py --ckpt.')
+ARG.add_argument('--data', type=str, default='nyc',
+                 help='Dataset of the model. nyc or tky.')
+ARG.add_argument('--n_users', type=int, default=200,
+                 help='Num of validation users sending requests.')
+ARG.add_argument('--requests', type=int, default=2000,
+                 help='Num of requests.')
+ARG.add_argument('--users', type=int, default=4,
+                 help='Num of distinct users per request.')
+ARG.add_argument('--check_in_rate', type=float, default=0.1,
+                 help='Probability that the user of a request checks in before it.')
+ARG.add_argument('--k', type=int, default=10,
+                 help='Num of POIs returned per user.')
+ARG.add_argument('--max_entries', type=int, default=100000,
+                 help='Max num of entries of the cache.')
+ARG.add_argument('--ttl', type=float, default=300.,
+                 help='Time to live of the cache entries in seconds.')
+ARG.add_argument('--seed', type=int, default=42,
+                 help='Random seed.')
+ARG.add_argument('--report', type=str, default=None,
+                 help='Path to save the results as JSON.')
+
+
+def traffic(histories, n_requests, n_users, check_in_rate, n_poi, rng):
+    '''(uids, histories, checked_in) of each request, the histories grow with the check-ins.'''
+    histories = {uid: list(seq) for uid, seq in histories.items()}
+    uids = list(histories)
+    requests = []
+    for _ in range(n_requests):
+        users = rng.sample(uids, min(n_users, len(uids)))
+        checked_in = [rng.random() < check_in_rate for _ in users]
+        for uid, checked in zip(users, checked_in):
+            if checked:
+                histories[uid] = histories[uid] + [rng.randrange(n_poi)]
+        requests.append((users, [histories[uid] for uid in users], checked_in))
+    return requests
+
+
+def percentiles(values):
+    p50, p99 = np.percentile(np.array(values) * 1e3, [50, 99])
+    return float(p50), float(p99)
+
+
+if __name__ == '__main__':
+    ARG = ARG.parse_args()
+    torch.manual_seed(ARG.seed)
+    rng = random.Random(ARG.seed)
+
+    if ARG.tables is not None:
+        ranker = Ranker.from_serving(ServingModel(ARG.tables))
+    elif ARG.ckpt is not None:
+        dist_edges, dist_vec = load_dist_graph(f'./processed_data/{ARG.data}')
+        ranker = Ranker.from_checkpoint(ARG.ckpt, dist_edges, dist_vec)
+    else:
+        raise ValueError('Either --tables or --ckpt is needed.')
+
+    with open(f'./processed_data/{ARG.data}/raw/val.pkl', 'rb') as f:
+        histories = {uid: seq for uid, _, seq, _, _ in pickle.load(f)}
+    histories = dict(rng.sample(sorted(histories.items()), min(ARG.n_users, len(histories))))
+    requests = traffic(histories, ARG.requests, ARG.users, ARG.check_in_rate, ranker.n_poi, rng)
+
+    uncached = []
+    for uids, user_histories, _ in requests:
+        start = time.perf_counter()
+        ranker.rank(user_histories, ARG.k)
+        uncached.append(time.perf_counter() - start)
+
+    # the results of a user are compared with those of the uncached ranker for the user alone, so that
+    # they depend neither on the other users of the request nor on those encoded with the cached entry
+    cached = CachedRanker(ranker, ResultCache(ARG.max_entries, ARG.ttl))
+    mismatches = 0
+    for uids, user_histories, checked_in in requests:
+        for uid, checked in zip(uids, checked_in):
+            if checked:
+                cached.check_in(uid)
+        results = cached.rank(uids, user_histories, ARG.k)
+        for (pois, _), history in zip(results, user_histories):
+            mismatches += not torch.equal(pois, ranker.rank([history], ARG.k)[0][0])
+
+    stats = cached.stats()
+    stats['uncached_p50_ms'], stats['uncached_p99_ms'] = percentiles(uncached)
+    stats['mismatches'] = mismatches
+    print(f'{ARG.requests} requests of {ARG.users} of {len(histories)} users, check-in rate {ARG.check_in_rate:g}')
+    print(f'hit rate: {stats["hit_rate"]:.3f}, top-K hits: {stats["topk_hits"]}, '
+          f'invalidated: {stats["invalidated"]}, results different from the uncached ranker: {mismatches}')
+    print(f'{"":>10}{"requests":>10}{"p50 (ms)":>10}{"p99 (ms)":>10}')
+    print(f'{"uncached":>10}{len(uncached):>10}{stats["uncached_p50_ms"]:>10.2f}{stats["uncached_p99_ms"]:>10.2f}')
+    for name in ('hit', 'miss'):
+        if stats[f'{name}_requests']:
+            print(f'{name:>10}{stats[f"{name}_requests"]:>10}{stats[f"{name}_p50_ms"]:>10.2f}'
+                  f'{stats[f"{name}_p99_ms"]:>10.2f}')
+
+    if ARG.report is not None:
+        with open(ARG.report, 'w') as f:
+            json.dump(stats, f, indent=1)
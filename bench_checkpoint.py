@@ -0,0 +1,96 @@
+import argparse
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+from GeoGraph import GeoGraph
+from bench_modules import synthetic_graph
+from misc import EmbeddingLayer
+
+
+BENCH = argparse.ArgumentParser(
+    description='Peak memory and time of a training step of the GeoGraph GCN layers on a synthetic graph, '
+                'with and without activation checkpointing (--checkpoint_gcn). Every run is a new process, '
+                'so that its peak RSS is its own.')
+BENCH.add_argument('--n_poi', type=int, default=50000,
+                   help='Num of POIs of the distance graph.')
+BENCH.add_argument('--degree', type=int, default=50,
+                   help='Average num of distance edges per POI.')
+BENCH.add_argument('--gcn_num', type=int, nargs='+', default=[1, 2, 4],
+                   help='Num of GCN layers.')
+BENCH.add_argument('--embed', type=int, nargs='+', default=[64, 128, 256],
+                   help='Embedding dimension.')
+BENCH.add_argument('--steps', type=int, default=5,
+                   help='Num of timed training steps.')
+BENCH.add_argument('--warmup', type=int, default=1,
+                   help='Num of untimed training steps.')
+BENCH.add_argument('--threads', type=int, default=1,
+                   help='Num of intra-op threads.')
+BENCH.add_argument('--seed', type=int, default=42,
+                   help='Random seed.')
+BENCH.add_argument('--report', type=str, default=None,
+                   help='Path to save the results as JSON.')
+BENCH.add_argument('--run', type=str, default=None,
+                   help='Internal, run one configuration given as JSON.')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(config):
+    '''Train the GCN layers for warmup + steps steps, returns the step time and the peak RSS over the setup.'''
+    torch.set_num_threads(BENCH.threads)
+    torch.manual_seed(BENCH.seed)
+    dist_edges, dist_vec = synthetic_graph(BENCH.n_poi, BENCH.degree, np.random.default_rng(BENCH.seed))
+    geo = GeoGraph(BENCH.n_poi, config['gcn_num'], config['embed'], dist_edges, dist_vec, 1,
+                   checkpoint=config['checkpoint'])
+    poi_embeds = EmbeddingLayer(BENCH.n_poi, config['embed'])
+    params = list(geo.mpnn.parameters()) + list(poi_embeds.parameters())
+    # the gradients are allocated once, before the base
+    for p in params:
+        p.grad = torch.zeros_like(p)
+    base = peak_rss_mb()
+
+    times = []
+    for _ in range(BENCH.warmup + BENCH.steps):
+        start = time.perf_counter()
+        for p in params:
+            p.grad.zero_()
+        geo.encode(poi_embeds).sum().backward()
+        times.append(time.perf_counter() - start)
+    return {**config, 'step_ms': float(np.median(times[BENCH.warmup:])) * 1e3,
+            'peak_mb': peak_rss_mb() - base}
+
+
+def launch(config):
+    cmd = [sys.executable, __file__] + sys.argv[1:] + ['--run', json.dumps(config)]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+if __name__ == '__main__':
+    BENCH = BENCH.parse_args()
+    if BENCH.run is not None:
+        print(json.dumps(run(json.loads(BENCH.run))))
+        sys.exit()
+
+    results = []
+    print(f'{"gcn_num":>8}{"embed":>7}{"peak (MB)":>11}{"ckpt (MB)":>11}{"memory":>8}'
+          f'{"step (ms)":>11}{"ckpt (ms)":>11}{"time":>7}')
+    for gcn_num, embed in itertools.product(BENCH.gcn_num, BENCH.embed):
+        plain, ckpt = (launch({'gcn_num': gcn_num, 'embed': embed, 'checkpoint': c}) for c in (False, True))
+        results.extend([plain, ckpt])
+        print(f'{gcn_num:>8}{embed:>7}{plain["peak_mb"]:>11.1f}{ckpt["peak_mb"]:>11.1f}'
+              f'{ckpt["peak_mb"] / plain["peak_mb"]:>8.2f}{plain["step_ms"]:>11.1f}{ckpt["step_ms"]:>11.1f}'
+              f'{ckpt["step_ms"] / plain["step_ms"]:>7.2f}', flush=True)
+
+    if BENCH.report is not None:
+        with open(BENCH.report, 'w') as f:
+            json.dump({'n_poi': BENCH.n_poi, 'degree': BENCH.degree, 'threads': BENCH.threads,
+                       'results': results}, f, indent=1)
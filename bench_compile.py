@@ -0,0 +1,84 @@
+import argparse
+import itertools
+import json
+import time
+import numpy as np
+import torch
+import torch._dynamo
+from dataset import static_inputs
+from trainer import Variant, build_parser, load_data, make_loaders, set_seed
+
+
+MODES = ['eager', 'static', 'compile']
+
+BENCH = argparse.ArgumentParser(
+    add_help=False,
+    description='Training step time of the eager model, of the static-shape mode and of the compiled '
+                'static-shape mode on the same batches. Other arguments are passed to the trainer, '
+                'see main.py --help.')
+BENCH.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES,
+                   help='Modes to run.')
+BENCH.add_argument('--steps', type=int, default=50,
+                   help='Num of timed training steps.')
+BENCH.add_argument('--warmup', type=int, default=10,
+                   help='Num of untimed training steps, the compilation of the first buckets happens here.')
+BENCH.add_argument('--report', type=str, default=None,
+                   help='Path to save the results as JSON.')
+
+BENCH, TRAIN_ARGS = BENCH.parse_known_args()
+
+
+def run(mode, batches, arg, n_poi, dist_edges, dist_vec):
+    '''Train a fresh model on the batches, returns the times of the warm-up and of the timed steps.'''
+    arg = argparse.Namespace(**vars(arg))
+    arg.static_shapes = {'eager': None, 'static': 'eager', 'compile': 'compile'}[mode]
+    set_seed(arg.seed)
+    torch._dynamo.reset()
+    variant = Variant('full', arg, n_poi, dist_edges, dist_vec, torch.device('cpu'))
+    variant.model.train()
+
+    times = []
+    for trn_batch, bnk_batch in batches:
+        start = time.perf_counter()
+        static = None
+        if arg.static_shapes:
+            static = static_inputs(trn_batch, arg.batch), static_inputs(bnk_batch, arg.batch)
+        variant.train_step(trn_batch, bnk_batch, arg, static)
+        times.append(time.perf_counter() - start)
+
+    warmup, timed = times[:BENCH.warmup], np.array(times[BENCH.warmup:]) * 1e3
+    return {'mode': mode, 'warmup_s': sum(warmup), 'median_ms': float(np.median(timed)),
+            'p90_ms': float(np.percentile(timed, 90)), 'mean_ms': float(timed.mean())}
+
+
+if __name__ == '__main__':
+    arg = build_parser().parse_args(TRAIN_ARGS)
+    if arg.resample_negatives:
+        raise ValueError('--resample_negatives is not supported, the benchmark trains on the negatives of train.pkl.')
+    if arg.threads is not None:
+        torch.set_num_threads(arg.threads)
+    set_seed(arg.seed)
+
+    n_user, n_poi, train_set, val_set, test_set, dist_edges, dist_vec = load_data(arg)
+    train_loader, bank_loader, _ = make_loaders(train_set, arg)
+    # every mode trains on the same batches, the loaders are cycled for short training sets
+    n_steps = BENCH.warmup + BENCH.steps
+    batches = list(itertools.islice(zip(itertools.cycle(train_loader), itertools.cycle(bank_loader)), n_steps))
+    shapes = set()
+    for pair in batches:
+        for inputs in (static_inputs(b, arg.batch) for b in pair):
+            shapes.add((inputs['x'].size(0), inputs['poi'].size(0), inputs['pad_len']))
+    print(f'{len(batches)} steps, {len(shapes)} distinct bucketed shapes')
+
+    results = []
+    print(f'{"mode":>10}{"warm-up (s)":>14}{"median (ms)":>14}{"p90 (ms)":>12}{"speedup":>10}')
+    for mode in BENCH.modes:
+        r = run(mode, batches, arg, n_poi, dist_edges, dist_vec)
+        results.append(r)
+        speedup = results[0]['median_ms'] / r['median_ms']
+        print(f'{mode:>10}{r["warmup_s"]:>14.2f}{r["median_ms"]:>14.2f}{r["p90_ms"]:>12.2f}{speedup:>10.2f}',
+              flush=True)
+
+    if BENCH.report is not None:
+        with open(BENCH.report, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,108 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import torch
+from torch.utils.data.distributed import DistributedSampler
+from dataset import make_loader
+from distributed import init_distributed, is_distributed, is_main_process
+from trainer import Variant, build_parser, load_data, set_seed
+import torch.distributed as dist
+
+
+BENCH = argparse.ArgumentParser(
+    description='Scaling of data-parallel training from 1 to --nproc processes. '
+                'Other arguments are passed to the trainer, see main.py --help.')
+BENCH.add_argument('--nproc', type=int, nargs='+', default=[1, 2, 4],
+                   help='Num of processes to benchmark.')
+BENCH.add_argument('--steps', type=int, default=50,
+                   help='Num of timed training steps.')
+BENCH.add_argument('--warmup', type=int, default=5,
+                   help='Num of untimed training steps.')
+BENCH.add_argument('--worker', action='store_true',
+                   help='Internal, run one training process under torchrun.')
+
+BENCH, TRAIN_ARGS = BENCH.parse_known_args()
+
+
+def worker():
+    arg = build_parser().parse_args(TRAIN_ARGS)
+    if arg.threads is not None:
+        torch.set_num_threads(arg.threads)
+    init_distributed()
+    set_seed(arg.seed)
+
+    n_user, n_poi, train_set, val_set, test_set, dist_edges, dist_vec = load_data(arg)
+    variant = Variant('full', arg, n_poi, dist_edges, dist_vec, torch.device('cpu'))
+    variant.model.train()
+
+    sampler = DistributedSampler(train_set, shuffle=True, seed=arg.seed)
+    bank_sampler = DistributedSampler(train_set, shuffle=True, seed=arg.seed + 1)
+    train_loader = make_loader(train_set, arg.batch, sampler=sampler)
+    # every rank has a shard of the same length
+    if len(train_loader) <= BENCH.warmup:
+        raise ValueError(f'The shard of a process has {len(train_loader)} batches, not more than --warmup '
+                         f'{BENCH.warmup}: lower --warmup or --batch, or use fewer processes.')
+    if len(train_loader) < BENCH.warmup + BENCH.steps:
+        logging.warning(f'The shard of a process has {len(train_loader)} batches, only '
+                        f'{len(train_loader) - BENCH.warmup} of the --steps {BENCH.steps} are timed.')
+    batches = zip(train_loader, make_loader(train_set, arg.batch, sampler=bank_sampler))
+
+    n_samples, n_steps = 0, 0
+    for step, (trn_batch, bnk_batch) in enumerate(batches):
+        if step == BENCH.warmup:
+            if is_distributed():
+                dist.barrier()
+            start = time.perf_counter()
+        if step >= BENCH.warmup:
+            n_samples += trn_batch.num_graphs
+            n_steps += 1
+        variant.train_step(trn_batch, bnk_batch, arg)
+        if step + 1 == BENCH.warmup + BENCH.steps:
+            break
+    if is_distributed():
+        dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    # every rank processes the same number of samples
+    world_size = dist.get_world_size()
+    if is_main_process():
+        print('RESULT ' + json.dumps({
+            'nproc': world_size,
+            'steps': n_steps,
+            'step_time': elapsed / n_steps,
+            'samples_per_sec': n_samples * world_size / elapsed,
+        }), flush=True)
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    if build_parser().parse_args(TRAIN_ARGS).resample_negatives:
+        raise ValueError('--resample_negatives is not supported, the benchmark trains on the negatives of train.pkl.')
+    if BENCH.worker:
+        worker()
+        sys.exit(0)
+
+    results = []
+    for nproc in BENCH.nproc:
+        cmd = [sys.executable, '-m', 'torch.distributed.run', '--standalone', f'--nproc_per_node={nproc}',
+               os.path.abspath(__file__), '--worker', '--steps', str(BENCH.steps),
+               '--warmup', str(BENCH.warmup)] + TRAIN_ARGS
+        out = subprocess.run(cmd, capture_output=True, text=True)
+        lines = [line for line in out.stdout.splitlines() if line.startswith('RESULT ')]
+        if out.returncode != 0 or not lines:
+            print(out.stderr, file=sys.stderr)
+            raise RuntimeError(f'Benchmark with {nproc} processes failed.')
+        results.append(json.loads(lines[-1][len('RESULT '):]))
+        if results[-1]['steps'] < BENCH.steps:
+            print(f'{nproc} processes: the shards are too short, {results[-1]["steps"]} steps were timed.')
+
+    base = results[0]['samples_per_sec'] / results[0]['nproc']
+    print(f'{"nproc":>6}{"step ms":>10}{"samples/s":>12}{"speedup":>10}{"efficiency":>12}')
+    for r in results:
+        speedup = r['samples_per_sec'] / base
+        print(f'{r["nproc"]:>6}{r["step_time"] * 1e3:>10.1f}{r["samples_per_sec"]:>12.1f}'
+              f'{speedup:>10.2f}{speedup / r["nproc"]:>12.2f}')
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import torch
+import preprocess
+import synth_checkins
+from dataset import MyDataset
+from trainer import Variant, build_parser, load_data, make_loaders, set_seed
+
+
+STAGES = ['generate', 'preprocess', 'dataset', 'train']
+
+BENCH = argparse.ArgumentParser(
+    parents=[synth_checkins.ARG], add_help=False,
+    description='End-to-end run on synthetic check-ins: generation, preprocess.py, the dataset build and '
+                'training steps, each in its own process, with the wall time and peak RSS of each stage. '
+                'The generator is set by the arguments of synth_checkins.py, other arguments are passed to '
+                'the trainer, see main.py --help.')
+BENCH.add_argument('--workdir', type=str, default='./e2e',
+                   help='Working directory, the processed data is written to processed_data/synth in it.')
+BENCH.add_argument('--src', type=str, default=None,
+                   help='Use this check-in file instead of generating one.')
+BENCH.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES,
+                   help='Stages to run, the later stages use the outputs of the earlier ones.')
+BENCH.add_argument('--threshold', type=float, default=0.5,
+                   help='Distance threshold of the neighborhood graph in km.')
+BENCH.add_argument('--graph', type=str, default='radius', choices=['radius', 'knn', 'adaptive'],
+                   help='Neighborhood graph of preprocess.py.')
+BENCH.add_argument('--k', type=int, default=10,
+                   help='Num of nearest neighbors of the knn and adaptive graphs.')
+BENCH.add_argument('--max_degree', type=int, default=0,
+                   help='Max num of neighbors of a POI, 0 does not cap the degree.')
+BENCH.add_argument('--steps', type=int, default=50,
+                   help='Num of timed training steps.')
+BENCH.add_argument('--warmup', type=int, default=5,
+                   help='Num of untimed training steps.')
+BENCH.add_argument('--report', type=str, default=None,
+                   help='Path to save the results as JSON.')
+BENCH.add_argument('--stage', type=str, default=None, choices=STAGES,
+                   help='Internal, run one stage in this process.')
+
+BENCH, TRAIN_ARGS = BENCH.parse_known_args()
+
+ROOT = 'processed_data/synth'
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def src_path():
+    if BENCH.src is not None:
+        return os.path.abspath(BENCH.src)
+    return os.path.join(os.path.abspath(BENCH.workdir), 'dataset_TSMC2014_SYNTH.txt')
+
+
+def stage_generate():
+    data = synth_checkins.generate(BENCH)
+    synth_checkins.write_tsv(data, src_path())
+    return {'checkins': len(data), 'users': BENCH.users, 'pois': int(data['poi'].nunique())}
+
+
+def stage_preprocess():
+    preprocess.main(['--src', src_path(), '--dst', f'{ROOT}/raw/', '--threshold', str(BENCH.threshold),
+                     '--graph', BENCH.graph, '--k', str(BENCH.k), '--max_degree', str(BENCH.max_degree)])
+    with open(f'{ROOT}/raw/graph_stats.json') as f:
+        stats = json.load(f)
+    return {'num_edges': stats['num_edges'], 'degree_max': stats['degree_max']}
+
+
+def stage_dataset():
+    # rebuild the processed files from the raw samples
+    shutil.rmtree(f'{ROOT}/processed', ignore_errors=True)
+    return {f'{split}_samples': len(MyDataset(ROOT, set=split)) for split in ['train', 'val', 'test']}
+
+
+def stage_train():
+    arg = build_parser().parse_args(TRAIN_ARGS + ['--data', 'synth'])
+    if arg.threads is not None:
+        torch.set_num_threads(arg.threads)
+    set_seed(arg.seed)
+
+    start = time.perf_counter()
+    n_user, n_poi, train_set, val_set, test_set, dist_edges, dist_vec = load_data(arg)
+    variant = Variant('full', arg, n_poi, dist_edges, dist_vec, torch.device('cpu'))
+    train_loader, bank_loader, _ = make_loaders(train_set, arg)
+    setup_time = time.perf_counter() - start
+
+    variant.model.train()
+    step, n_samples = 0, 0
+    while step < BENCH.warmup + BENCH.steps:
+        for trn_batch, bnk_batch in zip(train_loader, bank_loader):
+            if step == BENCH.warmup:
+                start = time.perf_counter()
+            if step >= BENCH.warmup:
+                n_samples += trn_batch.num_graphs
+            variant.train_step(trn_batch, bnk_batch, arg)
+            step += 1
+            if step == BENCH.warmup + BENCH.steps:
+                break
+    elapsed = time.perf_counter() - start
+
+    return {'setup_s': setup_time, 'steps': BENCH.steps, 'step_ms': elapsed / BENCH.steps * 1e3,
+            'samples_per_sec': n_samples / elapsed}
+
+
+def run_stage(name):
+    '''Run a stage in this process and print its result.'''
+    base_rss = peak_rss_mb()
+    start = time.perf_counter()
+    result = globals()[f'stage_{name}']()
+    result = {'stage': name, 'wall_s': time.perf_counter() - start,
+              'peak_rss_mb': peak_rss_mb(), 'base_rss_mb': base_rss, **result}
+    print('RESULT ' + json.dumps(result), flush=True)
+
+
+def launch(name):
+    '''Run a stage in a new process, so that its peak RSS is its own.'''
+    workdir = os.path.abspath(BENCH.workdir)
+    # the paths of the command line are relative to the current directory
+    cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--stage', name, '--workdir', workdir]
+    if BENCH.src is not None:
+        cmd += ['--src', os.path.abspath(BENCH.src)]
+    out = subprocess.run(cmd, cwd=workdir, stdout=subprocess.PIPE, text=True, check=True).stdout
+    for line in out.splitlines():
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+        print(line)
+    raise RuntimeError(f'The {name} stage printed no result.')
+
+
+if __name__ == '__main__':
+    if BENCH.stage is not None:
+        run_stage(BENCH.stage)
+        sys.exit()
+
+    os.makedirs(BENCH.workdir, exist_ok=True)
+    stages = [s for s in BENCH.stages if not (s == 'generate' and BENCH.src is not None)]
+    results = []
+    for name in stages:
+        results.append(launch(name))
+        r = results[-1]
+        extra = {k: v for k, v in r.items() if k not in ('stage', 'wall_s', 'peak_rss_mb', 'base_rss_mb')}
+        print(f'{name}: {r["wall_s"]:.2f}s, peak RSS {r["peak_rss_mb"]:.0f} MB, {extra}', flush=True)
+
+    print(f'{"stage":>12}{"wall (s)":>12}{"peak RSS (MB)":>16}{"base RSS (MB)":>16}')
+    for r in results:
+        print(f'{r["stage"]:>12}{r["wall_s"]:>12.2f}{r["peak_rss_mb"]:>16.0f}{r["base_rss_mb"]:>16.0f}')
+    if BENCH.report is not None:
+        with open(BENCH.report, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,79 @@
+import argparse
+import json
+import time
+import torch
+from evaluation import Evaluator
+from trainer import Variant, build_parser, load_data, make_loaders, set_seed
+
+
+BENCH = argparse.ArgumentParser(
+    add_help=False,
+    description='Accuracy and throughput of the model as the histories are bounded to their last K check-ins '
+                '(--history_last). Every K trains a fresh model on the same data. Other arguments are passed '
+                'to the trainer, see main.py --help.')
+BENCH.add_argument('--last', type=int, nargs='+', default=[0, 5, 10, 20, 50],
+                   help='Values of K, 0 keeps the full histories.')
+BENCH.add_argument('--epochs', type=int, default=1,
+                   help='Num of training epochs per K.')
+BENCH.add_argument('--report', type=str, default=None,
+                   help='Path to save the results as JSON.')
+
+BENCH, TRAIN_ARGS = BENCH.parse_known_args()
+
+
+def history_lengths(dataset):
+    '''Num of check-ins of the history of each sample, one more than its edges.'''
+    idx = torch.as_tensor(list(dataset.indices()))
+    ptr = dataset.slices['edge_index']
+    return ptr[idx + 1] - ptr[idx] + 1
+
+
+def run(k, arg):
+    '''Train a fresh model with histories of at most k check-ins, returns its throughput and AUCs.'''
+    arg = argparse.Namespace(**vars(arg))
+    arg.history_last = k
+    set_seed(arg.seed)
+    device = torch.device('cpu')
+    n_user, n_poi, train_set, val_set, test_set, dist_edges, dist_vec = load_data(arg)
+    variant = Variant('full', arg, n_poi, dist_edges, dist_vec, device)
+    train_loader, bank_loader, _ = make_loaders(train_set, arg)
+
+    variant.model.train()
+    n_samples = 0
+    start = time.perf_counter()
+    for _ in range(BENCH.epochs):
+        for trn_batch, bnk_batch in zip(train_loader, bank_loader):
+            variant.train_step(trn_batch, bnk_batch, arg)
+            n_samples += trn_batch.num_graphs
+    train_time = time.perf_counter() - start
+
+    result = {'last': k, 'hist_mean': history_lengths(train_set).float().mean().item(),
+              'train_samples_per_sec': n_samples / train_time}
+    for name, dataset in (('val', val_set), ('test', test_set)):
+        evaluator = Evaluator(dataset, arg, device)
+        # the first call collates the batches
+        evaluator(variant.model)
+        start = time.perf_counter()
+        result[f'{name}_auc'], result[f'{name}_logloss'] = evaluator(variant.model)
+        result[f'{name}_samples_per_sec'] = len(dataset) / (time.perf_counter() - start)
+    return result
+
+
+if __name__ == '__main__':
+    arg = build_parser().parse_args(TRAIN_ARGS)
+    if arg.resample_negatives:
+        raise ValueError('--resample_negatives is not supported, the benchmark trains on the negatives of train.pkl.')
+    if arg.threads is not None:
+        torch.set_num_threads(arg.threads)
+
+    results = []
+    print(f'{"K":>6}{"hist len":>10}{"train (samples/s)":>19}{"eval (samples/s)":>18}{"val AUC":>9}{"test AUC":>10}')
+    for k in BENCH.last:
+        r = run(k, arg)
+        results.append(r)
+        print(f'{k or "full":>6}{r["hist_mean"]:>10.1f}{r["train_samples_per_sec"]:>19.0f}'
+              f'{r["test_samples_per_sec"]:>18.0f}{r["val_auc"]:>9.4f}{r["test_auc"]:>10.4f}', flush=True)
+
+    if BENCH.report is not None:
+        with open(BENCH.report, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,256 @@
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import numpy as np
+import torch
+from torch_geometric.data import Batch, InMemoryDataset
+from GeoGraph import GeoGraph, SelfAttn
+from SeqGraph import SeqGraph
+from consistency import ConsistencyLoss
+from dataset import SeqGraphCollater, seq_to_graph
+from misc import EmbeddingLayer, autocast
+
+
+BENCHMARKS = ['GraphLayer', 'GeoGraph', 'SelfAttn', 'SeqGraph', 'ConsistencyLoss', 'collate']
+
+ARG = argparse.ArgumentParser(
+    description='CPU microbenchmarks of the model components on synthetic inputs.')
+sub = ARG.add_subparsers(dest='command', required=True)
+
+RUN = sub.add_parser('run', help='Run the benchmarks and save the results as JSON.')
+RUN.add_argument('--only', type=str, nargs='+', default=BENCHMARKS, choices=BENCHMARKS,
+                 help='Benchmarks to run.')
+RUN.add_argument('--n_poi', type=int, nargs='+', default=[5000, 50000],
+                 help='Num of POIs of the distance graph.')
+RUN.add_argument('--degree', type=int, nargs='+', default=[10, 50],
+                 help='Average num of distance edges per POI.')
+RUN.add_argument('--batch', type=int, nargs='+', default=[128, 1024],
+                 help='Num of samples per batch.')
+RUN.add_argument('--hist_len', type=int, nargs='+', default=[20, 100],
+                 help='Num of check-ins per history.')
+RUN.add_argument('--hid_graph_num', type=int, nargs='+', default=[16],
+                 help='Num of hidden graphs of SeqGraph.')
+RUN.add_argument('--hid_graph_size', type=int, nargs='+', default=[10],
+                 help='Size of the hidden graphs of SeqGraph.')
+RUN.add_argument('--embed', type=int, default=64,
+                 help='Embedding dimension.')
+RUN.add_argument('--gcn_num', type=int, default=2,
+                 help='Num of GCN layers of GeoGraph.')
+RUN.add_argument('--max_step', type=int, default=2,
+                 help='Steps of random walk of SeqGraph.')
+RUN.add_argument('--num_heads', type=int, default=1,
+                 help='Num of attention heads.')
+RUN.add_argument('--memory_size', type=int, default=12800,
+                 help='Memory bank size of the consistency loss.')
+RUN.add_argument('--precision', type=str, nargs='+', default=['fp32'], choices=['fp32', 'bf16'],
+                 help='Precisions of the forward passes, bf16 runs under autocast as trainer.py --precision bf16.')
+RUN.add_argument('--repeat', type=int, default=20,
+                 help='Num of timed runs of each benchmark.')
+RUN.add_argument('--warmup', type=int, default=3,
+                 help='Num of untimed runs of each benchmark.')
+RUN.add_argument('--threads', type=int, default=1,
+                 help='Num of intra-op threads.')
+RUN.add_argument('--seed', type=int, default=42,
+                 help='Random seed.')
+RUN.add_argument('--out', type=str, default='bench_baseline.json',
+                 help='Path of the JSON results.')
+
+COMPARE = sub.add_parser('compare', help='Compare results with a baseline, exit with 1 on a slowdown.')
+COMPARE.add_argument('baseline', type=str,
+                     help='JSON results of the baseline.')
+COMPARE.add_argument('current', type=str,
+                     help='JSON results to check.')
+COMPARE.add_argument('--threshold', type=float, default=0.1,
+                     help='Relative increase of the median time flagged as a slowdown.')
+
+
+def measure(fn, repeat, warmup):
+    '''Median and min of the wall time of fn() in ms.'''
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1e3)
+    return {'median_ms': float(np.median(times)), 'min_ms': float(np.min(times))}
+
+
+def train_fn(forward, params):
+    '''Forward and backward pass, the gradients are cleared every run.'''
+    def fn():
+        for p in params:
+            p.grad = None
+        out = forward()
+        out = out[0] if isinstance(out, tuple) else out
+        # the backward pass runs outside of autocast, as in training
+        with torch.autocast('cpu', enabled=False):
+            out.float().sum().backward()
+    return fn
+
+
+def eval_fn(forward, module):
+    '''Forward pass in eval mode, without autograd.'''
+    def fn():
+        module.eval()
+        with torch.no_grad():
+            forward()
+        module.train()
+    return fn
+
+
+def synthetic_graph(n_poi, degree, rng):
+    '''Random distance graph with n_poi * degree / 2 edges, as loaded by dataset.load_dist_graph.'''
+    n_edges = n_poi * degree // 2
+    dist_edges = torch.from_numpy(rng.integers(0, n_poi, size=(2, n_edges)))
+    dist_vec = rng.random(n_edges)
+    return dist_edges, dist_vec
+
+
+def synthetic_samples(n_poi, n_samples, hist_len, rng):
+    '''Samples of random histories, about half of the check-ins revisit a POI of the history.'''
+    samples = []
+    for uid in range(n_samples):
+        visited = rng.integers(0, n_poi, size=max(1, hist_len // 2))
+        seq = rng.choice(visited, size=hist_len).tolist()
+        samples.append(seq_to_graph(uid, int(rng.integers(n_poi)), seq, rng.random(2).tolist(), uid % 2))
+    return samples
+
+
+def benchmarks(arg, rng):
+    '''Yield (name, params, {mode: fn}) for the selected benchmarks over the parameter grid.'''
+    embed = arg.embed
+    only = set(arg.only)
+
+    for n_poi, degree in itertools.product(arg.n_poi, arg.degree):
+        if not only & {'GraphLayer', 'GeoGraph'}:
+            break
+        dist_edges, dist_vec = synthetic_graph(n_poi, degree, rng)
+        geo = GeoGraph(n_poi, arg.gcn_num, embed, dist_edges, dist_vec, arg.num_heads)
+        poi_embeds = EmbeddingLayer(n_poi, embed)
+        params = {'n_poi': n_poi, 'degree': degree, 'embed': embed}
+        if 'GraphLayer' in only:
+            layer = geo.mpnn[0]
+            forward = lambda: layer(poi_embeds.weight, geo.dist_edges, geo.dist_vec)
+            yield 'GraphLayer', params, {'fwd': eval_fn(forward, layer),
+                                         'train': train_fn(forward, list(layer.parameters()) +
+                                                           list(poi_embeds.parameters()))}
+        if 'GeoGraph' in only:
+            forward = lambda: geo.encode(poi_embeds)
+            yield 'GeoGraph', {**params, 'gcn_num': arg.gcn_num}, {
+                'fwd': eval_fn(forward, geo),
+                'train': train_fn(forward, list(geo.parameters()) + list(poi_embeds.parameters()))}
+
+    n_poi = max(arg.n_poi)
+    poi_embeds = EmbeddingLayer(n_poi, embed)
+    for batch_size, hist_len in itertools.product(arg.batch, arg.hist_len):
+        if not only & {'SelfAttn', 'SeqGraph', 'collate'}:
+            break
+        samples = synthetic_samples(n_poi, batch_size, hist_len, rng)
+        batch = Batch.from_data_list(samples)
+        params = {'batch': batch_size, 'hist_len': hist_len}
+
+        if 'SelfAttn' in only:
+            attn = SelfAttn(embed, arg.num_heads)
+            _, seq_len = torch.unique(batch.batch, return_counts=True)
+            sections = tuple(seq_len.numpy())
+            sess_embed = torch.randn(batch.num_nodes, embed, requires_grad=True)
+            forward = lambda: attn(sess_embed, sections)
+            yield 'SelfAttn', {**params, 'embed': embed}, {
+                'fwd': eval_fn(forward, attn), 'train': train_fn(forward, list(attn.parameters()) + [sess_embed])}
+
+        if 'SeqGraph' in only:
+            for graph_num, graph_size in itertools.product(arg.hid_graph_num, arg.hid_graph_size):
+                seq = SeqGraph(arg.max_step, embed, graph_num, graph_size)
+                forward = lambda: seq(batch, poi_embeds)
+                seq_params = {**params, 'hid_graph_num': graph_num, 'hid_graph_size': graph_size}
+                yield 'SeqGraph', seq_params, {
+                    'fwd': eval_fn(forward, seq),
+                    'train': train_fn(forward, list(seq.parameters()) + list(poi_embeds.parameters()))}
+
+        if 'collate' in only:
+            # fetch and collate a batch from an in-memory dataset, per sample as the PyG DataLoader does
+            # and vectorized as the training loaders do
+            dataset = InMemoryDataset()
+            dataset._data, dataset.slices = InMemoryDataset.collate(
+                synthetic_samples(n_poi, 4 * batch_size, hist_len, rng))
+            idx = rng.permutation(len(dataset))[:batch_size].tolist()
+            collater = SeqGraphCollater(dataset)
+            yield 'collate', params, {'fetch': lambda: Batch.from_data_list([dataset[i] for i in idx]),
+                                      'vectorized': lambda: collater(idx)}
+
+    if 'ConsistencyLoss' in only:
+        for batch_size in arg.batch:
+            loss_fn = ConsistencyLoss(embed, arg.memory_size, 0.01, torch.device('cpu'))
+            seq_embed = torch.randn(batch_size, embed, requires_grad=True)
+            geo_embed = torch.randn(batch_size, embed, requires_grad=True)
+            forward = lambda: loss_fn(seq_embed, geo_embed)
+            yield 'ConsistencyLoss', {'batch': batch_size, 'embed': embed, 'memory_size': arg.memory_size}, {
+                'train': train_fn(forward, [seq_embed, geo_embed])}
+
+
+def bench_key(name, params, mode):
+    return f'{name}[{",".join(f"{k}={v}" for k, v in params.items())}]/{mode}'
+
+
+def run(arg):
+    torch.set_num_threads(arg.threads)
+    torch.manual_seed(arg.seed)
+    rng = np.random.default_rng(arg.seed)
+
+    results = {}
+    for name, params, fns in benchmarks(arg, rng):
+        for precision in arg.precision:
+            if precision != 'fp32' and name == 'collate':
+                continue
+            # the keys of fp32 are those of the baselines without --precision
+            key_params = params if precision == 'fp32' else {**params, 'precision': precision}
+            for mode, fn in fns.items():
+                key = bench_key(name, key_params, mode)
+                with autocast(precision, 'cpu'):
+                    results[key] = measure(fn, arg.repeat, arg.warmup)
+                print(f'{key:<90}{results[key]["median_ms"]:>10.3f} ms')
+
+    meta = {'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+            'threads': arg.threads, 'repeat': arg.repeat}
+    with open(arg.out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print(f'Results written to {arg.out}')
+
+
+def compare(arg):
+    with open(arg.baseline) as f:
+        baseline = json.load(f)
+    with open(arg.current) as f:
+        current = json.load(f)
+    if baseline['meta'] != current['meta']:
+        print(f'Warning: different settings, baseline {baseline["meta"]}, current {current["meta"]}')
+
+    slow = []
+    print(f'{"benchmark":<90}{"baseline":>10}{"current":>10}{"change":>9}')
+    for key, base in baseline['results'].items():
+        if key not in current['results']:
+            continue
+        base_ms, cur_ms = base['median_ms'], current['results'][key]['median_ms']
+        change = cur_ms / base_ms - 1.
+        flag = ''
+        if change > arg.threshold:
+            slow.append(key)
+            flag = '  SLOWER'
+        print(f'{key:<90}{base_ms:>10.3f}{cur_ms:>10.3f}{change:>+9.1%}{flag}')
+
+    if slow:
+        print(f'{len(slow)} benchmarks are more than {arg.threshold:.0%} slower than the baseline.')
+        sys.exit(1)
+    print('No slowdown beyond the threshold.')
+
+
+if __name__ == '__main__':
+    arg = ARG.parse_args()
+    if arg.command == 'run':
+        run(arg)
+    else:
+        compare(arg)
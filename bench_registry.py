@@ -0,0 +1,101 @@
+import argparse
+import json
+import logging
+import os
+import pickle
+import random
+import time
+import numpy as np
+import torch
+from registry import ModelRegistry
+
+
+ARG = argparse.ArgumentParser(
+    description='Cold-start load time and resident size of the model of each city in a ModelRegistry, then '
+                'the latency of a mix of ranking requests to all the cities under the memory budget.')
+ARG.add_argument('--model', type=str, nargs='+', required=True,
+                 help='CITY=PATH, a checkpoint written by main.py --ckpt or tables written by serving.py, '
+                      'e.g. nyc=best_nyc.pt tky=tables_tky.')
+ARG.add_argument('--data_root', type=str, default='./processed_data',
+                 help='Directory of the processed data of the cities.')
+ARG.add_argument('--budget_mb', type=float, default=0.,
+                 help='Memory budget of the loaded models in MB, 0 for no limit.')
+ARG.add_argument('--workers', type=int, default=4,
+                 help='Num of threads of the request pool.')
+ARG.add_argument('--requests', type=int, default=200,
+                 help='Num of ranking requests after the cold starts.')
+ARG.add_argument('--users', type=int, default=8,
+                 help='Num of user histories per request.')
+ARG.add_argument('--k', type=int, default=10,
+                 help='Num of POIs returned per user.')
+ARG.add_argument('--threads', type=int, default=None,
+                 help='Num of intra-op threads, shared by all the cities.')
+ARG.add_argument('--seed', type=int, default=42,
+                 help='Random seed.')
+ARG.add_argument('--report', type=str, default=None,
+                 help='Path to save the results as JSON.')
+
+
+def rss_mb():
+    '''Current resident size of the process, from /proc (Linux).'''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def val_histories(data_root, city):
+    '''History of each validation user of a city.'''
+    with open(os.path.join(data_root, city, 'raw', 'val.pkl'), 'rb') as f:
+        return list({uid: seq for uid, _, seq, _, _ in pickle.load(f)}.values())
+
+
+if __name__ == '__main__':
+    ARG = ARG.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if ARG.threads is not None:
+        torch.set_num_threads(ARG.threads)
+    random.seed(ARG.seed)
+
+    sources = dict(spec.split('=', 1) for spec in ARG.model)
+    registry = ModelRegistry(sources, ARG.data_root, ARG.budget_mb, ARG.workers)
+    histories = {city: val_histories(ARG.data_root, city) for city in sources}
+
+    # cold starts, one city at a time so that the RSS growth is its own
+    cold = {}
+    print(f'{"city":>10}{"load (s)":>10}{"size (MB)":>11}{"RSS (MB)":>10}{"first (ms)":>12}')
+    for city in sources:
+        base = rss_mb()
+        start = time.perf_counter()
+        registry.submit(city, histories[city][:ARG.users], ARG.k).result()
+        first = time.perf_counter() - start
+        c = registry.stats()['cities'][city]
+        cold[city] = {'load_s': c['load_s'], 'size_mb': c['size_mb'], 'rss_mb': rss_mb() - base,
+                      'first_request_ms': first * 1e3}
+        print(f'{city:>10}{c["load_s"]:>10.2f}{c["size_mb"]:>11.1f}{rss_mb() - base:>10.1f}{first * 1e3:>12.1f}',
+              flush=True)
+
+    # requests to random cities, each waits for its model if it was evicted
+    cities = [random.choice(list(sources)) for _ in range(ARG.requests)]
+    latencies = {city: [] for city in sources}
+    start = time.perf_counter()
+    futures = []
+    for city in cities:
+        users = random.sample(histories[city], min(ARG.users, len(histories[city])))
+        futures.append((city, time.perf_counter(), registry.submit(city, users, ARG.k)))
+    for city, submitted, future in futures:
+        future.result()
+        latencies[city].append(time.perf_counter() - submitted)
+    elapsed = time.perf_counter() - start
+    registry.close()
+
+    stats = registry.stats()
+    print(f'{ARG.requests} requests in {elapsed:.2f}s, loaded {stats["size_mb"]:.1f} MB '
+          f'of a budget of {stats["budget_mb"]:g} MB')
+    print(f'{"city":>10}{"loads":>7}{"hits":>7}{"evictions":>11}{"p50 (ms)":>10}{"p99 (ms)":>10}')
+    for city, c in stats['cities'].items():
+        p50, p99 = np.percentile(np.array(latencies[city] or [0.]) * 1e3, [50, 99])
+        c.update(p50_ms=float(p50), p99_ms=float(p99))
+        print(f'{city:>10}{c["loads"]:>7}{c["hits"]:>7}{c["evictions"]:>11}{p50:>10.1f}{p99:>10.1f}')
+
+    if ARG.report is not None:
+        with open(ARG.report, 'w') as f:
+            json.dump({'cold': cold, 'stats': stats, 'elapsed_s': elapsed}, f, indent=1)
@@ -0,0 +1,162 @@
+import argparse
+import http.client
+import json
+import pickle
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+
+
+ARG = argparse.ArgumentParser(
+    description='Closed-loop load generator of scoring_server.py: concurrent clients send requests built from '
+                'the validation samples and the latency percentiles are reported.')
+ARG.add_argument('--model', type=str, default=None,
+                 help='Start scoring_server.py with this model for the run, otherwise connect to a running server.')
+ARG.add_argument('--host', type=str, default='127.0.0.1',
+                 help='Host of the server.')
+ARG.add_argument('--port', type=int, default=8000,
+                 help='Port of the server.')
+ARG.add_argument('--unix', type=str, default=None,
+                 help='Unix socket of the server instead of TCP.')
+ARG.add_argument('--max_batch', type=int, default=64,
+                 help='Max num of samples per micro-batch of a started server.')
+ARG.add_argument('--max_wait_ms', type=float, default=5.,
+                 help='Batching deadline in ms of a started server.')
+ARG.add_argument('--threads', type=int, default=None,
+                 help='Num of intra-op threads of a started server.')
+ARG.add_argument('--data', type=str, default='nyc',
+                 help='Dataset of the model. nyc or tky.')
+ARG.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                 help='Num of concurrent clients, one run each.')
+ARG.add_argument('--requests', type=int, default=2000,
+                 help='Num of timed requests per run.')
+ARG.add_argument('--warmup', type=int, default=50,
+                 help='Num of untimed requests per run.')
+ARG.add_argument('--samples_per_request', type=int, default=1,
+                 help='Num of (poi, history) samples per request.')
+ARG.add_argument('--report', type=str, default=None,
+                 help='Path to save the results as JSON.')
+ARG.add_argument('--seed', type=int, default=42,
+                 help='Random seed.')
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def connect(arg):
+    if arg.unix is not None:
+        return UnixHTTPConnection(arg.unix)
+    return http.client.HTTPConnection(arg.host, arg.port)
+
+
+def call(conn, method, path, body=None):
+    data = None if body is None else json.dumps(body)
+    conn.request(method, path, body=data, headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    reply = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError(f'{method} {path} failed with {response.status}: {reply}')
+    return reply
+
+
+def start_server(arg):
+    cmd = [sys.executable, 'scoring_server.py', '--model', arg.model, '--max_batch', str(arg.max_batch),
+           '--max_wait_ms', str(arg.max_wait_ms), '--host', arg.host, '--port', str(arg.port)]
+    if arg.unix is not None:
+        cmd += ['--unix', arg.unix]
+    if arg.threads is not None:
+        cmd += ['--threads', str(arg.threads)]
+    server = subprocess.Popen(cmd)
+    for _ in range(600):
+        try:
+            call(connect(arg), 'GET', '/health')
+            return server
+        except (OSError, http.client.HTTPException):
+            if server.poll() is not None:
+                raise RuntimeError('scoring_server.py exited before serving.')
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('scoring_server.py did not start in 60s.')
+
+
+def client(arg, bodies, latencies, errors):
+    '''Send the requests one after the other on a persistent connection.'''
+    conn = connect(arg)
+    for body in bodies:
+        start = time.perf_counter()
+        try:
+            call(conn, 'POST', '/score', body)
+        except (OSError, http.client.HTTPException, RuntimeError):
+            errors.append(1)
+            conn.close()
+            conn = connect(arg)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def run(arg, concurrency, samples):
+    '''Run concurrency clients until arg.warmup + arg.requests requests are sent.'''
+    def bodies(n):
+        return [{'samples': [{'poi': poi, 'history': seq}
+                             for poi, seq in random.sample(samples, arg.samples_per_request)]}
+                for _ in range(n)]
+
+    def spread(n):
+        # the requests of each client
+        return [bodies(n // concurrency + (i < n % concurrency)) for i in range(concurrency)]
+
+    for phase, n in (('warmup', arg.warmup), ('timed', arg.requests)):
+        latencies, errors = [], []
+        work = spread(n)
+        stats = call(connect(arg), 'GET', '/stats')
+        threads = [threading.Thread(target=client, args=(arg, w, latencies, errors)) for w in work]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+    after = call(connect(arg), 'GET', '/stats')
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1e3, [50, 90, 99])
+    n_batches = after['batches'] - stats['batches']
+    return {'concurrency': concurrency, 'requests': len(latencies), 'errors': len(errors),
+            'req_per_sec': len(latencies) / elapsed, 'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99,
+            'mean_batch': (after['requests'] - stats['requests']) * arg.samples_per_request / max(n_batches, 1)}
+
+
+if __name__ == '__main__':
+    ARG = ARG.parse_args()
+    random.seed(ARG.seed)
+
+    with open(f'./processed_data/{ARG.data}/raw/val.pkl', 'rb') as f:
+        samples = [(poi, seq) for _, poi, seq, _, _ in pickle.load(f)]
+
+    server = start_server(ARG) if ARG.model is not None else None
+    results = []
+    try:
+        print(f'{"clients":>8}{"req/s":>10}{"p50 (ms)":>10}{"p90 (ms)":>10}{"p99 (ms)":>10}{"batch":>8}{"errors":>8}')
+        for concurrency in ARG.concurrency:
+            r = run(ARG, concurrency, samples)
+            results.append(r)
+            print(f'{concurrency:>8}{r["req_per_sec"]:>10.1f}{r["p50_ms"]:>10.2f}{r["p90_ms"]:>10.2f}'
+                  f'{r["p99_ms"]:>10.2f}{r["mean_batch"]:>8.1f}{r["errors"]:>8}', flush=True)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if ARG.report is not None:
+        with open(ARG.report, 'w') as f:
+            json.dump(results, f, indent=1)
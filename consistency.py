@@ -2,6 +2,9 @@ import torch
 from torch import nn
 import math
 import torch.nn.functional as F
+from distributed import all_gather_cat, is_distributed
+from misc import fp32
+from timing import timed
 
 
 class SampleSimilarities(nn.Module):
@@ -38,6 +41,8 @@ class SampleSimilarities(nn.Module):
         Returns:
             torch.Tensor: The computed similarities.
         """
+        # under bf16 autocast only the product with the memory bank runs in bf16
+        input_embed = input_embed.float()
         batchSize = input_embed.shape[0]
         anchorSeq = self.memory.clone()
 
@@ -48,7 +53,7 @@ class SampleSimilarities(nn.Module):
         cosSim = torch.mm(norm_input, norm_anchor.t())
 
         # Scale by temperature
-        cosSim = torch.div(cosSim, self.T)
+        cosSim = torch.div(cosSim.float(), self.T)
 
         # Compute the softmax
         # sim = F.log_softmax(cosSim, dim=1) # log_softmax instead of softmax: for numerical stability
@@ -57,17 +62,24 @@ class SampleSimilarities(nn.Module):
         # Update the memory bank
         if update:
             with torch.no_grad():
+                new_embed = input_embed.detach()
+                # In data-parallel training every rank writes the sequences of all the ranks,
+                # so the memory banks stay identical across ranks
+                if is_distributed():
+                    new_embed = all_gather_cat(new_embed)
+                newSize = new_embed.shape[0]
+
                 # Compute the indices for updating anchor sequence in the memory bank
-                new_idx = torch.arange(batchSize).to(self.device)
+                new_idx = torch.arange(newSize).to(self.device)
                 new_idx += self.index
                 new_idx = torch.fmod(new_idx, self.queueSize)
                 new_idx = new_idx.long()
 
                 # Update the memory bank with the input sequence
-                self.memory.index_copy_(dim=0, index=new_idx, source=input_embed)
+                self.memory.index_copy_(dim=0, index=new_idx, source=new_embed)
 
                 # Update the index for the next update
-                self.index = (self.index + batchSize) % self.queueSize
+                self.index = (self.index + newSize) % self.queueSize
 
         return cosSim
 
@@ -94,6 +106,7 @@ class ConsistencyLoss(nn.Module):
         super(ConsistencyLoss, self).__init__()
         self.calculate_sampleSimilarities = SampleSimilarities(embed_dim, queue_size, T, device).to(device)
 
+    @timed('consistency')
     def forward(self, seq_embed, geo_embed):
             """
             Calculates the consistency loss between the given sequence and geometry embeddings.
@@ -118,12 +131,13 @@ class ConsistencyLoss(nn.Module):
             seq_simDistribution = self.calculate_sampleSimilarities(seq_embed)
             geo_simDistribution = self.calculate_sampleSimilarities(geo_embed)
             
-            # Apply the softmax function to the distributions
-            seq_simDistribution = F.log_softmax(seq_simDistribution, dim=1)
-            geo_simDistribution = F.softmax(geo_simDistribution, dim=1)
-            
-            # Calculate the KL divergence between the two distributions
-            eps = 1e-6
-            conLoss = F.kl_div(seq_simDistribution,geo_simDistribution+eps,reduction='batchmean')
+            with fp32(seq_simDistribution):
+                # Apply the softmax function to the distributions
+                seq_simDistribution = F.log_softmax(seq_simDistribution, dim=1)
+                geo_simDistribution = F.softmax(geo_simDistribution, dim=1)
+
+                # Calculate the KL divergence between the two distributions
+                eps = 1e-6
+                conLoss = F.kl_div(seq_simDistribution,geo_simDistribution+eps,reduction='batchmean')
 
             return conLoss
@@ -1,14 +1,330 @@
 import pickle as pkl
+import queue
+import threading
+import numpy as np
 import torch
-from torch_geometric.data import InMemoryDataset, Data
+from torch.utils.data import DataLoader
+from torch_geometric.data import Batch, InMemoryDataset, Data
 import os.path as osp
 from tqdm import tqdm
+from history import HistoryPolicy
+from negatives import NegativeSampler
+
+
+def load_dist_graph(root='./processed_data/nyc'):
+    '''Load the distance graph generated by preprocess.py.
+
+    Returns:
+        dist_edges (torch.Tensor): Edges of the graph, size (2, num_edges).
+        dist_vec (np.ndarray): Distance of the edges, size (num_edges,).
+    '''
+    with open(osp.join(root, 'raw', 'dist_graph.pkl'), 'rb') as f:
+        dist_edges = torch.LongTensor(pkl.load(f))
+    dist_vec = np.load(osp.join(root, 'raw', 'dist_on_graph.npy'))
+    return dist_edges, dist_vec
+
+
+def share_memory(dataset):
+    '''Move the storage of an InMemoryDataset to shared memory, so that worker processes
+       map the same pages instead of holding their own copy.'''
+    dataset._data.apply(lambda t: t.share_memory_())
+    for value in dataset.slices.values():
+        value.share_memory_()
+    return dataset
+
+
+def seq_to_graph(uid, poi, seq, coord, y):
+    '''Build the sequence graph of one sample.
+
+    Args:
+        uid (int): User id.
+        poi (int): Target POI.
+        seq (list): POIs in the history of the user.
+        coord (tuple): Coordinate of the target POI.
+        y (int): Label of the sample, 1 if the user visits the target POI.
+
+    Returns:
+        Data: The nodes are the unique POIs of the history in order of first appearance,
+              the edges link consecutive check-ins.
+    '''
+    # the first appearance order of the poi in the sequence
+    idx = 0
+    x = []
+    node2idx = dict()
+    for node in seq:
+        if node not in node2idx:
+            node2idx[node] = idx
+            x.append([node])
+            idx += 1
+    idx_seq = [node2idx[node] for node in seq]
+    # x is the poi of each node, size (num_nodes, 1)
+    x = torch.LongTensor(x)
+    # edge_index is the edge of the graph, size (2, num_edges)
+    edge_index = torch.LongTensor([idx_seq[:-1], idx_seq[1:]])
+    # y is the label (0 or 1) of the sample, size (1)
+    y = torch.LongTensor([y])
+    # size (1)
+    uid = torch.LongTensor([uid])
+    # target poi, size (1)
+    poi = torch.LongTensor([poi])
+    # coordinate of target poi, size (2)
+    coord = torch.Tensor(coord)
+
+    return Data(x=x, edge_index=edge_index, y=y, uid=uid, poi=poi, coord=coord)
+
+
+class SeqGraphCollater:
+    '''Collate batches of a MyDataset (or of a subset of it) by sample index, straight from its
+       concatenated storage.
+
+    The nodes and edges of the samples are gathered with the offsets of the slices of the dataset and
+    the node ids of the edges are shifted by the node offsets of the batch, a few array ops per batch
+    instead of the per-sample work of Batch.from_data_list. The Batch is the same as that of the PyG
+    DataLoader, without the bookkeeping of Batch.to_data_list.
+
+    Args:
+        dataset (MyDataset): Dataset of sequence graphs from seq_to_graph, possibly indexed.
+
+    Input:
+        list: Indices of the samples in the dataset.
+
+    Output:
+        Batch: The samples, with batch and ptr.
+    '''
+
+    def __init__(self, dataset):
+        data, slices = dataset._data, dataset.slices
+        self.index = torch.as_tensor(list(dataset.indices()), dtype=torch.long)
+        self.x, self.edge_index = data.x, data.edge_index
+        self.node_ptr, self.edge_ptr = slices['x'], slices['edge_index']
+        self.y, self.uid, self.poi = data.y, data.uid, data.poi
+        self.coord = data.coord.view(-1, 2)
+
+    def __call__(self, idx):
+        idx = self.index[torch.as_tensor(idx, dtype=torch.long)]
+        n_graphs = idx.size(0)
+        graphs = torch.arange(n_graphs)
+        n_nodes = self.node_ptr[idx + 1] - self.node_ptr[idx]
+        n_edges = self.edge_ptr[idx + 1] - self.edge_ptr[idx]
+        ptr = torch.cat((n_nodes.new_zeros(1), torch.cumsum(n_nodes, 0)))
+        edge_ptr = torch.cat((n_edges.new_zeros(1), torch.cumsum(n_edges, 0)))
+
+        # sample of each node and edge of the batch
+        batch = torch.repeat_interleave(graphs, n_nodes)
+        edge_batch = torch.repeat_interleave(graphs, n_edges)
+        # position in the storage of each node and edge of the batch
+        node = torch.arange(batch.size(0)) + (self.node_ptr[idx] - ptr[:-1])[batch]
+        edge = torch.arange(edge_batch.size(0)) + (self.edge_ptr[idx] - edge_ptr[:-1])[edge_batch]
+
+        out = Batch(x=self.x[node], edge_index=self.edge_index[:, edge] + ptr[edge_batch], y=self.y[idx],
+                    uid=self.uid[idx], poi=self.poi[idx], coord=self.coord[idx].view(-1), batch=batch, ptr=ptr)
+        out._num_graphs = n_graphs
+        return out
+
+
+def make_loader(dataset, batch_size, shuffle=False, sampler=None, **kwargs):
+    '''DataLoader of a MyDataset collated by SeqGraphCollater, with the same batches as the PyG DataLoader.'''
+    return DataLoader(range(len(dataset)), batch_size, shuffle=shuffle, sampler=sampler,
+                      collate_fn=SeqGraphCollater(dataset), **kwargs)
+
+
+class NegativeResampler:
+    '''Redraw the POI of the negative samples of a training set in place, e.g. at the start of every epoch,
+       instead of keeping the negatives drawn by preprocess.py.
+
+    The negatives of a history are anchored at the positive POI of the same history, for hard negatives;
+    when bounded histories of a user coincide, at any of their positives.
+    The storage of the POIs and coordinates is moved to shared memory, so that the loader workers
+    collate the redrawn negatives. The draws of an epoch depend only on the seed and the epoch.
+
+    Args:
+        dataset (MyDataset): Training set, the whole storage is redrawn even if it is indexed.
+        state (dict): The state.pkl of preprocess.py, with the user sequences and POI coordinates.
+        dist_edges (torch.Tensor): Edges of the distance graph, size (2, num_edges).
+        popularity (bool): Draw the negatives by popularity instead of uniformly.
+        hard (float): Share of the negatives drawn among the neighbors of the positive POI.
+        seed (int): Random seed.
+    '''
+
+    def __init__(self, dataset, state, dist_edges, popularity=False, hard=0., seed=0):
+        data, slices = dataset._data, dataset.slices
+        user_seqs, coords = state['user_seqs'], state['coords']
+        self.seed = seed
+        self.sampler = NegativeSampler(len(coords), user_seqs, popularity, dist_edges.numpy(), hard)
+        self.coords = torch.tensor([coords[poi] for poi in range(len(coords))], dtype=data.coord.dtype)
+
+        self.neg = torch.nonzero(data.y == 0).view(-1)
+        self.uid = data.uid[self.neg].numpy()
+        # the same history gives the same nodes and edges, so a sample is matched to a positive by them
+        x, edge_index = data.x.view(-1).numpy(), data.edge_index.numpy()
+        node_ptr, edge_ptr = slices['x'].tolist(), slices['edge_index'].tolist()
+        uids, pois, labels = data.uid.tolist(), data.poi.tolist(), data.y.tolist()
+
+        def key(i):
+            return (uids[i], x[node_ptr[i]:node_ptr[i + 1]].tobytes(),
+                    edge_index[:, edge_ptr[i]:edge_ptr[i + 1]].tobytes())
+
+        positives = {key(i): pois[i] for i in range(len(labels)) if labels[i] == 1}
+        self.anchor = np.array([positives[key(i)] for i in self.neg.tolist()], dtype=np.int64)
+
+        self.poi, self.coord = data.poi.share_memory_(), data.coord.view(-1, 2).share_memory_()
+
+    def __call__(self, epoch):
+        self.sampler.rng = np.random.default_rng([self.seed, epoch])
+        poi = torch.from_numpy(self.sampler.sample(self.uid, 1, self.anchor)[:, 0])
+        self.poi[self.neg] = poi
+        self.coord[self.neg] = self.coords[poi]
+
+
+def bucket(n, minimum=16):
+    '''Smallest size of the form 2^k or 3 * 2^(k-1) that holds n, so padding wastes at most a third.'''
+    size = minimum
+    while size < n:
+        size = size * 3 // 2 if size & (size - 1) == 0 else size * 4 // 3
+    return size
+
+
+def static_inputs(batch, batch_size):
+    '''Pad a Batch to bucketed shapes for the static-shape forward of the encoders (forward_static).
+
+    The samples are padded to batch_size (or a bucket of the num of samples if larger), the nodes and
+    the edges to one bucket M > num_nodes, and the sequences to a bucket P of the longest one. The padding
+    nodes and edges belong to an extra trash sample, index batch_size, which is dropped.
+
+    Returns:
+        dict: x (M,) POI of each node, edge_index (2, M), graph (M,) sample of each node, pos (M,) position
+              of each node in its sample, poi (batch_size,) target POI, valid (batch_size,) mask of the real
+              samples, max_len () length of the longest sequence and pad_len the int P.
+    '''
+    device = batch.x.device
+    n_graphs, n_nodes, n_edges = batch.num_graphs, batch.num_nodes, batch.edge_index.size(1)
+    batch_size = max(batch_size, bucket(n_graphs))
+    size = bucket(max(n_nodes + 1, n_edges))
+
+    seq_len = batch.ptr[1:] - batch.ptr[:-1]
+    max_len = seq_len.max()
+    pos = torch.arange(n_nodes, device=device) - batch.ptr[batch.batch]
+
+    trash_nodes = size - n_nodes
+    x = torch.cat((batch.x.view(-1), batch.x.new_zeros(trash_nodes)))
+    graph = torch.cat((batch.batch, batch.batch.new_full((trash_nodes,), batch_size)))
+    pos = torch.cat((pos, pos.new_zeros(trash_nodes)))
+    # the padding edges link the first trash node to itself
+    edge_index = torch.cat((batch.edge_index, batch.edge_index.new_full((2, size - n_edges), n_nodes)), dim=1)
+    poi = torch.cat((batch.poi, batch.poi.new_zeros(batch_size - n_graphs)))
+    valid = torch.arange(batch_size, device=device) < n_graphs
+
+    return {'x': x, 'edge_index': edge_index, 'graph': graph, 'pos': pos, 'poi': poi, 'valid': valid,
+            'max_len': max_len, 'pad_len': bucket(int(max_len))}
+
+
+def _apply(obj, fn):
+    '''Apply fn to the tensors and Batches of a (nested) tuple, list or dict, other values are kept.'''
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_apply(value, fn) for value in obj)
+    if isinstance(obj, dict):
+        return {key: _apply(value, fn) for key, value in obj.items()}
+    if torch.is_tensor(obj) or isinstance(obj, Data):
+        return fn(obj)
+    return obj
+
+
+# queued by the background thread after the last batch
+END = object()
+
+
+class Prefetcher:
+    '''Load the next batches in a background thread while the current step computes.
+
+    The thread takes up to depth items ahead from batches (e.g. the collated pairs of the training and
+    memory bank loaders), and on CUDA pins them and copies them to the device on a side stream with
+    non_blocking transfers; the training stream waits for the copy of an item only when it is taken.
+    On the CPU the thread only collates ahead. The first item is loaded in the calling thread, as the
+    shuffling samplers draw their seeds from the global generator on their first batch, which must not
+    race with the dropout of the training step: the batches and the training are the same as without
+    prefetching.
+
+    Args:
+        batches (iterable): Items of tensors, Batches or (nested) tuples, lists and dicts of them.
+        device (torch.device): Device of the returned items.
+        depth (int): Max num of items loaded ahead.
+    '''
+
+    def __init__(self, batches, device, depth=2):
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        batches = iter(batches)
+        self.first = next(batches, END)
+        if self.first is not END:
+            self.first = self._load(self.first)
+        self.thread = threading.Thread(target=self._worker, args=(batches,), daemon=True)
+        self.thread.start()
+
+    def _load(self, item):
+        if self.stream is None:
+            return item, None
+        item = _apply(item, lambda t: t.pin_memory())
+        with torch.cuda.stream(self.stream):
+            item = _apply(item, lambda t: t.to(self.device, non_blocking=True))
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        return item, copied
+
+    def _put(self, item):
+        '''Queue an item, returns False if the prefetcher was closed meanwhile.'''
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self, batches):
+        try:
+            for item in batches:
+                if not self._put(self._load(item)):
+                    return
+        except Exception as e:
+            # raised in the training thread when it takes the item
+            self._put((e, None))
+            return
+        self._put(END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.first is not None:
+            item, self.first = self.first, None
+        else:
+            item = self.queue.get()
+        if item is END:
+            raise StopIteration
+        item, copied = item
+        if isinstance(item, Exception):
+            raise item
+        if copied is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(copied)
+            # the memory of the copies is used on the training stream, not only on the side stream
+            _apply(item, lambda t: t.record_stream(stream))
+        return item
+
+    def close(self):
+        '''Stop the background thread, the items not taken yet are dropped.'''
+        self.stop.set()
+        self.thread.join()
 
 
 class MyDataset(InMemoryDataset):
-    def __init__(self, root='./processed_data/nyc', set='train', transform=None, pre_transform=None):
+    def __init__(self, root='./processed_data/nyc', set='train', transform=None, pre_transform=None, history=None):
         # set is 'train' or 'test' or 'val'
         self.set = set
+        # the histories are bounded when the graphs are built, each policy has its own file
+        self.history = history or HistoryPolicy()
         
         super().__init__(root, transform, pre_transform)
         self.load(self.processed_paths[0])
@@ -21,7 +337,7 @@ class MyDataset(InMemoryDataset):
     @property
     def processed_file_names(self):
         # the file to save the processed data
-        return [f'{self.set}_seq_graph.pt']
+        return [f'{self.set}_seq_graph{self.history.tag()}.pt']
 
     def download(self):
         # no need to download
@@ -32,32 +348,8 @@ class MyDataset(InMemoryDataset):
             data = pkl.load(f)
             print(f'orignial data num of {self.set}: {len(data)}')
             
-        data_list = []
-        for uid, poi, seq, coord, y in tqdm(data):
-            # the first appearance order of the poi in the sequence
-            idx = 0
-            x = []
-            node2idx = dict()
-            for node in seq:
-                if node not in node2idx:
-                    node2idx[node] = idx
-                    x.append([node])
-                    idx += 1
-            idx_seq = [node2idx[node] for node in seq]
-            # x is the poi of each node, size (num_nodes, 1)
-            x = torch.LongTensor(x)
-            # edge_index is the edge of the graph, size (2, num_edges)
-            edge_index = torch.LongTensor([idx_seq[:-1], idx_seq[1:]])
-            # y is the label (0 or 1) of the sample, size (1)
-            y = torch.LongTensor([y])
-            # size (1)
-            uid = torch.LongTensor([uid])
-            # target poi, size (1)
-            poi = torch.LongTensor([poi])
-            # coordinate of target poi, size (2)
-            coord = torch.Tensor(coord)
-
-            data_list.append(Data(x=x, edge_index=edge_index,
-                             y=y, uid=uid, poi=poi, coord=coord))
+        if self.history:
+            data = [(uid, poi, self.history(seq), coord, y) for uid, poi, seq, coord, y in data]
+        data_list = [seq_to_graph(*sample) for sample in tqdm(data)]
 
         self.save(data_list, self.processed_paths[0])
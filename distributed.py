@@ -0,0 +1,65 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    '''Join the process group set up by torchrun.
+
+    Returns:
+        tuple: (rank, world_size)
+    '''
+    if 'RANK' not in os.environ:
+        raise RuntimeError('--ddp needs the environment of torchrun, e.g. '
+                           'torchrun --standalone --nproc_per_node 4 main.py --ddp')
+    dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_module(module, src=0):
+    '''Copy the parameters and buffers of the module on rank src to all the ranks.'''
+    for tensor in module.state_dict().values():
+        dist.broadcast(tensor, src)
+
+
+def allreduce_grads(parameters):
+    '''Average the gradients over the ranks, with one all-reduce over a flat buffer.
+       Parameters without a gradient are skipped, they are unused on every rank.'''
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def all_gather_cat(tensor):
+    '''Concatenate the tensor of every rank along the first dimension, in rank order.
+       The tensors must have the same size on every rank.'''
+    gathered = [torch.empty_like(tensor) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, tensor.contiguous())
+    return torch.cat(gathered, dim=0)
+
+
+def broadcast_object(obj, src=0):
+    '''Send a picklable object from rank src to all the ranks.'''
+    objs = [obj]
+    dist.broadcast_object_list(objs, src)
+    return objs[0]
@@ -0,0 +1,94 @@
+import argparse
+import math
+import time
+import torch
+import torch.nn.functional as F
+from misc import EmbeddingLayer, QREmbeddingLayer, QuantizedEmbeddingLayer, module_nbytes
+
+
+ARG = argparse.ArgumentParser()
+ARG.add_argument('--n_poi', type=int, nargs='+', default=[10000, 100000, 1000000, 10000000],
+                 help='Catalogue sizes to report the memory for.')
+ARG.add_argument('--embed', type=int, default=64,
+                 help='Embedding dimension.')
+ARG.add_argument('--qr_buckets', type=int, default=1024,
+                 help='Num of remainder buckets of the qr embedding.')
+ARG.add_argument('--gcn_num', type=int, default=2,
+                 help='Num of GCN, used to estimate the GeoGraph activation memory.')
+ARG.add_argument('--sample_poi', type=int, default=100000,
+                 help='Size of the table used to measure quantisation error and lookup time.')
+ARG.add_argument('--seed', type=int, default=42,
+                 help='Random seed.')
+
+ARG = ARG.parse_args()
+
+
+def fmt_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n < 1024:
+            return f'{n:.1f}{unit}'
+        n /= 1024
+    return f'{n:.1f}TB'
+
+
+def table_nbytes(kind, n_poi, arg):
+    '''Bytes needed to store the POI embedding table of the given kind.'''
+    if kind == 'dense':
+        return n_poi * arg.embed * 4
+    if kind == 'qr':
+        return (math.ceil(n_poi / arg.qr_buckets) + arg.qr_buckets) * arg.embed * 4
+    if kind == 'int8':
+        # one int8 per element and one fp32 scale per row
+        return n_poi * arg.embed + n_poi * 4
+    if kind == 'fp16':
+        return n_poi * arg.embed * 2
+    raise ValueError(kind)
+
+
+def lookup_time(layer, n_poi, n_lookup=4096, repeat=50):
+    idx = torch.randint(0, n_poi, (n_lookup,))
+    with torch.no_grad():
+        layer(idx)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            layer(idx)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+if __name__ == '__main__':
+    torch.manual_seed(ARG.seed)
+    kinds = ['dense', 'qr', 'int8', 'fp16']
+
+    print(f'POI embedding memory (embed={ARG.embed}, qr_buckets={ARG.qr_buckets})')
+    print(f'{"n_poi":>10}' + ''.join(f'{k:>12}' for k in kinds) + f'{"GCN act.":>12}')
+    for n_poi in ARG.n_poi:
+        row = f'{n_poi:>10}' + ''.join(f'{fmt_bytes(table_nbytes(k, n_poi, ARG)):>12}' for k in kinds)
+        # every GCN layer keeps the Linear, SpMM, leaky_relu and normalize outputs for backward
+        row += f'{fmt_bytes(4 * ARG.gcn_num * n_poi * ARG.embed * 4):>12}'
+        print(row)
+
+    # measure the layers on a sample table
+    dense = EmbeddingLayer(ARG.sample_poi, ARG.embed)
+    layers = {
+        'dense': dense,
+        'qr': QREmbeddingLayer(ARG.sample_poi, ARG.embed, ARG.qr_buckets),
+        'int8': QuantizedEmbeddingLayer.from_float(dense, 'int8'),
+        'fp16': QuantizedEmbeddingLayer.from_float(dense, 'fp16'),
+    }
+
+    print()
+    print(f'Sample table with {ARG.sample_poi} POIs')
+    print(f'{"layer":>8}{"bytes":>12}{"lookup us":>12}{"rel. err":>12}{"min cos":>12}')
+    with torch.no_grad():
+        ref = dense.weight
+        for kind, layer in layers.items():
+            row = f'{kind:>8}{fmt_bytes(module_nbytes(layer)):>12}{lookup_time(layer, ARG.sample_poi):>12.1f}'
+            if kind in ('int8', 'fp16'):
+                approx = layer.weight
+                rel_err = ((approx - ref).norm() / ref.norm()).item()
+                min_cos = F.cosine_similarity(approx, ref, dim=-1).min().item()
+                row += f'{rel_err:>12.2e}{min_cos:>12.6f}'
+            else:
+                # the qr table is a different model, its accuracy comes from training (main.py --poi_embed qr)
+                row += f'{"-":>12}{"-":>12}'
+            print(row)
@@ -0,0 +1,189 @@
+import torch
+import torch.nn.functional as F
+from dataset import make_loader
+from misc import autocast
+
+
+def binary_auc(scores, labels):
+    '''ROC AUC computed on the device from one sort (Mann-Whitney U statistic).
+       Tied scores get their average rank, as in sklearn.metrics.roc_auc_score.
+
+    Args:
+        scores (torch.Tensor): Predicted scores (probabilities or logits), size (n,).
+        labels (torch.Tensor): Binary labels, size (n,).
+
+    Returns:
+        torch.Tensor: The AUC, a 0-d tensor.
+    '''
+    scores, order = torch.sort(scores.double())
+    labels = labels[order].double()
+    _, inverse, counts = torch.unique_consecutive(scores, return_inverse=True, return_counts=True)
+    # 1-based average rank of each group of tied scores
+    avg_rank = torch.cumsum(counts, dim=0).double() - (counts.double() - 1.) / 2.
+    ranks = avg_rank[inverse]
+
+    n_pos = labels.sum()
+    n_neg = labels.numel() - n_pos
+    return ((ranks * labels).sum() - n_pos * (n_pos + 1.) / 2.) / (n_pos * n_neg)
+
+
+class Evaluator:
+    '''AUC and logloss of a model on a fixed dataset.
+
+    The batches are collated once, in order, and kept on the device, so repeated evaluations
+    (e.g. once per epoch) skip the data loading. The GCN layers run once per evaluation.
+    The logits stay on the device and are transferred to the host only as the final metrics.
+
+    Args:
+        dataset (MyDataset): Evaluation set.
+        arg (argparse.Namespace): Hyperparameters, uses arg.eval_batch and arg.precision.
+        device (torch.device): Device of the model.
+
+    Input:
+        KBGNN: The model.
+        str: Precision of the forward pass, 'fp32' or 'bf16', arg.precision if None.
+
+    Output:
+        tuple: (AUC, logloss)
+    '''
+
+    def __init__(self, dataset, arg, device):
+        self.loader = make_loader(dataset, arg.eval_batch)
+        self.device = device
+        self.precision = getattr(arg, 'precision', 'fp32')
+        self.batches = None
+
+    def __call__(self, model, precision=None):
+        if self.batches is None:
+            self.batches = [batch.to(self.device) for batch in self.loader]
+
+        model.eval()
+
+        logits, labels = [], []
+        logloss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        with torch.no_grad(), autocast(precision or self.precision, self.device):
+            poi_enc = model.encode_pois()
+            for batch in self.batches:
+                logit = model(batch, poi_enc).view(-1).float()
+                label = batch.y.view(-1).float()
+                logloss_sum += F.binary_cross_entropy_with_logits(logit, label, reduction='sum').double()
+                logits.append(logit)
+                labels.append(label)
+
+        logits, labels = torch.cat(logits), torch.cat(labels)
+        auc = binary_auc(logits, labels)
+        auc, logloss = torch.stack((auc, logloss_sum / labels.numel())).tolist()
+
+        return auc, logloss
+
+
+class RankingMetrics:
+    '''Streaming Recall@K, NDCG@K and MRR. The sums stay on the device of the ranks.
+
+    Args:
+        ks (List[int]): Cut-offs of Recall and NDCG.
+    '''
+
+    def __init__(self, ks):
+        self.ks = list(ks)
+        self.sums = None
+        self.count = 0
+
+    def update(self, ranks):
+        '''Add a batch of 0-based ranks of the positive POIs.'''
+        ranks = ranks.float()
+        gain = 1. / torch.log2(ranks + 2.)
+        stats = []
+        for k in self.ks:
+            hit = (ranks < k).float()
+            stats.append(hit.sum())
+            stats.append((hit * gain).sum())
+        stats.append((1. / (ranks + 1.)).sum())
+
+        stats = torch.stack(stats)
+        self.sums = stats if self.sums is None else self.sums + stats
+        self.count += ranks.numel()
+
+    def compute(self):
+        '''Return the averaged metrics as a dict, with a single transfer to the host.'''
+        values = (self.sums / max(self.count, 1)).tolist()
+        metrics = {}
+        for i, k in enumerate(self.ks):
+            metrics[f'Recall@{k}'] = values[2 * i]
+            metrics[f'NDCG@{k}'] = values[2 * i + 1]
+        metrics['MRR'] = values[-1]
+        return metrics
+
+
+def sample_candidates(poi, n_poi, n_cand):
+    '''n_cand distinct POIs other than poi for each sample, drawn uniformly, size (len(poi), n_cand).
+
+    Only n_cand POIs are drawn per sample: the duplicates are redrawn until there are none. When the
+    candidates are more than half of the other POIs, the top-n_cand of uniform noise over all of them
+    is cheaper.
+    '''
+    size, device = (poi.size(0), n_cand), poi.device
+    if 2 * n_cand > n_poi - 1:
+        sampled = torch.rand(poi.size(0), n_poi - 1, device=device).topk(n_cand, dim=1).indices
+    else:
+        sampled = torch.randint(0, n_poi - 1, size, device=device)
+        while True:
+            values, order = sampled.sort(dim=1)
+            dup = torch.zeros(size, dtype=torch.bool, device=device)
+            dup[:, 1:] = values[:, 1:] == values[:, :-1]
+            if not dup.any():
+                break
+            dup = torch.zeros_like(dup).scatter_(1, order, dup)
+            sampled[dup] = torch.randint(0, n_poi - 1, (int(dup.sum()),), device=device)
+    # the POIs among the n_poi - 1 others, shifted past the positive one
+    return sampled + (sampled >= poi.view(-1, 1)).long()
+
+
+def eval_ranking(model, dataset, arg, device):
+    '''Rank the visited POI of every positive sample against the whole catalogue,
+       or against arg.rank_candidates POIs when it is positive, drawn uniformly without replacement among
+       the other POIs for each user.
+
+    The GCN layers run once and the target part of the predictor (see MLP.target_part) is computed
+    for all the POIs. For each batch of users the candidates are scored in blocks of arg.rank_block
+    POIs on the device, and only the number of candidates scored above the positive POI is kept.
+    A candidate equal to the positive POI is not counted.
+
+    Returns:
+        dict: Recall@K and NDCG@K for K in arg.topk, and MRR.
+    '''
+    positives = dataset[torch.nonzero(dataset.y == 1).view(-1)]
+    loader = make_loader(positives, arg.eval_batch)
+    metrics = RankingMetrics(arg.topk)
+    predictor = model.predictor
+
+    model.eval()
+
+    with torch.no_grad():
+        poi_enc = model.encode_pois()
+        target_parts = predictor.target_part(poi_enc)
+        n_poi = target_parts.size(0)
+
+        for batch in loader:
+            batch = batch.to(device)
+            embeds, _ = model.user_embeds(batch, poi_enc)
+            user_part = predictor.user_part(*embeds).unsqueeze(1)
+            pos_score = predictor.score(user_part, target_parts[batch.poi].unsqueeze(1)).view(-1, 1)
+
+            if arg.rank_candidates > 0:
+                n_cand = min(arg.rank_candidates, n_poi - 1)
+                sampled = sample_candidates(batch.poi, n_poi, n_cand)
+            else:
+                n_cand = n_poi
+            higher = torch.zeros(user_part.size(0), dtype=torch.long, device=device)
+            for i in range(0, n_cand, arg.rank_block):
+                if arg.rank_candidates > 0:
+                    cand = sampled[:, i:i + arg.rank_block]
+                else:
+                    cand = torch.arange(i, min(i + arg.rank_block, n_poi), device=device).unsqueeze(0)
+                scores = predictor.score(user_part, target_parts[cand]).squeeze(-1)
+                higher += ((scores > pos_score) & (cand != batch.poi.view(-1, 1))).sum(dim=1)
+
+            metrics.update(higher)
+
+    return metrics.compute()
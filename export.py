@@ -0,0 +1,230 @@
+import argparse
+import copy
+import pickle
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from dataset import load_dist_graph
+from history import HistoryPolicy
+from model import load_checkpoint, load_model
+from serving import make_batch
+
+
+class SeqKernel(nn.Module):
+    '''Inference form of SeqGraph on plain tensors, for TorchScript and ONNX.
+       The features of the hidden graphs after each step of random walk do not depend on the input,
+       so they are computed once at export.
+
+    Args:
+        seq (SeqGraph): Trained sequential encoder.
+
+    Input:
+        poi_feat (torch.Tensor): Embeddings of the nodes of the sequence graphs, size (num_nodes, embed_dim).
+        edge_index (torch.Tensor): Edges of the sequence graphs, size (2, num_edges).
+        graph_indicator (torch.Tensor): Sample of each node, size (num_nodes,).
+        n_graphs (int): Num of samples.
+
+    Output:
+        torch.Tensor: Sequential embeddings e_s, size (n_graphs, embed_dim).
+    '''
+
+    def __init__(self, seq):
+        super(SeqKernel, self).__init__()
+        self.max_step = seq.max_step
+        size = seq.hidden_graph_size
+        with torch.no_grad():
+            adj = torch.zeros(seq.hidden_graph_num, size, size)
+            idx = torch.triu_indices(size, size, 1)
+            adj[:, idx[0], idx[1]] = seq.relu(seq.hidden_adj)
+            adj = adj + torch.transpose(adj, 1, 2)
+
+            z = seq.hidden_feat.detach().clone()
+            hidden_feat = [z]
+            for _ in range(1, self.max_step):
+                z = torch.einsum("abc,acd->abd", (adj, z))
+                hidden_feat.append(z)
+        # size (max_step, hidden_graph_num, hidden_graph_size, embed_dim)
+        self.register_buffer('hidden_feat', torch.stack(hidden_feat))
+
+        self.fc = copy.deepcopy(seq.fc)
+        self.bn = copy.deepcopy(seq.bn)
+        self.fc1 = copy.deepcopy(seq.fc1)
+        self.fc2 = copy.deepcopy(seq.fc2)
+
+    def forward(self, poi_feat, edge_index, graph_indicator, n_graphs: int):
+        x = torch.sigmoid(self.fc(poi_feat))
+        zx = torch.einsum("abc,dc->abd", (self.hidden_feat[0], x))
+
+        out = []
+        for i in range(self.max_step):
+            if i > 0:
+                # sum of the features of the predecessors, as SeqGraph.propagate
+                x = torch.zeros_like(x).index_add_(0, edge_index[1], x[edge_index[0]])
+            t = torch.einsum("abc,dc->abd", (self.hidden_feat[i], x)) * zx
+            t = torch.zeros(t.size(0), t.size(1), n_graphs, dtype=t.dtype).index_add_(2, graph_indicator, t)
+            out.append(torch.transpose(torch.sum(t, dim=1), 0, 1))
+
+        out = self.bn(torch.cat(out, dim=1))
+        out = F.leaky_relu(self.fc1(out))
+        return self.fc2(out)
+
+
+class GeoKernel(nn.Module):
+    '''Inference form of GeoGraph on plain tensors, with the GCN encodings of all the POIs embedded.
+       The padding of the sequences is masked and the mean is over each sequence, see GeoGraph.forward
+       per_sample, so the output of a sample does not depend on the other samples of the batch.
+
+    Args:
+        geo (GeoGraph): Trained geographical encoder.
+        poi_enc (torch.Tensor): Output of GeoGraph.encode, size (n_poi, embed_dim).
+
+    Input:
+        x (torch.Tensor): POI of each node of the sequence graphs, size (num_nodes,).
+        graph_indicator (torch.Tensor): Sample of each node, the nodes of a sample are contiguous.
+        poi (torch.Tensor): Target POI of each sample, size (n_graphs,).
+
+    Output:
+        aggr_feat (torch.Tensor): Geographical embeddings e_g, size (n_graphs, embed_dim).
+        tar_embed (torch.Tensor): Target encodings h_t, size (n_graphs, embed_dim).
+    '''
+
+    def __init__(self, geo, poi_enc):
+        super(GeoKernel, self).__init__()
+        self.register_buffer('poi_enc', poi_enc.detach().clone())
+        self.multihead_attn = copy.deepcopy(geo.selfAttn.multihead_attn)
+
+    def forward(self, x, graph_indicator, poi):
+        n_graphs = poi.size(0)
+        enc = self.poi_enc[x]
+
+        # pad the sequences with zeros, as SelfAttn, and mask the padding
+        seq_len = torch.bincount(graph_indicator, minlength=n_graphs)
+        offsets = torch.cumsum(seq_len, dim=0) - seq_len
+        pos = torch.arange(x.size(0)) - offsets[graph_indicator]
+        max_len = int(seq_len.max())
+        padded = torch.zeros(n_graphs, max_len, enc.size(1), dtype=enc.dtype)
+        padded[graph_indicator, pos] = enc
+        padding = torch.arange(max_len) >= seq_len.unsqueeze(1)
+
+        attn_output, _ = self.multihead_attn(padded, padded, padded, key_padding_mask=padding)
+        aggr_feat = (attn_output * (~padding).unsqueeze(-1)).sum(dim=1) / seq_len.unsqueeze(1)
+        return aggr_feat, self.poi_enc[poi]
+
+
+class ExportedKBGNN(nn.Module):
+    '''Self-contained inference KBGNN: the POI embeddings, the GeoGraph encodings of all the POIs and
+       the hidden graph features of SeqGraph are buffers, so it needs neither the distance graph nor PyG.
+
+    Args:
+        model (KBGNN): Trained full model, see model.load_model.
+        history (HistoryPolicy): History policy of the training run, kept as the history_last and
+            history_unique attributes for batch_inputs.
+
+    Input:
+        x (torch.Tensor): POI of each node of the sequence graphs, size (num_nodes,).
+        edge_index (torch.Tensor): Edges of the sequence graphs, size (2, num_edges).
+        graph_indicator (torch.Tensor): Sample of each node, size (num_nodes,).
+        poi (torch.Tensor): Target POI of each sample, size (batch_size,).
+
+    Output:
+        torch.Tensor: Probability of visiting the target POI, size (batch_size,).
+    '''
+
+    def __init__(self, model, history=None):
+        super(ExportedKBGNN, self).__init__()
+        history = history or HistoryPolicy()
+        self.history_last, self.history_unique = history.last, history.unique
+        if not (model.use_seq and model.use_geo):
+            raise ValueError('Only the full model can be exported.')
+        with torch.no_grad():
+            self.register_buffer('poi_embeds', model.poi_embeds.weight.detach().clone())
+            poi_enc = model.encode_pois()
+        self.seq = SeqKernel(model.seq_encoder)
+        self.geo = GeoKernel(model.geo_encoder, poi_enc)
+        self.predictor = copy.deepcopy(model.predictor)
+        self.eval()
+
+    def forward(self, x, edge_index, graph_indicator, poi):
+        e_s = self.seq(self.poi_embeds[x], edge_index, graph_indicator, poi.size(0))
+        e_g, h_t = self.geo(x, graph_indicator, poi)
+        return torch.sigmoid(self.predictor(e_g, e_s, h_t)).squeeze(-1)
+
+
+def batch_inputs(samples, history=None):
+    '''The inputs of ExportedKBGNN for (poi, history) samples, the histories bounded by the HistoryPolicy.'''
+    batch = make_batch([(0, poi, seq, (0., 0.), 0) for poi, seq in samples], history=history)
+    return batch.x.view(-1), batch.edge_index, batch.batch, batch.poi
+
+
+def export_model(ckpt_path, dist_edges, dist_vec, out_path, format='torchscript'):
+    '''Export a checkpoint as TorchScript or ONNX.
+
+    Args:
+        ckpt_path (str): Checkpoint written by main.py --ckpt.
+        dist_edges (torch.Tensor): Edges of the distance graph, size (2, num_edges).
+        dist_vec (np.ndarray): Distance of the edges, size (num_edges,).
+        out_path (str): Path of the exported model.
+        format (str): 'torchscript' or 'onnx'.
+
+    Returns:
+        tuple: (model, exported), the eager KBGNN and the ExportedKBGNN.
+    '''
+    ckpt = load_checkpoint(ckpt_path)
+    model = load_model(ckpt, dist_edges, dist_vec)
+    exported = ExportedKBGNN(model, HistoryPolicy.from_arg(ckpt['args']))
+    scripted = torch.jit.script(exported)
+    if format == 'torchscript':
+        scripted.save(out_path)
+    elif format == 'onnx':
+        # torch.onnx needs the onnx package. The scripted module is exported, so that the padded length
+        # of the attention stays dynamic.
+        inputs = batch_inputs([(0, [0, 1, 0]), (1, [1])])
+        torch.onnx.export(
+            scripted, inputs, out_path, dynamo=False, opset_version=17,
+            input_names=['x', 'edge_index', 'graph_indicator', 'poi'], output_names=['prob'],
+            dynamic_axes={'x': [0], 'edge_index': [1], 'graph_indicator': [0], 'poi': [0], 'prob': [0]})
+        # the scoring server checks the POI ids of the requests against n_poi and bounds their histories
+        import onnx
+        proto = onnx.load(out_path)
+        proto.metadata_props.add(key='n_poi', value=str(exported.poi_embeds.size(0)))
+        proto.metadata_props.add(key='history_last', value=str(exported.history_last))
+        proto.metadata_props.add(key='history_unique', value=str(exported.history_unique))
+        onnx.save(proto, out_path)
+    else:
+        raise ValueError(f'Unknown export format: {format}')
+    return model, exported
+
+
+if __name__ == '__main__':
+    ARG = argparse.ArgumentParser(
+        description='Export a checkpoint as a self-contained TorchScript or ONNX model for scoring_server.py.')
+    ARG.add_argument('--ckpt', type=str, required=True,
+                     help='Checkpoint written by main.py --ckpt.')
+    ARG.add_argument('--data', type=str, default='nyc',
+                     help='Dataset of the checkpoint. nyc or tky.')
+    ARG.add_argument('--out', type=str, required=True,
+                     help='Path of the exported model.')
+    ARG.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'],
+                     help='Format of the exported model.')
+    ARG.add_argument('--check', type=int, default=1000,
+                     help='Num of validation samples on which the exported model is compared with the checkpoint, '
+                          'and its batched output with that of each sample alone.')
+    ARG = ARG.parse_args()
+
+    dist_edges, dist_vec = load_dist_graph(f'./processed_data/{ARG.data}')
+    model, exported = export_model(ARG.ckpt, dist_edges, dist_vec, ARG.out, ARG.format)
+    print(f'Model exported to {ARG.out}')
+
+    if ARG.check > 0:
+        if ARG.format == 'torchscript':
+            exported = torch.jit.load(ARG.out)
+        with open(f'./processed_data/{ARG.data}/raw/val.pkl', 'rb') as f:
+            samples = pickle.load(f)[:ARG.check]
+        history = HistoryPolicy(exported.history_last, exported.history_unique)
+        with torch.no_grad():
+            expected = torch.sigmoid(model(make_batch(samples, history=history), per_sample=True)).squeeze(-1)
+            prob = exported(*batch_inputs([(poi, seq) for _, poi, seq, _, _ in samples], history))
+            alone = torch.cat([exported(*batch_inputs([(poi, seq)], history)) for _, poi, seq, _, _ in samples])
+        print(f'Max abs difference with the checkpoint on {len(samples)} samples: '
+              f'{(prob - expected).abs().max().item():.3g}')
+        print(f'Max abs difference between the batch and each sample alone: {(prob - alone).abs().max().item():.3g}')
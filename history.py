@@ -0,0 +1,76 @@
+class HistoryPolicy:
+    '''Bound the history of a sample to its most recent check-ins.
+
+    A history keeps its last `last` check-ins, its check-ins since the `unique`-th most recent distinct
+    POI, and its check-ins of the last `window` hours before the target; the tightest bound wins and
+    0 disables a bound. The most recent check-in is always kept, so a history is never empty. The window
+    needs the time of the check-ins, which only preprocess.py has: the samples and the serving requests
+    carry none, so the window is applied there and ignored elsewhere.
+
+    Args:
+        last (int): Max num of check-ins.
+        unique (int): Max num of distinct POIs.
+        window (float): Max age of the check-ins in hours.
+
+    Input:
+        list: POIs of the history, oldest first.
+        list: Time of each check-in in seconds, optional.
+        float: Time of the target in seconds, optional.
+
+    Output:
+        list: The most recent part of the history.
+    '''
+
+    def __init__(self, last=0, unique=0, window=0.):
+        self.last = int(last)
+        self.unique = int(unique)
+        self.window = float(window)
+
+    @classmethod
+    def from_arg(cls, arg):
+        '''The policy of the --history_last and --history_unique arguments of a run, e.g. of a checkpoint.'''
+        return cls(getattr(arg, 'history_last', 0), getattr(arg, 'history_unique', 0))
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get('last', 0), d.get('unique', 0), d.get('window', 0.))
+
+    def to_dict(self):
+        return {'last': self.last, 'unique': self.unique, 'window': self.window}
+
+    def tightest(self, other):
+        '''The policy with the tightest of the bounds of both.'''
+        def bound(a, b):
+            return min(a, b) if a > 0 and b > 0 else max(a, b)
+        return HistoryPolicy(bound(self.last, other.last), bound(self.unique, other.unique),
+                             bound(self.window, other.window))
+
+    def __bool__(self):
+        return self.last > 0 or self.unique > 0 or self.window > 0
+
+    def __repr__(self):
+        return f'HistoryPolicy(last={self.last}, unique={self.unique}, window={self.window:g})'
+
+    def tag(self):
+        '''Suffix of the files built with the policy, empty for the full histories.'''
+        return ''.join(f'_{name}{value:g}' for name, value in self.to_dict().items() if value > 0)
+
+    def __call__(self, seq, times=None, now=None):
+        if not self or len(seq) <= 1:
+            return seq
+        start = 0
+        if self.last > 0:
+            start = max(start, len(seq) - self.last)
+        if self.unique > 0:
+            seen = set()
+            i = len(seq)
+            while i > start and (seq[i - 1] in seen or len(seen) < self.unique):
+                seen.add(seq[i - 1])
+                i -= 1
+            start = i
+        if self.window > 0 and times is not None:
+            i = len(seq)
+            while i > start and now - times[i - 1] <= self.window * 3600:
+                i -= 1
+            start = i
+        return seq[min(start, len(seq) - 1):]
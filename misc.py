@@ -1,3 +1,4 @@
+import math
 import torch
 import torch.nn as nn
 
@@ -24,8 +25,147 @@ class EmbeddingLayer(nn.Module):
     def forward(self, idx):
         return self.embeds(idx)
 
+    @property
+    def weight(self):
+        return self.embeds.weight
 
-class MLP(nn.Module):
+
+class QREmbeddingLayer(nn.Module):
+    '''Compositional (quotient-remainder) embedding layer for POI.
+       Each POI is embedded as the element-wise product (or sum) of a row of a
+       quotient table and a row of a remainder table, so only
+       ceil(n_poi / n_buckets) + n_buckets rows are stored.
+
+    Args:
+        n_poi (int): Number of POI.
+        embed_dim (int): Embedding dimension.
+        n_buckets (int): Number of rows in the remainder table.
+        combine (str): How to combine the two parts, 'mult' or 'add'.
+
+    Input:
+        torch.Tensor: Index of POI.
+
+    Output:
+        torch.Tensor: Embedding vector of POI.
+    '''
+
+    def __init__(self, n_poi, embed_dim, n_buckets, combine='mult'):
+        super(QREmbeddingLayer, self).__init__()
+        if combine not in ('mult', 'add'):
+            raise ValueError(f'Unknown combine operation: {combine}')
+        self.n_poi = n_poi
+        self.n_buckets = n_buckets
+        self.combine = combine
+
+        self.quotient = nn.Embedding(math.ceil(n_poi / n_buckets), embed_dim)
+        self.remainder = nn.Embedding(n_buckets, embed_dim)
+        nn.init.xavier_normal_(self.quotient.weight)
+        if combine == 'mult':
+            # start close to the quotient embedding, the noise breaks the tie between POIs sharing a quotient
+            nn.init.normal_(self.remainder.weight, mean=1., std=0.1)
+        else:
+            nn.init.xavier_normal_(self.remainder.weight)
+
+    def forward(self, idx):
+        q_embed = self.quotient(torch.div(idx, self.n_buckets, rounding_mode='floor'))
+        r_embed = self.remainder(torch.remainder(idx, self.n_buckets))
+        if self.combine == 'mult':
+            return q_embed * r_embed
+        return q_embed + r_embed
+
+    @property
+    def weight(self):
+        return self(torch.arange(self.n_poi, device=self.quotient.weight.device))
+
+
+class QuantizedEmbeddingLayer(nn.Module):
+    '''Inference-only embedding layer for POI with int8 or fp16 storage.
+       int8 tables are quantised symmetrically with one fp32 scale per row.
+       Rows are dequantised to fp32 on lookup.
+
+    Args:
+        weight (torch.Tensor): Full-precision embedding table, size (n_poi, embed_dim).
+        dtype (str): Storage type, 'int8' or 'fp16'.
+
+    Input:
+        torch.Tensor: Index of POI.
+
+    Output:
+        torch.Tensor: Embedding vector of POI.
+    '''
+
+    def __init__(self, weight, dtype='int8'):
+        super(QuantizedEmbeddingLayer, self).__init__()
+        weight = weight.detach().float()
+        self.dtype = dtype
+        if dtype == 'int8':
+            scale = weight.abs().amax(dim=1).clamp(min=1e-12) / 127.
+            qweight = torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+        elif dtype == 'fp16':
+            # fp16 tables do not need a scale, keep an empty buffer so the state dict layout is fixed
+            scale = torch.empty(0)
+            qweight = weight.half()
+        else:
+            raise ValueError(f'Unknown quantised dtype: {dtype}')
+        self.register_buffer('qweight', qweight)
+        self.register_buffer('scale', scale)
+
+    @classmethod
+    def from_float(cls, layer, dtype='int8'):
+        return cls(layer.weight, dtype)
+
+    def forward(self, idx):
+        rows = self.qweight[idx].float()
+        if self.dtype == 'int8':
+            rows = rows * self.scale[idx].unsqueeze(-1)
+        return rows
+
+    @property
+    def weight(self):
+        if self.dtype == 'int8':
+            return self.qweight.float() * self.scale.unsqueeze(-1)
+        return self.qweight.float()
+
+
+def autocast(precision, device):
+    '''Autocast to bfloat16 for --precision bf16, a disabled context for fp32.'''
+    return torch.autocast(torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+def fp32(tensor):
+    '''Context that runs in fp32 within an autocast region, for the numerically sensitive ops.
+       The inputs still need a cast with .float().'''
+    return torch.autocast(tensor.device.type, enabled=False)
+
+
+def module_nbytes(module):
+    '''Number of bytes held by the parameters and buffers of a module.'''
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class SplitPredictor:
+    '''Split of the first Linear layer of a predictor by input block, so that for ranking the user part
+       (the user embeddings) and the target part (h_t) are computed once and combined by broadcasting:
+       score(user_part(*user_embeds), target_part(h_t)) == forward(*user_embeds, h_t).
+       The predictor is an nn.Sequential of Linear, LeakyReLU, Linear with h_t as the last input block.
+    '''
+
+    def user_part(self, *user_embeds):
+        weight, bias = self.predictor[0].weight, self.predictor[0].bias
+        d = self.embed_dim
+        return sum(e @ weight[:, i * d:(i + 1) * d].t() for i, e in enumerate(user_embeds)) + bias
+
+    def target_part(self, h_t):
+        weight = self.predictor[0].weight
+        return h_t @ weight[:, -self.embed_dim:].t()
+
+    def score(self, user_part, target_part):
+        hidden = self.predictor[1](user_part + target_part)
+        return self.predictor[2](hidden)
+
+
+class MLP(SplitPredictor, nn.Module):
     '''MLP for predicting the probability of visiting a POI.
 
     Args:
@@ -57,7 +197,7 @@ class MLP(nn.Module):
         return pred_logits
 
 
-class MLP2(nn.Module):
+class MLP2(SplitPredictor, nn.Module):
     '''MLP for predicting the probability of visiting a POI.
        only use one embedding and target geographical representation.
 
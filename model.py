@@ -0,0 +1,165 @@
+import argparse
+import torch
+import torch.nn as nn
+from GeoGraph import GeoGraph
+from SeqGraph import SeqGraph
+from misc import EmbeddingLayer, QREmbeddingLayer, MLP, MLP2
+
+
+# components of the full model and of the ablation studies
+VARIANTS = {
+    'full': dict(use_seq=True, use_geo=True, use_con=True),
+    'geo': dict(use_seq=False, use_geo=True, use_con=False),
+    'seq': dict(use_seq=True, use_geo=False, use_con=False),
+}
+
+
+def build_encoders(arg, n_poi, dist_edges, dist_vec, device):
+    '''Build the sequential encoder, geographical encoder and predictor.
+
+    Args:
+        arg (argparse.Namespace): Hyperparameters, see trainer.py.
+        n_poi (int): Number of POI.
+        dist_edges (torch.Tensor): Edges of the distance graph, size (2, num_edges), or None for serving.
+        dist_vec (np.ndarray): Distance of the edges, size (num_edges,), or None for serving.
+        device (torch.device): Device of the modules.
+
+    Returns:
+        tuple: (Seq_encoder, Geo_encoder, Predictor)
+    '''
+    Seq_encoder = SeqGraph(arg.max_step, arg.embed,
+                           arg.hid_graph_num, arg.hid_graph_size).to(device)
+    Geo_encoder = GeoGraph(n_poi, arg.gcn_num,
+                           arg.embed, dist_edges, dist_vec, arg.num_heads).to(device)
+    Predictor = MLP(arg.embed).to(device)
+
+    return Seq_encoder, Geo_encoder, Predictor
+
+
+def build_poi_embeds(arg, n_poi, device):
+    '''Build the POI embedding table selected by --poi_embed.'''
+    if getattr(arg, 'poi_embed', 'dense') == 'qr':
+        return QREmbeddingLayer(n_poi, arg.embed, arg.qr_buckets).to(device)
+    return EmbeddingLayer(n_poi, arg.embed).to(device)
+
+
+class KBGNN(nn.Module):
+    """
+    KBGNN model, or one of its ablations.
+
+    The geographical encoder always provides the target representation h_t. The user is represented
+    by the geographical embedding e_g (use_geo), the sequential embedding e_s (use_seq) or both.
+    MLP is the predictor when both are used and MLP2 otherwise.
+
+    Args:
+        arg (argparse.Namespace): Hyperparameters, see trainer.py.
+        n_poi (int): Number of POI.
+        dist_edges (torch.Tensor): Edges of the distance graph, size (2, num_edges).
+        dist_vec (np.ndarray): Distance of the edges, size (num_edges,).
+        use_seq (bool): Use the sequential embedding.
+        use_geo (bool): Use the geographical embedding.
+
+    """
+
+    def __init__(self, arg, n_poi, dist_edges, dist_vec, use_seq=True, use_geo=True):
+        super(KBGNN, self).__init__()
+        self.use_seq = use_seq
+        self.use_geo = use_geo
+
+        self.seq_encoder = None
+        if use_seq:
+            self.seq_encoder = SeqGraph(arg.max_step, arg.embed, arg.hid_graph_num, arg.hid_graph_size)
+        self.geo_encoder = GeoGraph(n_poi, arg.gcn_num, arg.embed, dist_edges, dist_vec, arg.num_heads,
+                                    getattr(arg, 'checkpoint_gcn', False))
+        self.poi_embeds = build_poi_embeds(arg, n_poi, 'cpu')
+        self.predictor = MLP(arg.embed) if use_seq and use_geo else MLP2(arg.embed)
+
+    def encode_pois(self):
+        '''GeoGraph encodings of all the POIs, shared by the batches of one step.'''
+        return self.geo_encoder.encode(self.poi_embeds)
+
+    def user_embeds(self, batch, poi_enc, per_sample=False):
+        '''The user representations fed to the predictor, in order, and the target representation.
+           See GeoGraph.forward for per_sample.'''
+        e_g, h_t = self.geo_encoder(batch, self.poi_embeds, poi_enc=poi_enc, per_sample=per_sample)
+        embeds = []
+        if self.use_geo:
+            embeds.append(e_g)
+        if self.use_seq:
+            embeds.append(self.seq_encoder(batch, self.poi_embeds))
+        return embeds, h_t
+
+    def forward(self, batch, poi_enc=None, per_sample=False):
+        '''Logits of visiting the target POI of each sample, size (batch_size, 1).'''
+        if poi_enc is None:
+            poi_enc = self.encode_pois()
+        embeds, h_t = self.user_embeds(batch, poi_enc, per_sample)
+        return self.predictor(*embeds, h_t)
+
+    # Static-shape mode: the inputs are padded to bucketed shapes by dataset.static_inputs, so that
+    # torch.compile builds one graph per bucket. The outputs have a row per padded sample.
+
+    def user_embeds_static(self, data, poi_enc):
+        e_g, h_t = self.geo_encoder.forward_static(data, poi_enc)
+        embeds = []
+        if self.use_geo:
+            embeds.append(e_g)
+        if self.use_seq:
+            embeds.append(self.seq_encoder.forward_static(data, self.poi_embeds))
+        return embeds, h_t
+
+    def forward_static(self, data, poi_enc):
+        embeds, h_t = self.user_embeds_static(data, poi_enc)
+        return self.predictor(*embeds, h_t)
+
+    def bank_embeds_static(self, data, poi_enc):
+        '''The sequential and geographical embeddings of the consistency loss.'''
+        e_g, _ = self.geo_encoder.forward_static(data, poi_enc)
+        return self.seq_encoder.forward_static(data, self.poi_embeds), e_g
+
+
+def save_checkpoint(path, arg, n_poi, model):
+    '''Save the hyperparameters and the weights of a KBGNN model.'''
+    ckpt = {
+        'args': vars(arg),
+        'n_poi': n_poi,
+        'use_seq': model.use_seq,
+        'use_geo': model.use_geo,
+        'geo_encoder': model.geo_encoder.state_dict(),
+        'poi_embeds': model.poi_embeds.state_dict(),
+        'predictor': model.predictor.state_dict(),
+    }
+    if model.use_seq:
+        ckpt['seq_encoder'] = model.seq_encoder.state_dict()
+    torch.save(ckpt, path)
+
+
+def load_checkpoint(path, map_location='cpu'):
+    '''Load a checkpoint written by save_checkpoint, the hyperparameters are returned as a Namespace.'''
+    ckpt = torch.load(path, map_location=map_location)
+    ckpt['args'] = argparse.Namespace(**ckpt['args'])
+    return ckpt
+
+
+def load_model(ckpt, dist_edges, dist_vec, device='cpu'):
+    '''Rebuild the KBGNN model of a checkpoint loaded by load_checkpoint, in eval mode.'''
+    model = KBGNN(ckpt['args'], ckpt['n_poi'], dist_edges, dist_vec,
+                  ckpt.get('use_seq', True), ckpt.get('use_geo', True))
+    model.geo_encoder.load_state_dict(ckpt['geo_encoder'])
+    model.poi_embeds.load_state_dict(ckpt['poi_embeds'])
+    model.predictor.load_state_dict(ckpt['predictor'])
+    if model.use_seq:
+        model.seq_encoder.load_state_dict(ckpt['seq_encoder'])
+    return model.to(device).eval()
+
+
+def load_modules(ckpt, dist_edges, dist_vec, device='cpu'):
+    '''Rebuild the modules of a full-model checkpoint loaded by load_checkpoint, in eval mode.
+
+    Returns:
+        tuple: (Seq_encoder, Geo_encoder, Poi_embeds, Predictor)
+    '''
+    model = load_model(ckpt, dist_edges, dist_vec, device)
+    if not (model.use_seq and model.use_geo):
+        raise ValueError('Only checkpoints of the full model can be split into modules.')
+    return model.seq_encoder, model.geo_encoder, model.poi_embeds, model.predictor
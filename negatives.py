@@ -0,0 +1,131 @@
+import numpy as np
+
+
+class AliasTable:
+    '''Walker's alias table, draws from a discrete distribution in O(1) per sample.
+
+    Args:
+        weights (np.ndarray): Non-negative weight of each outcome, size (n,).
+    '''
+
+    def __init__(self, weights):
+        p = np.asarray(weights, dtype=np.float64)
+        n = len(p)
+        p = p * n / p.sum()
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = list(np.nonzero(p < 1)[0])
+        large = list(np.nonzero(p >= 1)[0])
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = p[s], l
+            # the excess of l fills the bucket of s
+            p[l] += p[s] - 1
+            (small if p[l] < 1 else large).append(l)
+        # the buckets left over are full up to rounding errors
+
+    def sample(self, n, rng):
+        i = rng.integers(0, len(self.prob), n)
+        return np.where(rng.random(n) < self.prob[i], i, self.alias[i])
+
+
+class NegativeSampler:
+    '''Vectorized sampler of negative POIs, POIs that a user never visits.
+
+    Candidates are drawn for all the pending negatives at once and the visited ones are rejected by a
+    binary search in the sorted (user, POI) keys of the check-ins; only the rejected ones are drawn again.
+    A candidate is drawn uniformly, or proportionally to the num of check-ins of the POI with popularity
+    (from an alias table). With hard > 0, each negative is with probability hard a neighbor of its anchor
+    (the positive POI) in the distance graph instead; the neighbors are drawn for a few rounds, after
+    which the negatives still rejected fall back to the other candidates.
+
+    Args:
+        num_poi (int): Number of POI.
+        user_seqs (dict): The POIs that each user visits.
+        popularity (bool): Draw the candidates by popularity instead of uniformly.
+        dist_edges (np.ndarray): Edges of the distance graph, size (2, num_edges), needed by hard.
+        hard (float): Share of the negatives drawn among the neighbors of their anchor.
+        rng (np.random.Generator): Random generator.
+    '''
+
+    # rounds of hard negatives before the fall back
+    HARD_ROUNDS = 4
+    MAX_ROUNDS = 1000
+
+    def __init__(self, num_poi, user_seqs, popularity=False, dist_edges=None, hard=0., rng=None):
+        self.num_poi = num_poi
+        self.rng = np.random.default_rng() if rng is None else rng
+        uids = np.array(list(user_seqs), dtype=np.int64)
+        lens = np.array([len(user_seqs[uid]) for uid in uids], dtype=np.int64)
+        pois = np.concatenate([np.asarray(user_seqs[uid], dtype=np.int64) for uid in uids])
+        self.keys = np.unique(np.repeat(uids, lens) * num_poi + pois)
+
+        self.alias = None
+        if popularity:
+            self.alias = AliasTable(np.bincount(pois, minlength=num_poi))
+
+        self.hard = hard
+        if hard > 0:
+            if dist_edges is None:
+                raise ValueError('Hard negatives need the distance graph.')
+            # both directions of the edges, grouped by source
+            src = np.concatenate((dist_edges[0], dist_edges[1])).astype(np.int64)
+            dst = np.concatenate((dist_edges[1], dist_edges[0])).astype(np.int64)
+            order = np.argsort(src, kind='stable')
+            self.neighbors = dst[order]
+            self.degree = np.bincount(src, minlength=num_poi)
+            self.indptr = np.concatenate(([0], np.cumsum(self.degree)))
+
+    def visited(self, uid, poi):
+        '''Whether each user visits each POI.'''
+        keys = uid * self.num_poi + poi
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[pos] == keys
+
+    def _candidates(self, n, uniform):
+        if self.alias is None or uniform:
+            return self.rng.integers(0, self.num_poi, n)
+        return self.alias.sample(n, self.rng)
+
+    def sample(self, uid, k=1, anchor=None, uniform=False):
+        '''Draw k negatives for each user of uid.
+
+        Args:
+            uid (np.ndarray): Users, size (n,).
+            k (int): Num of negatives per user.
+            anchor (np.ndarray): POI whose neighbors are the hard negatives of each user, size (n,).
+            uniform (bool): Draw uniformly, without popularity nor hard negatives.
+
+        Returns:
+            np.ndarray: The negatives, size (n, k).
+        '''
+        uid = np.repeat(np.asarray(uid, dtype=np.int64), k)
+        n = len(uid)
+        hard = np.zeros(n, dtype=bool)
+        if anchor is not None and self.hard > 0 and not uniform:
+            anchor = np.repeat(np.asarray(anchor, dtype=np.int64), k)
+            hard = (self.rng.random(n) < self.hard) & (self.degree[anchor] > 0)
+
+        out = np.empty(n, dtype=np.int64)
+        todo = np.arange(n)
+        for r in range(self.MAX_ROUNDS):
+            if len(todo) == 0:
+                break
+            if r == self.HARD_ROUNDS:
+                hard[:] = False
+            is_hard = hard[todo]
+            cand = np.empty(len(todo), dtype=np.int64)
+            cand[~is_hard] = self._candidates(int((~is_hard).sum()), uniform)
+            if is_hard.any():
+                a = anchor[todo[is_hard]]
+                offset = (self.rng.random(len(a)) * self.degree[a]).astype(np.int64)
+                cand[is_hard] = self.neighbors[self.indptr[a] + offset]
+
+            rejected = self.visited(uid[todo], cand)
+            out[todo[~rejected]] = cand[~rejected]
+            todo = todo[rejected]
+
+        if len(todo) > 0:
+            raise ValueError(f'No negative found for {len(todo)} samples in {self.MAX_ROUNDS} rounds, '
+                             'their users visit (nearly) all the POIs.')
+        return out.reshape(-1, k)
@@ -1,10 +1,19 @@
+import argparse
 import pandas as pd
 import numpy as np
 import random
 import pickle as pkl
-from tqdm import tqdm
 import os
+import json
+import glob
 from math import cos, asin, sqrt, pi
+from sklearn.neighbors import BallTree
+from history import HistoryPolicy
+from negatives import NegativeSampler
+
+
+# radius of the earth in km
+EARTH_RADIUS = 6371
 
 
 def distance(lat1, lon1, lat2, lon2):
@@ -17,8 +26,7 @@ def distance(lat1, lon1, lat2, lon2):
     Returns:
         The distance between two points in kilometers
     '''
-    # radius of the earth in km
-    r = 6371
+    r = EARTH_RADIUS
     # convert factor from degree to radian
     p = pi / 180
     # calculate the haversine theta according to the formula
@@ -27,139 +35,541 @@ def distance(lat1, lon1, lat2, lon2):
     return 2 * r * asin(sqrt(hav_theta))
 
 
-# src_path = './dataset_tsmc2014/dataset_TSMC2014_TKY.txt'
-src_path = './dataset_tsmc2014/dataset_TSMC2014_NYC.txt'
-# dst_path = './processed_data/tky/raw/'
-dst_path = './processed_data/nyc/raw/'
-
-# create the destination directory if not exist
-os.makedirs(dst_path, exist_ok=True)
-
-# set random seed
-random.seed(42)
+ARG = argparse.ArgumentParser()
+ARG.add_argument('--src', type=str, default='./dataset_tsmc2014/dataset_TSMC2014_NYC.txt',
+                 help='Check-in file in the TSMC2014 format, e.g. ./dataset_tsmc2014/dataset_TSMC2014_TKY.txt')
+ARG.add_argument('--dst', type=str, default='./processed_data/nyc/raw/',
+                 help='Output directory, e.g. ./processed_data/tky/raw/')
+ARG.add_argument('--threshold', type=float, default=0.5,
+                 help='POIs closer than this distance in km are neighbors.')
+ARG.add_argument('--graph', type=str, default='radius', choices=['radius', 'knn', 'adaptive'],
+                 help='Neighborhood graph. radius: all the POIs within --threshold. '
+                      'knn: the --k nearest POIs within --threshold of each POI. '
+                      'adaptive: the POIs within the radius of both ends, the radius of a POI is the distance '
+                      'to its --k-th nearest POI, at most --threshold.')
+ARG.add_argument('--k', type=int, default=10,
+                 help='Num of nearest neighbors of the knn and adaptive graphs.')
+ARG.add_argument('--max_degree', type=int, default=None,
+                 help='Max num of neighbors of a POI, the nearest are kept. 0 does not cap the degree. '
+                      'Defaults to --k with --graph knn, whose links are symmetric, so a POI is also linked to '
+                      'the POIs it is among the --k nearest of and can have more than --k neighbors otherwise. '
+                      'Defaults to 0 with the other graphs.')
+ARG.add_argument('--negatives', type=int, default=1,
+                 help='Num of negative training samples per positive one. The evaluation sets have one.')
+ARG.add_argument('--neg_sampler', type=str, default='uniform', choices=['uniform', 'popularity'],
+                 help='Distribution of the negative training POIs, uniform or by num of check-ins. '
+                      'The negatives of the evaluation sets are uniform.')
+ARG.add_argument('--hard_negatives', type=float, default=0.,
+                 help='Share of the negative training POIs drawn among the neighbors of the positive POI '
+                      'in the neighborhood graph.')
+ARG.add_argument('--history_last', type=int, default=0,
+                 help='Max num of check-ins in the history of a sample, the most recent are kept. 0 keeps them all.')
+ARG.add_argument('--history_unique', type=int, default=0,
+                 help='Max num of distinct POIs in the history of a sample, the most recent are kept. '
+                      '0 keeps them all.')
+ARG.add_argument('--history_window', type=float, default=0.,
+                 help='Max age in hours of the check-ins in the history of a sample, relative to its target. '
+                      '0 keeps them all.')
+ARG.add_argument('--seed', type=int, default=42,
+                 help='Random seed.')
+ARG.add_argument('--incremental', action='store_true',
+                 help='Add the check-ins of --src to the data already preprocessed in --dst, see update().')
+
+# negative settings of the data preprocessed before they were saved in state.pkl
+DEFAULT_NEGATIVES = {'k': 1, 'sampler': 'uniform', 'hard': 0.}
 
 # the columns of the dataset
 col_names = ['uid', 'poi', 'cat_id', 'cat_name',
              'latitude', 'longitude', 'offset', 'time']
 
-print('Reading data...')
 
-# read the data
-data = pd.read_csv(src_path, sep='\t', header=None,
-                   names=col_names, encoding='unicode_escape')
+def read_checkins(src_path, uid_map=None, poi_map=None):
+    '''Read the check-ins and map the users and POIs to continuous indices. Users and POIs missing
+       from the given maps are added to them with the next indices, in order of first appearance.
+
+    Returns:
+        data (pd.DataFrame): Columns uid, poi, latitude, longitude and time (in seconds), in the order of the file.
+        uid_map, poi_map (dict): Index of each user and POI id.
+    '''
+    # read the data
+    data = pd.read_csv(src_path, sep='\t', header=None,
+                       names=col_names, encoding='unicode_escape')
+
+    # remove the columns that are not needed
+    data.drop(['cat_id', 'cat_name', 'offset'], axis=1, inplace=True)
+    # the times are in UTC
+    time = pd.to_datetime(data['time'], format='%a %b %d %H:%M:%S %z %Y')
+    data['time'] = (time - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+
+    # map the user and POI to a continuous index
+    uid_map = {} if uid_map is None else uid_map
+    poi_map = {} if poi_map is None else poi_map
+    for col, mapping in (('uid', uid_map), ('poi', poi_map)):
+        for key in pd.unique(data[col]):
+            if key not in mapping:
+                mapping[key] = len(mapping)
+    data['uid'] = data['uid'].map(uid_map)
+    data['poi'] = data['poi'].map(poi_map)
 
-# remove the columns that are not needed
-data.drop(['cat_id', 'cat_name', 'offset', 'time'], axis=1, inplace=True)
+    # count the number of users and POIs
+    print("#Users: {}".format(len(uid_map)))
+    print("#POIs: {}".format(len(poi_map)))
 
-# count the number of users and POIs
-num_user = pd.unique(data['uid']).shape[0]
-num_poi = pd.unique(data['poi']).shape[0]
-print("#Users: {}".format(num_user))
-print("#POIs: {}".format(num_poi))
+    return data, uid_map, poi_map
 
-# map the user and POI to a continuous index
-uid_map = dict(zip(pd.unique(data['uid']), range(num_user)))
-poi_map = dict(zip(pd.unique(data['poi']), range(num_poi)))
-data['uid'] = data['uid'].map(uid_map)
-data['poi'] = data['poi'].map(poi_map)
 
-print('Finish reading data.')
+def poi_coords(data, num_poi, coords=None):
+    '''The (latitude, longitude) of each POI, from its first check-in. The POIs of coords keep theirs.'''
+    old = {} if coords is None else coords
+    coords = {poi: old.get(poi) for poi in range(num_poi)}
+    for poi, item in data[data['poi'] >= len(old)].groupby('poi'):
+        lat, lon = item['latitude'].iloc[0], item['longitude'].iloc[0]
+        coords[poi] = (lat, lon)
+    return coords
 
-print('Generating dataset...')
 
-sum_seqlen=0
+def user_sequences(data, col='poi'):
+    '''The sequence of POIs (or of another column, e.g. time) of each user, in the order of the file.'''
+    return data.groupby('uid', sort=True)[col].apply(list).to_dict()
 
-# the coordinates of each POI
-coords = {poi: None for poi in range(num_poi)}
-for poi, item in data.groupby('poi'):
-    lat, lon = item['latitude'].iloc[0], item['longitude'].iloc[0]
-    coords[poi] = (lat, lon)
 
-# generate training, testing and validation set
-train_set, eval_set = [], []
-for uid in range(num_user):
-    # the sequence of POIs that the user visits
-    true_seq = data[data['uid'] == uid]['poi'].tolist()
-    true_seq_set = set(true_seq)
+def train_positions(true_seq, start=0):
+    '''Positions of the check-ins of a user that are positive training samples, from start on.'''
+    return range(max(1, start), len(true_seq) - 1)
 
-    # calculate the sequence length 
-    seqlen=len(true_seq)
-    # calculate the sum of sequence length, this is also the interactions in this sequence
-    sum_seqlen+=seqlen    
 
-    # take only the POIs that the user never visits
-    false_seq = []
-    while len(false_seq) < len(true_seq):
-        poi = random.randint(0, num_poi - 1)
-        if poi not in true_seq_set:
-            false_seq.append(poi)
+def draw_negatives(sampler, user_seqs, uids, starts, k):
+    '''Draw the negatives of the users at once: k for each training position from start on, anchored at
+       the positive POI for hard negatives, and one uniform negative for the last check-in.
+
+    Returns:
+        tuple: (train_negatives, eval_negatives), for each user an array of size (num_positions, k)
+               and a POI.
+    '''
+    positions = [train_positions(user_seqs[uid], start) for uid, start in zip(uids, starts)]
+    counts = [len(pos) for pos in positions]
+    anchors = [user_seqs[uid][i] for uid, pos in zip(uids, positions) for i in pos]
+    train = sampler.sample(np.repeat(np.asarray(uids, dtype=np.int64), counts), k,
+                           np.array(anchors, dtype=np.int64))
+    evals = sampler.sample(uids, 1, uniform=True)[:, 0]
+    return np.split(train, np.cumsum(counts)[:-1]), evals.tolist()
 
-    for i in range(1, len(true_seq) - 1):
-        train_set.append(
-            (uid, true_seq[i], true_seq[:i], coords[true_seq[i]], 1))
-        train_set.append(
-            (uid, false_seq[i], true_seq[:i], coords[false_seq[i]], 0))
+
+def make_sampler(negatives, user_seqs, num_poi, edges, seed):
+    '''The NegativeSampler of the negative settings (k, sampler, hard) saved in state.pkl.'''
+    return NegativeSampler(num_poi, user_seqs, negatives['sampler'] == 'popularity', edges,
+                           negatives['hard'], np.random.default_rng(seed))
+
+
+def bounded_history(true_seq, i, policy=None, times=None):
+    '''The history of the check-in at position i, bounded by the HistoryPolicy.'''
+    if not policy:
+        return true_seq[:i]
+    if times is None:
+        return policy(true_seq[:i])
+    return policy(true_seq[:i], times[:i], times[i])
+
+
+def user_samples(uid, true_seq, coords, negatives, eval_negative, start=0, policy=None, times=None):
+    '''The samples of the check-ins of a user from position start on: training samples for the check-ins
+       before the last one, and evaluation samples for the last one.
+
+    Args:
+        negatives (np.ndarray): Negatives of each training position, size (num_positions, k).
+        eval_negative (int): Negative of the last check-in.
+        policy (HistoryPolicy): Bound of the histories, None keeps them all.
+        times (list): Time of each check-in, for the window of the policy.
+
+    Returns:
+        tuple: (train_samples, eval_samples), lists of (uid, poi, history, coordinate, label)
+    '''
+    train_samples = []
+    for i, false_pois in zip(train_positions(true_seq, start), negatives.tolist()):
+        history = bounded_history(true_seq, i, policy, times)
+        train_samples.append(
+            (uid, true_seq[i], history, coords[true_seq[i]], 1))
+        for poi in false_pois:
+            train_samples.append((uid, poi, history, coords[poi], 0))
 
     # we use the last POI of a user as the evaluation set
-    eval_set.append(
-        (uid, true_seq[-1], true_seq[:-1], coords[true_seq[-1]], 1))
-    eval_set.append(
-        (uid, false_seq[-1], true_seq[:-1], coords[false_seq[-1]], 0))
-
-print(f'avgSeqLen = {sum_seqlen/num_user}')
-print(f'interactions = {sum_seqlen}')       
-    
-    
-# random shuffle the training and evaluation set
-random.shuffle(train_set)
-random.shuffle(eval_set)
-
-# split the evaluation set into validation and testing set
-sep = len(eval_set) // 2
-val_set = eval_set[:sep]
-test_set = eval_set[sep:]
-
-print(f'#Train: {len(train_set)}')
-print(f'#Validation: {len(val_set)}')
-print(f'#Test: {len(test_set)}')
-
-# save the datasets
-with open(dst_path+'train.pkl', 'wb') as f:
-    pkl.dump(train_set, f, pkl.HIGHEST_PROTOCOL)
-with open(dst_path+'test.pkl', 'wb') as f:
-    pkl.dump(test_set, f, pkl.HIGHEST_PROTOCOL)
-with open(dst_path+'val.pkl', 'wb') as f:
-    pkl.dump(val_set, f, pkl.HIGHEST_PROTOCOL)
-with open(dst_path+'info.pkl', 'wb') as f:
-    pkl.dump((num_user, num_poi), f, pkl.HIGHEST_PROTOCOL)
-
-print('Finish generating dataset.')
-
-print('Generating neighborhood graph...')
-
-# only regard the POIs with distance less or equal than 0.5km as neighbors
-threshold = 0.5
-edges = [[], []]
-
-for i in tqdm(range(num_poi)):
-    for j in range(i + 1, num_poi):
-        lat1, lon1 = coords[i]
-        lat2, lon2 = coords[j]
-        if distance(lat1, lon1, lat2, lon2) <= threshold:
-            edges[0].append(i)
-            edges[1].append(j)
-
-# convert the list to numpy array, size: (2, num_edges)
-edges = np.array(edges)
-
-# save the neighborhood graph
-with open(dst_path+'dist_graph.pkl', 'wb') as f:
-    pkl.dump(edges, f, pkl.HIGHEST_PROTOCOL)
-
-# the distance of each edge, size: (num_edges,)
-dist_on_graph = np.array([distance(coords[edges[0, i]][0], coords[edges[0, i]][1],
-                         coords[edges[1, i]][0], coords[edges[1, i]][1]) for i in range(edges.shape[1])])
-
-np.save(dst_path + 'dist_on_graph.npy', dist_on_graph)
-
-print('Finish generating neighborhood graph.')
+    history = bounded_history(true_seq, len(true_seq) - 1, policy, times)
+    eval_samples = [
+        (uid, true_seq[-1], history, coords[true_seq[-1]], 1),
+        (uid, eval_negative, history, coords[eval_negative], 0),
+    ]
+    return train_samples, eval_samples
+
+
+def generate_samples(user_seqs, num_user, coords, sampler, k=1, policy=None, user_times=None):
+    '''Generate the positive and negative samples of every user, k negatives per positive training sample,
+       with the histories bounded by policy.
+
+    Returns:
+        tuple: (train_set, val_set, test_set), lists of (uid, poi, history, coordinate, label)
+    '''
+    sum_seqlen=0
+    uids = list(range(num_user))
+    train_negatives, eval_negatives = draw_negatives(sampler, user_seqs, uids, [0] * num_user, k)
+
+    # generate training, testing and validation set
+    train_set, eval_set = [], []
+    for uid in uids:
+        true_seq = user_seqs[uid]
+
+        # calculate the sum of sequence length, this is also the interactions in this sequence
+        sum_seqlen+=len(true_seq)
+
+        train_samples, eval_samples = user_samples(uid, true_seq, coords, train_negatives[uid], eval_negatives[uid],
+                                                   policy=policy, times=user_times and user_times[uid])
+        train_set.extend(train_samples)
+        eval_set.extend(eval_samples)
+
+    print(f'avgSeqLen = {sum_seqlen/num_user}')
+    print(f'interactions = {sum_seqlen}')       
+    if policy:
+        print(f'avgHistLen = {np.mean([len(sample[2]) for sample in train_set + eval_set])} ({policy})')
+
+    # random shuffle the training and evaluation set
+    random.shuffle(train_set)
+    random.shuffle(eval_set)
+
+    # split the evaluation set into validation and testing set
+    sep = len(eval_set) // 2
+    val_set = eval_set[:sep]
+    test_set = eval_set[sep:]
+
+    print(f'#Train: {len(train_set)}')
+    print(f'#Validation: {len(val_set)}')
+    print(f'#Test: {len(test_set)}')
+
+    return train_set, val_set, test_set
+
+
+def update_samples(user_seqs, new_seqs, train_set, val_set, test_set, coords, sampler, k=1, policy=None,
+                   user_times=None, new_times=None):
+    '''Add the samples of the new check-ins of each user. The last check-in of a user with new check-ins
+       becomes a training sample and the new last one replaces it in the evaluation set; its positive
+       and negative sample go to the split of the previous ones. The negatives of the earlier training
+       samples that the users visit in the new check-ins are redrawn. The sequences of user_seqs (and the
+       times of user_times) are extended, the sampler must already know the new check-ins.
+
+    Returns:
+        tuple: (train_set, val_set, test_set)
+    '''
+    changed = set(new_seqs)
+    new_visits = {uid: set(seq) for uid, seq in new_seqs.items()}
+    split_of = {}
+    splits = {'val': [], 'test': []}
+    for name, samples in (('val', val_set), ('test', test_set)):
+        for sample in samples:
+            if sample[0] in changed:
+                split_of[(sample[0], sample[4])] = name
+            else:
+                splits[name].append(sample)
+
+    uids = sorted(changed)
+    starts = [max(0, len(user_seqs.get(uid, [])) - 1) for uid in uids]
+    for uid in uids:
+        user_seqs[uid] = user_seqs.get(uid, []) + new_seqs[uid]
+        if user_times is not None:
+            user_times[uid] = user_times.get(uid, []) + new_times[uid]
+    train_negatives, eval_negatives = draw_negatives(sampler, user_seqs, uids, starts, k)
+
+    new_train = []
+    for uid, start, negatives, eval_negative in zip(uids, starts, train_negatives, eval_negatives):
+        train_samples, eval_samples = user_samples(uid, user_seqs[uid], coords, negatives, eval_negative, start,
+                                                   policy, user_times and user_times[uid])
+        new_train.extend(train_samples)
+        for sample in eval_samples:
+            # new users are split at random
+            name = split_of.get((uid, sample[4])) or random.choice(['val', 'test'])
+            splits[name].append(sample)
+
+    # the earlier negatives must still be POIs that the user never visits
+    train_set = list(train_set)
+    stale = [n for n, (uid, poi, _, _, label) in enumerate(train_set)
+             if label == 0 and uid in changed and poi in new_visits[uid]]
+    if stale:
+        # anchored at the positive POI of the same history, any of them if bounded histories coincide
+        positives = {(uid, tuple(history)): poi for uid, poi, history, _, label in train_set
+                     if label == 1 and uid in changed}
+        anchors = [positives[(train_set[n][0], tuple(train_set[n][2]))] for n in stale]
+        redrawn = sampler.sample([train_set[n][0] for n in stale], 1, np.array(anchors))[:, 0].tolist()
+        for n, poi in zip(stale, redrawn):
+            uid, _, history, _, _ = train_set[n]
+            train_set[n] = (uid, poi, history, coords[poi], 0)
+
+    random.shuffle(new_train)
+    print(f'#Users with new check-ins: {len(changed)}')
+    print(f'#New training samples: {len(new_train)}')
+    print(f'#Redrawn negatives: {len(stale)}')
+    return train_set + new_train, splits['val'], splits['test']
+
+
+def save_datasets(dst_path, train_set, val_set, test_set, num_user, num_poi):
+    with open(dst_path+'train.pkl', 'wb') as f:
+        pkl.dump(train_set, f, pkl.HIGHEST_PROTOCOL)
+    with open(dst_path+'test.pkl', 'wb') as f:
+        pkl.dump(test_set, f, pkl.HIGHEST_PROTOCOL)
+    with open(dst_path+'val.pkl', 'wb') as f:
+        pkl.dump(val_set, f, pkl.HIGHEST_PROTOCOL)
+    with open(dst_path+'info.pkl', 'wb') as f:
+        pkl.dump((num_user, num_poi), f, pkl.HIGHEST_PROTOCOL)
+
+
+def _ball_tree(latlon):
+    return BallTree(np.radians(latlon), metric='haversine')
+
+
+def _pairs(nodes, neighbors):
+    '''Unique pairs (i < j) between each node and its neighbors.'''
+    i = np.repeat(nodes, [len(nb) for nb in neighbors])
+    j = np.concatenate(neighbors).astype(np.int64) if len(neighbors) else np.zeros(0, dtype=np.int64)
+    pairs = np.stack((np.minimum(i, j), np.maximum(i, j)))[:, i != j]
+    pairs = np.unique(pairs, axis=1)
+    return pairs[0], pairs[1]
+
+
+def radius_pairs(tree, latlon, nodes, threshold):
+    '''Candidate pairs of the nodes within threshold km, slightly widened for the exact test by distance().'''
+    neighbors = tree.query_radius(np.radians(latlon[nodes]), r=threshold * (1 + 1e-6) / EARTH_RADIUS)
+    return _pairs(nodes, list(neighbors))
+
+
+def knn_pairs(tree, latlon, nodes, k):
+    '''Pairs of the nodes and their k nearest POIs.'''
+    _, ind = tree.query(np.radians(latlon[nodes]), k=min(k + 1, len(latlon)))
+    return _pairs(nodes, list(ind))
+
+
+def kth_distance(tree, latlon, nodes, k):
+    '''Distance in km of the nodes to their k-th nearest POI.'''
+    dist, _ = tree.query(np.radians(latlon[nodes]), k=min(k + 1, len(latlon)))
+    return dist[:, -1] * EARTH_RADIUS
+
+
+def cap_degree(edges, dist_on_graph, max_degree, degree):
+    '''Keep the edges in order of distance while both ends have less than max_degree neighbors.
+       degree is the num of neighbors of each POI from the other edges of the graph.'''
+    degree = degree.copy()
+    keep = np.zeros(edges.shape[1], dtype=bool)
+    for e in np.argsort(dist_on_graph, kind='stable'):
+        i, j = edges[0, e], edges[1, e]
+        if degree[i] < max_degree and degree[j] < max_degree:
+            degree[i] += 1
+            degree[j] += 1
+            keep[e] = True
+    return np.ascontiguousarray(edges[:, keep]), dist_on_graph[keep]
+
+
+def neighborhood_graph(coords, num_poi, threshold=0.5, mode='radius', k=10, max_degree=0, nodes=None, degree=None):
+    '''Link the POIs near each other, see --graph. The distances are computed by distance().
+
+    Args:
+        nodes (np.ndarray): Only build the edges of these POIs, all of them if None.
+        degree (np.ndarray): Degree of the POIs in the existing edges, for --max_degree.
+
+    Returns:
+        edges (np.ndarray): Edges with i < j sorted by i then j, size (2, num_edges).
+        dist_on_graph (np.ndarray): The distance of each edge, size (num_edges,).
+    '''
+    latlon = np.array([coords[poi] for poi in range(num_poi)], dtype=np.float64)
+    nodes = np.arange(num_poi) if nodes is None else np.asarray(nodes, dtype=np.int64)
+    if len(nodes) == 0:
+        return np.zeros((2, 0), dtype=np.int64), np.zeros(0)
+
+    tree = _ball_tree(latlon)
+    if mode == 'radius':
+        i, j = radius_pairs(tree, latlon, nodes, threshold)
+    else:
+        i, j = knn_pairs(tree, latlon, nodes, k)
+    i, j = i.tolist(), j.tolist()
+
+    # the distance of each candidate edge
+    dist = [distance(coords[a][0], coords[a][1], coords[b][0], coords[b][1]) for a, b in zip(i, j)]
+    dist = np.array(dist, dtype=np.float64)
+    i, j = np.array(i, dtype=np.int64), np.array(j, dtype=np.int64)
+
+    keep = dist <= threshold
+    if mode == 'adaptive':
+        radius = np.zeros(num_poi)
+        ends = np.unique(np.concatenate((i, j)))
+        radius[ends] = np.minimum(kth_distance(tree, latlon, ends, k), threshold)
+        keep &= dist <= np.minimum(radius[i], radius[j])
+
+    # convert to numpy array in the order of the pairs, size: (2, num_edges)
+    order = np.lexsort((j[keep], i[keep]))
+    edges = np.ascontiguousarray(np.stack((i[keep], j[keep]))[:, order])
+    dist_on_graph = dist[keep][order]
+
+    if max_degree > 0:
+        degree = np.zeros(num_poi, dtype=np.int64) if degree is None else degree
+        edges, dist_on_graph = cap_degree(edges, dist_on_graph, max_degree, degree)
+    return edges, dist_on_graph
+
+
+def degree_stats(edges, num_poi):
+    '''Degree distribution of the graph, and the non-zeros of the GCN propagation matrix
+       (both directions and the self-loops) that bound the cost of a GeoGraph layer.'''
+    degree = np.bincount(edges.ravel(), minlength=num_poi)
+    return {
+        'num_poi': int(num_poi),
+        'num_edges': int(edges.shape[1]),
+        'gcn_nnz': int(2 * edges.shape[1] + num_poi),
+        'degree_mean': float(degree.mean()),
+        'degree_p50': float(np.percentile(degree, 50)),
+        'degree_p90': float(np.percentile(degree, 90)),
+        'degree_p99': float(np.percentile(degree, 99)),
+        'degree_max': int(degree.max()),
+        'isolated': int((degree == 0).sum()),
+    }
+
+
+def save_graph(dst_path, edges, dist_on_graph, stats):
+    with open(dst_path+'dist_graph.pkl', 'wb') as f:
+        pkl.dump(edges, f, pkl.HIGHEST_PROTOCOL)
+    np.save(dst_path + 'dist_on_graph.npy', dist_on_graph)
+    with open(dst_path + 'graph_stats.json', 'w') as f:
+        json.dump(stats, f, indent=1)
+
+
+def load_datasets(dst_path):
+    splits = []
+    for name in ['train', 'val', 'test']:
+        with open(dst_path + f'{name}.pkl', 'rb') as f:
+            splits.append(pkl.load(f))
+    return splits
+
+
+def load_graph(dst_path):
+    with open(dst_path+'dist_graph.pkl', 'rb') as f:
+        edges = pkl.load(f)
+    return edges, np.load(dst_path + 'dist_on_graph.npy')
+
+
+def save_state(dst_path, state):
+    '''Save what --incremental needs: the id maps, coordinates, sequences of the users and the graph,
+       negative and history settings.'''
+    with open(dst_path + 'state.pkl', 'wb') as f:
+        pkl.dump(state, f, pkl.HIGHEST_PROTOCOL)
+
+
+def load_state(dst_path):
+    with open(dst_path + 'state.pkl', 'rb') as f:
+        return pkl.load(f)
+
+
+def invalidate_processed(dst_path):
+    '''Remove the sequence graphs built by MyDataset from the previous samples, they are rebuilt on load.'''
+    root = os.path.dirname(os.path.normpath(dst_path))
+    for path in glob.glob(os.path.join(root, 'processed', '*_seq_graph*.pt')):
+        os.remove(path)
+
+
+def update(arg, dst_path):
+    '''Add new check-ins to preprocessed data. Users and POIs keep their indices and new ones are appended.
+       Only the samples of the users with new check-ins and the edges of the new POIs are generated, with
+       the graph settings of the first run. The knn and adaptive graphs of the existing POIs are not
+       revisited, a full run rebuilds them.'''
+    state = load_state(dst_path)
+    state['updates'] += 1
+    random.seed(arg.seed + state['updates'])
+
+    print('Reading data...')
+    old_num_poi = len(state['coords'])
+    data, uid_map, poi_map = read_checkins(arg.src, state['uid_map'], state['poi_map'])
+    num_user, num_poi = len(uid_map), len(poi_map)
+    print(f'#New POIs: {num_poi - old_num_poi}')
+    print('Finish reading data.')
+
+    coords = poi_coords(data, num_poi, state['coords'])
+    print('Updating neighborhood graph...')
+    graph = state['graph']
+    edges, dist_on_graph = load_graph(dst_path)
+    new_edges, new_dist = neighborhood_graph(
+        coords, num_poi, graph['threshold'], graph['mode'], graph['k'], graph['max_degree'],
+        nodes=np.arange(old_num_poi, num_poi), degree=np.bincount(edges.ravel(), minlength=num_poi))
+    edges = np.concatenate((edges.reshape(2, -1).astype(np.int64), new_edges), axis=1)
+    dist_on_graph = np.concatenate((dist_on_graph, new_dist))
+    order = np.lexsort((edges[1], edges[0]))
+    edges, dist_on_graph = np.ascontiguousarray(edges[:, order]), dist_on_graph[order]
+    print(f'#New edges: {new_edges.shape[1]}')
+    stats = degree_stats(edges, num_poi)
+    print('Degrees: ' + ', '.join(f'{name} = {value:g}' for name, value in stats.items()))
+    save_graph(dst_path, edges, dist_on_graph, stats)
+    print('Finish updating neighborhood graph.')
+
+    print('Generating dataset...')
+    new_seqs = user_sequences(data)
+    # the negatives are drawn with the settings of the first run, against all the check-ins
+    negatives = state.get('negatives', DEFAULT_NEGATIVES)
+    # and the histories with the policy of the first run
+    policy = HistoryPolicy.from_dict(state.get('history', {}))
+    if policy.window > 0 and 'user_times' not in state:
+        raise ValueError('The check-in times are missing from state.pkl, run preprocess.py again.')
+    all_seqs = dict(state['user_seqs'])
+    for uid, seq in new_seqs.items():
+        all_seqs[uid] = all_seqs.get(uid, []) + seq
+    sampler = make_sampler(negatives, all_seqs, num_poi, edges, arg.seed + state['updates'])
+    train_set, val_set, test_set = load_datasets(dst_path)
+    train_set, val_set, test_set = update_samples(state['user_seqs'], new_seqs, train_set, val_set, test_set,
+                                                  coords, sampler, negatives['k'], policy, state.get('user_times'),
+                                                  user_sequences(data, 'time'))
+    save_datasets(dst_path, train_set, val_set, test_set, num_user, num_poi)
+    print('Finish generating dataset.')
+
+    invalidate_processed(dst_path)
+    state.update(uid_map=uid_map, poi_map=poi_map, coords=coords)
+    save_state(dst_path, state)
+
+
+def main(argv=None):
+    arg = ARG.parse_args(argv)
+    dst_path = os.path.join(arg.dst, '')
+    if arg.incremental:
+        update(arg, dst_path)
+        return
+
+    # create the destination directory if not exist
+    os.makedirs(dst_path, exist_ok=True)
+
+    if arg.max_degree is None:
+        arg.max_degree = arg.k if arg.graph == 'knn' else 0
+
+    # set random seed
+    random.seed(arg.seed)
+
+    print('Reading data...')
+    data, uid_map, poi_map = read_checkins(arg.src)
+    num_user, num_poi = len(uid_map), len(poi_map)
+    print('Finish reading data.')
+
+    coords = poi_coords(data, num_poi)
+    print('Generating neighborhood graph...')
+    # only regard the POIs with distance less or equal than the threshold as neighbors
+    edges, dist_on_graph = neighborhood_graph(coords, num_poi, arg.threshold, arg.graph, arg.k, arg.max_degree)
+    stats = degree_stats(edges, num_poi)
+    print('Degrees: ' + ', '.join(f'{name} = {value:g}' for name, value in stats.items()))
+    save_graph(dst_path, edges, dist_on_graph, stats)
+    print('Finish generating neighborhood graph.')
+
+    print('Generating dataset...')
+    user_seqs = user_sequences(data)
+    user_times = user_sequences(data, 'time')
+    negatives = {'k': arg.negatives, 'sampler': arg.neg_sampler, 'hard': arg.hard_negatives}
+    policy = HistoryPolicy(arg.history_last, arg.history_unique, arg.history_window)
+    sampler = make_sampler(negatives, user_seqs, num_poi, edges, arg.seed)
+    train_set, val_set, test_set = generate_samples(user_seqs, num_user, coords, sampler, arg.negatives,
+                                                    policy, user_times)
+    save_datasets(dst_path, train_set, val_set, test_set, num_user, num_poi)
+    print('Finish generating dataset.')
+
+    invalidate_processed(dst_path)
+    graph = {'threshold': arg.threshold, 'mode': arg.graph, 'k': arg.k, 'max_degree': arg.max_degree}
+    save_state(dst_path, {'uid_map': uid_map, 'poi_map': poi_map, 'coords': coords, 'user_seqs': user_seqs,
+                          'user_times': user_times, 'graph': graph, 'negatives': negatives,
+                          'history': policy.to_dict(), 'updates': 0})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import torch
+from torch_geometric.data import Batch
+from dataset import seq_to_graph
+from history import HistoryPolicy
+from model import load_checkpoint, load_modules
+
+
+def neighbor_csr(dist_edges, n_poi):
+    '''Compressed sparse row neighbour lists of the (undirected) distance graph.
+
+    Args:
+        dist_edges (torch.Tensor): Edges of the distance graph, size (2, num_edges), each pair stored once.
+        n_poi (int): Number of POI.
+
+    Returns:
+        indptr (torch.Tensor): Size (n_poi + 1,), the neighbours of POI i are indices[indptr[i]:indptr[i + 1]].
+        indices (torch.Tensor): Size (2 * num_edges,).
+    '''
+    src = torch.cat((dist_edges[0], dist_edges[1]))
+    dst = torch.cat((dist_edges[1], dist_edges[0]))
+    order = torch.argsort(src, stable=True)
+    indptr = torch.zeros(n_poi + 1, dtype=torch.long)
+    indptr[1:] = torch.cumsum(torch.bincount(src, minlength=n_poi), dim=0)
+    return indptr, dst[order]
+
+
+def gather_neighbors(indptr, indices, nodes):
+    '''Concatenated neighbour lists of the given nodes, without a Python loop over the nodes.'''
+    start, end = indptr[nodes], indptr[nodes + 1]
+    counts = end - start
+    if counts.sum() == 0:
+        return nodes.new_empty(0)
+    # position of every gathered neighbour inside indices
+    offsets = torch.repeat_interleave(start - torch.cumsum(counts, dim=0) + counts, counts)
+    return indices[offsets + torch.arange(int(counts.sum()))]
+
+
+def history_batch(histories, device='cpu'):
+    '''Collate user histories into a Batch for the encoders. The target fields are placeholders.'''
+    graphs = [seq_to_graph(0, 0, seq, (0., 0.), 0) for seq in histories]
+    return Batch.from_data_list(graphs).to(device)
+
+
+class Ranker:
+    """
+    Rank the whole POI catalogue (or a candidate subset) for a batch of users.
+
+    The user representations e_g and e_s are computed once per user. The Predictor's first Linear
+    layer is split (see MLP.user_part and MLP.target_part), so the target part of every POI is
+    precomputed once and each score only costs the hidden activation and the last Linear layer.
+    POIs are scored in blocks and the top-K is kept with torch.topk (a partial sort).
+
+    Args:
+        Seq_encoder (SeqGraph): Sequential encoder.
+        Geo_encoder (GeoGraph): Geographical encoder.
+        Poi_embeds: POI embedding layer, EmbeddingLayer or MmapEmbeddingLayer.
+        Predictor (MLP): Predictor.
+        poi_enc: GeoGraph encodings of all the POIs, a tensor or a MmapTable.
+        dist_edges (torch.Tensor): Edges of the distance graph, only needed for candidate pruning.
+        block_size (int): Number of POIs scored at a time.
+        history (HistoryPolicy): Bound of the user histories, that of the training run.
+
+    """
+
+    def __init__(self, Seq_encoder, Geo_encoder, Poi_embeds, Predictor, poi_enc, dist_edges=None, block_size=4096,
+                 history=None):
+        self.Seq_encoder = Seq_encoder
+        self.Geo_encoder = Geo_encoder
+        self.Poi_embeds = Poi_embeds
+        self.Predictor = Predictor
+        self.poi_enc = poi_enc
+        self.n_poi = len(poi_enc)
+        self.block_size = block_size
+        self.history = history or HistoryPolicy()
+
+        # target part of the predictor for every POI, computed block by block
+        with torch.no_grad():
+            self.target_parts = torch.cat([
+                Predictor.target_part(poi_enc[torch.arange(i, min(i + block_size, self.n_poi))])
+                for i in range(0, self.n_poi, block_size)])
+
+        self.indptr, self.indices = None, None
+        if dist_edges is not None:
+            self.indptr, self.indices = neighbor_csr(dist_edges, self.n_poi)
+
+    @classmethod
+    def from_modules(cls, Seq_encoder, Geo_encoder, Poi_embeds, Predictor, dist_edges=None, block_size=4096,
+                     history=None):
+        '''Build a ranker from the training modules, running the GCN layers once.'''
+        with torch.no_grad():
+            poi_enc = Geo_encoder.encode(Poi_embeds)
+        return cls(Seq_encoder, Geo_encoder, Poi_embeds, Predictor, poi_enc, dist_edges, block_size, history)
+
+    @classmethod
+    def from_checkpoint(cls, ckpt_path, dist_edges, dist_vec, block_size=4096):
+        '''Build a ranker from a checkpoint written by main.py --ckpt, with its history policy.'''
+        ckpt = load_checkpoint(ckpt_path)
+        modules = load_modules(ckpt, dist_edges, dist_vec)
+        return cls.from_modules(*modules, dist_edges=dist_edges, block_size=block_size,
+                                history=HistoryPolicy.from_arg(ckpt['args']))
+
+    @classmethod
+    def from_serving(cls, model, dist_edges=None, block_size=4096):
+        '''Build a ranker from a ServingModel, reading the POI tables through its memory maps.'''
+        return cls(model.Seq_encoder, model.Geo_encoder, model.poi_embeds, model.Predictor,
+                   model.poi_enc, dist_edges, block_size, model.history)
+
+    def user_repr(self, batch):
+        '''Compute e_g, e_s for each user history in the batch. The padding of the histories is masked, so the
+           result of a user does not depend on the other histories of the batch.'''
+        self.Seq_encoder.eval()
+        self.Geo_encoder.eval()
+        with torch.no_grad():
+            e_s = self.Seq_encoder(batch, self.Poi_embeds)
+            e_g, _ = self.Geo_encoder(batch, self.Poi_embeds, poi_enc=self.poi_enc, per_sample=True)
+        return e_g, e_s
+
+    def score(self, e_g, e_s, pois):
+        '''Logits of the given POIs for each user, size (n_users, len(pois)).'''
+        scores = []
+        with torch.no_grad():
+            user_part = self.Predictor.user_part(e_g, e_s).unsqueeze(1)
+            for i in range(0, pois.size(0), self.block_size):
+                block = self.target_parts[pois[i:i + self.block_size]].unsqueeze(0)
+                scores.append(self.Predictor.score(user_part, block).squeeze(-1))
+        return torch.cat(scores, dim=1)
+
+    def topk(self, e_g, e_s, k=10):
+        '''Top-K POIs of the whole catalogue for each user.
+
+        Returns:
+            scores (torch.Tensor): Logits, size (n_users, k), in descending order.
+            pois (torch.Tensor): POI ids, size (n_users, k).
+        '''
+        k = min(k, self.n_poi)
+        with torch.no_grad():
+            user_part = self.Predictor.user_part(e_g, e_s).unsqueeze(1)
+            best_scores = user_part.new_empty(user_part.size(0), 0)
+            best_pois = torch.empty(user_part.size(0), 0, dtype=torch.long)
+            for i in range(0, self.n_poi, self.block_size):
+                block = self.target_parts[i:i + self.block_size].unsqueeze(0)
+                scores = self.Predictor.score(user_part, block).squeeze(-1)
+                pois = torch.arange(i, i + scores.size(1)).expand(scores.size(0), -1)
+                # merge the block into the running top-K
+                best_scores = torch.cat((best_scores, scores), dim=1)
+                best_pois = torch.cat((best_pois, pois), dim=1)
+                best_scores, idx = torch.topk(best_scores, min(k, best_scores.size(1)), dim=1)
+                best_pois = torch.gather(best_pois, 1, idx)
+        return best_scores, best_pois
+
+    def geo_candidates(self, seq, n_recent=5, hops=1):
+        '''POIs within `hops` steps of the last n_recent check-ins on the distance graph,
+           including the check-ins themselves.'''
+        if self.indptr is None:
+            raise ValueError('Candidate pruning needs the distance graph, pass dist_edges to Ranker.')
+        candidates = torch.unique(torch.LongTensor(seq[-n_recent:]))
+        frontier = candidates
+        for _ in range(hops):
+            frontier = gather_neighbors(self.indptr, self.indices, frontier)
+            candidates = torch.unique(torch.cat((candidates, frontier)))
+        return candidates
+
+    def rank(self, histories, k=10, prune=False, n_recent=5, hops=1):
+        '''Top-K next POIs for each user history.
+
+        Args:
+            histories (list): POI sequences, one per user, bounded by the history policy of the ranker.
+            k (int): Number of POIs returned per user.
+            prune (bool): Only score the geo-neighbourhood of the recent check-ins.
+            n_recent (int): Number of recent check-ins used for pruning.
+            hops (int): Neighbourhood size used for pruning.
+
+        Returns:
+            list: (pois, scores) per user, both of length <= k, in descending order of score.
+        '''
+        histories = [self.history(seq) for seq in histories]
+        e_g, e_s = self.user_repr(history_batch(histories))
+        return self.rank_repr(e_g, e_s, histories, k, prune, n_recent, hops)
+
+    def rank_repr(self, e_g, e_s, histories, k=10, prune=False, n_recent=5, hops=1):
+        '''Top-K next POIs for users whose e_g, e_s are already computed, see rank. The histories are only
+           used for pruning and are not bounded here.'''
+        if not prune:
+            scores, pois = self.topk(e_g, e_s, k)
+            return list(zip(pois, scores))
+
+        results = []
+        for i, seq in enumerate(histories):
+            candidates = self.geo_candidates(seq, n_recent, hops)
+            scores = self.score(e_g[i:i + 1], e_s[i:i + 1], candidates)[0]
+            scores, idx = torch.topk(scores, min(k, scores.size(0)))
+            results.append((candidates[idx], scores))
+        return results
@@ -0,0 +1,152 @@
+import logging
+import os.path as osp
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn as nn
+from dataset import load_dist_graph
+from ranking import Ranker
+from serving import TABLE_META, ServingModel
+
+
+def _tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, nn.Module):
+        for module in obj.modules():
+            yield from module.parameters(recurse=False)
+            yield from module.buffers(recurse=False)
+            yield from (v for v in vars(module).values() if isinstance(v, torch.Tensor))
+    elif hasattr(obj, '__dict__'):
+        for value in vars(obj).values():
+            if isinstance(value, (torch.Tensor, nn.Module)):
+                yield from _tensors(value)
+
+
+def tensor_bytes(*objs):
+    '''Bytes of the distinct tensor storages held by the objects: the parameters, buffers and tensor
+       attributes of modules, and the tensor and module attributes of other objects. Memory-mapped
+       tables are not tensors, so they are not counted.'''
+    storages = {}
+    for obj in objs:
+        for t in _tensors(obj):
+            parts = (t._indices(), t._values()) if t.is_sparse else (t,)
+            for part in parts:
+                storage = part.untyped_storage()
+                storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+class CityModel:
+    '''A loaded model of the registry.'''
+
+    def __init__(self, city, ranker, load_s, nbytes):
+        self.city = city
+        self.ranker = ranker
+        self.load_s = load_s
+        self.nbytes = nbytes
+
+
+class ModelRegistry:
+    '''Models of several cities in one serving process, each loaded on its first request and evicted
+       least recently used when the loaded ones exceed a memory budget.
+
+    A city is a checkpoint written by main.py --ckpt or a directory of tables written by serving.py,
+    with the distance graph of {data_root}/{city}; either is wrapped in a ranking.Ranker. The cities
+    share the code, the intra-op threads of torch and one pool of request threads. A city is loaded
+    by its first request only, the requests to the loaded cities go on meanwhile. The size of a model is
+    that of its tensors, see tensor_bytes, so the memory-mapped tables count for nothing. An evicted
+    model is freed once the requests using it finish, and is loaded again by the next request to its city.
+
+    Args:
+        sources (dict): Checkpoint or table directory of each city.
+        data_root (str): Directory of the processed data of the cities.
+        budget_mb (float): Max total size of the loaded models in MB, 0 for no limit. The model of the
+            latest request is kept even if it is over the budget alone.
+        workers (int): Num of threads of the request pool.
+        block_size (int): Num of POIs scored at a time by the rankers.
+    '''
+
+    def __init__(self, sources, data_root='./processed_data', budget_mb=0., workers=4, block_size=4096):
+        self.sources = dict(sources)
+        self.data_root = data_root
+        self.budget = budget_mb * 2 ** 20
+        self.block_size = block_size
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_locks = {city: threading.Lock() for city in self.sources}
+        self.counters = {city: {'loads': 0, 'hits': 0, 'evictions': 0} for city in self.sources}
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='registry')
+
+    def _load(self, city):
+        start = time.perf_counter()
+        source = self.sources[city]
+        dist_edges, dist_vec = load_dist_graph(osp.join(self.data_root, city))
+        if osp.isdir(source) and osp.exists(osp.join(source, TABLE_META)):
+            ranker = Ranker.from_serving(ServingModel(source), dist_edges, self.block_size)
+        else:
+            ranker = Ranker.from_checkpoint(source, dist_edges, dist_vec, self.block_size)
+        return CityModel(city, ranker, time.perf_counter() - start, tensor_bytes(ranker))
+
+    def _evict(self, keep):
+        # called with the lock held
+        while self.budget > 0 and len(self.models) > 1 and self.size() > self.budget:
+            city = next(c for c in self.models if c != keep)
+            model = self.models.pop(city)
+            self.counters[city]['evictions'] += 1
+            logging.info(f'Evicted the model of {city} ({model.nbytes / 2 ** 20:.1f} MB)')
+
+    def size(self):
+        '''Total size of the loaded models in bytes.'''
+        return sum(model.nbytes for model in self.models.values())
+
+    def _cached(self, city):
+        with self.lock:
+            model = self.models.get(city)
+            if model is None:
+                return None
+            self.models.move_to_end(city)
+            self.counters[city]['hits'] += 1
+            return model.ranker
+
+    def get(self, city):
+        '''The Ranker of a city, loaded if it is not.'''
+        if city not in self.sources:
+            raise KeyError(f'Unknown city {city}, the registry has {sorted(self.sources)}.')
+        ranker = self._cached(city)
+        if ranker is not None:
+            return ranker
+
+        # a city is loaded once even if several requests wait for it
+        with self.load_locks[city]:
+            ranker = self._cached(city)
+            if ranker is not None:
+                return ranker
+            model = self._load(city)
+            with self.lock:
+                self.models[city] = model
+                self.counters[city]['loads'] += 1
+                self.counters[city].update(load_s=model.load_s, size_mb=model.nbytes / 2 ** 20)
+                self._evict(keep=city)
+        logging.info(f'Loaded the model of {city} in {model.load_s:.2f}s ({model.nbytes / 2 ** 20:.1f} MB)')
+        return model.ranker
+
+    def submit(self, city, histories, k=10, **kwargs):
+        '''Rank the catalogue of a city for the histories in the request pool, see Ranker.rank.
+
+        Returns:
+            Future: The (pois, scores) of each history.
+        '''
+        return self.executor.submit(lambda: self.get(city).rank(histories, k, **kwargs))
+
+    def stats(self):
+        '''Loads, hits and evictions of each city, with the time in s and the size in MB of its last load,
+           and the total size of the loaded models.'''
+        with self.lock:
+            cities = {city: dict(counters, loaded=city in self.models) for city, counters in self.counters.items()}
+            return {'cities': cities, 'size_mb': self.size() / 2 ** 20, 'budget_mb': self.budget / 2 ** 20}
+
+    def close(self):
+        self.executor.shutdown()
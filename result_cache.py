@@ -0,0 +1,202 @@
+import threading
+import time
+from collections import OrderedDict, deque
+import numpy as np
+import torch
+from ranking import history_batch
+
+
+class UserResult:
+    '''Cached result of a user: e_g, e_s of its history and the last top-K list, if any.'''
+
+    def __init__(self, tail, e_g, e_s, expires):
+        self.tail = tail
+        self.e_g = e_g
+        self.e_s = e_s
+        # (k, pois, scores)
+        self.topk = None
+        self.expires = expires
+
+
+class ResultCache:
+    '''LRU cache of user results with a time to live, keyed by (uid, hash of the history tail, model version).
+
+    The tail is the history as the model sees it, after its history policy. An entry keeps the tail
+    it was computed from, so that a hash collision is a miss. A new check-in changes the tail and thus
+    the key, invalidate(uid) frees the entries of the previous ones; a new model version makes all the
+    entries unreachable, clear() frees them.
+
+    Args:
+        max_entries (int): Max num of entries, the least recently used are evicted.
+        ttl (float): Time to live of an entry in seconds, 0 for no limit.
+        clock (callable): Time in seconds.
+    '''
+
+    def __init__(self, max_entries=100000, ttl=300., clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.user_keys = {}
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'invalidated': 0}
+
+    @staticmethod
+    def key(uid, tail, version):
+        return uid, hash(tuple(tail)), version
+
+    def _remove(self, key):
+        del self.entries[key]
+        keys = self.user_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.user_keys[key[0]]
+
+    def get(self, uid, tail, version):
+        '''The entry of a user state, None if it is missing or expired.'''
+        key = self.key(uid, tail, version)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.tail != tuple(tail):
+                entry = None
+            elif entry is not None and self.ttl > 0 and entry.expires <= self.clock():
+                self._remove(key)
+                self.counters['expired'] += 1
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry
+
+    def put(self, uid, tail, version, e_g, e_s):
+        '''Cache the e_g, e_s of a user state, returns its entry.'''
+        key = self.key(uid, tail, version)
+        entry = UserResult(tuple(tail), e_g, e_s, self.clock() + self.ttl)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.user_keys.setdefault(uid, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.counters['evicted'] += 1
+        return entry
+
+    def invalidate(self, uid):
+        '''Drop the entries of a user, e.g. on a new check-in. Returns their num.'''
+        with self.lock:
+            keys = list(self.user_keys.get(uid, ()))
+            for key in keys:
+                self._remove(key)
+            self.counters['invalidated'] += len(keys)
+        return len(keys)
+
+    def clear(self):
+        '''Drop all the entries, e.g. when the model is reloaded.'''
+        with self.lock:
+            self.counters['invalidated'] += len(self.entries)
+            self.entries.clear()
+            self.user_keys.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, entries=len(self.entries))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.
+        return stats
+
+
+class CachedRanker:
+    '''Ranker whose user representations and top-K lists are cached per user state.
+
+    For each request, only the users missing from the cache are collated and encoded, in one batch. The
+    encoding of a user does not depend on the other users of the batch (see Ranker.user_repr), so a cached
+    entry is valid for any later request.
+    A cached top-K list of at least k POIs answers an unpruned request without scoring; pruned requests
+    are scored from the cached e_g, e_s.
+
+    Args:
+        ranker (Ranker): The model.
+        cache (ResultCache): The cache, a new one if None.
+        version: Version of the model, part of the cache keys.
+        window (int): Num of recent requests of the latency statistics.
+    '''
+
+    def __init__(self, ranker, cache=None, version=0, window=10000):
+        self.ranker = ranker
+        self.cache = ResultCache() if cache is None else cache
+        self.version = version
+        self.lock = threading.Lock()
+        self.latency = {'hit': deque(maxlen=window), 'miss': deque(maxlen=window)}
+        self.topk_hits = 0
+
+    def check_in(self, uid):
+        '''A new check-in of a user, its cached results are dropped.'''
+        self.cache.invalidate(uid)
+
+    def reload(self, ranker, version=None):
+        '''Swap the model, the cache is cleared and the version bumped (or set).'''
+        with self.lock:
+            self.ranker = ranker
+            self.version = self.version + 1 if version is None else version
+        self.cache.clear()
+
+    def rank(self, uids, histories, k=10, prune=False, n_recent=5, hops=1):
+        '''Top-K next POIs for each user, see Ranker.rank.
+
+        Args:
+            uids (list): User ids, one per history.
+            histories (list): POI sequences, one per user.
+        '''
+        start = time.perf_counter()
+        ranker, version = self.ranker, self.version
+        tails = [ranker.history(seq) for seq in histories]
+        entries = [self.cache.get(uid, tail, version) for uid, tail in zip(uids, tails)]
+
+        miss = [i for i, entry in enumerate(entries) if entry is None]
+        if miss:
+            e_g, e_s = ranker.user_repr(history_batch([tails[i] for i in miss]))
+            for j, i in enumerate(miss):
+                entries[i] = self.cache.put(uids[i], tails[i], version,
+                                            e_g[j:j + 1].clone(), e_s[j:j + 1].clone())
+
+        topk_hits = 0
+        if prune:
+            e_g = torch.cat([entry.e_g for entry in entries])
+            e_s = torch.cat([entry.e_s for entry in entries])
+            results = ranker.rank_repr(e_g, e_s, tails, k, prune, n_recent, hops)
+        else:
+            k = min(k, ranker.n_poi)
+            todo = [i for i, entry in enumerate(entries) if entry.topk is None or entry.topk[0] < k]
+            if todo:
+                e_g = torch.cat([entries[i].e_g for i in todo])
+                e_s = torch.cat([entries[i].e_s for i in todo])
+                scores, pois = ranker.topk(e_g, e_s, k)
+                for j, i in enumerate(todo):
+                    entries[i].topk = (k, pois[j], scores[j])
+            topk_hits = len(entries) - len(todo)
+            results = [(entry.topk[1][:k], entry.topk[2][:k]) for entry in entries]
+
+        with self.lock:
+            self.topk_hits += topk_hits
+            self.latency['miss' if miss else 'hit'].append(time.perf_counter() - start)
+        return results
+
+    def stats(self):
+        '''Counters of the cache, the num of users answered by a cached top-K list, and the
+           p50/p99 latency in ms of the requests answered from the cache (hit) or not (miss).'''
+        stats = self.cache.stats()
+        with self.lock:
+            stats['topk_hits'] = self.topk_hits
+            latency = {name: list(values) for name, values in self.latency.items()}
+        for name, values in latency.items():
+            stats[f'{name}_requests'] = len(values)
+            if values:
+                p50, p99 = np.percentile(np.array(values) * 1e3, [50, 99])
+                stats[f'{name}_p50_ms'], stats[f'{name}_p99_ms'] = float(p50), float(p99)
+        return stats
@@ -0,0 +1,276 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from export import batch_inputs
+from history import HistoryPolicy
+
+
+class TorchScriptRunner:
+    '''Run a TorchScript model written by export.py.'''
+
+    def __init__(self, path):
+        self.model = torch.jit.load(path).eval()
+        self.n_poi = self.model.poi_embeds.size(0)
+        # the models exported before the history policy keep the full histories
+        self.history = HistoryPolicy(getattr(self.model, 'history_last', 0),
+                                     getattr(self.model, 'history_unique', 0))
+
+    def __call__(self, inputs):
+        with torch.no_grad():
+            return self.model(*inputs).numpy()
+
+
+class OnnxRunner:
+    '''Run an ONNX model written by export.py with onnxruntime.'''
+
+    def __init__(self, path, threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.names = [i.name for i in self.session.get_inputs()]
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.n_poi = int(meta['n_poi'])
+        self.history = HistoryPolicy(int(meta.get('history_last', 0)), int(meta.get('history_unique', 0)))
+
+    def __call__(self, inputs):
+        feed = {name: t.numpy() for name, t in zip(self.names, inputs)}
+        return self.session.run(None, feed)[0]
+
+
+def load_runner(path, threads=None):
+    if path.endswith('.onnx'):
+        return OnnxRunner(path, threads)
+    return TorchScriptRunner(path)
+
+
+# queued to stop the batching thread
+STOP = object()
+
+
+class Request:
+    def __init__(self, samples):
+        self.samples = samples
+        self.arrival = time.perf_counter()
+        self.future = Future()
+
+
+class MicroBatcher:
+    '''Coalesce concurrent requests into micro-batches scored by one model call.
+
+    A batch is closed when it holds max_batch samples or when its oldest request has waited max_wait
+    seconds, so no request waits more than max_wait for others to join; the requests queued while the
+    model was busy join without waiting. Requests larger than max_batch are scored alone.
+
+    Args:
+        runner (callable): Model taking the inputs of export.batch_inputs, returns the probabilities. The
+            histories are bounded by its history policy, if it has one.
+        max_batch (int): Max num of samples per batch.
+        max_wait (float): Batching deadline in seconds.
+        window (int): Num of recent batches of the statistics.
+    '''
+
+    def __init__(self, runner, max_batch=64, max_wait=0.005, window=10000):
+        self.runner = runner
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.n_requests, self.n_batches = 0, 0
+        self.batch_sizes = deque(maxlen=window)
+        self.wait = deque(maxlen=window)
+        self.service = deque(maxlen=window)
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, samples):
+        '''Queue (poi, history) samples, the returned Future holds their probabilities.'''
+        request = Request(samples)
+        self.queue.put(request)
+        return request.future
+
+    def close(self):
+        self.queue.put(STOP)
+        self.thread.join()
+
+    def _collect(self, first):
+        '''Take the requests of the batch of first from the queue, returns the batch and the request that
+           starts the next one, if any.'''
+        batch, n_samples = [first], len(first.samples)
+        deadline = first.arrival + self.max_wait
+        while n_samples < self.max_batch:
+            # after the deadline, only the requests already queued join the batch
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.queue.get(block=timeout > 0, timeout=max(timeout, 0))
+            except queue.Empty:
+                break
+            if request is STOP or n_samples + len(request.samples) > self.max_batch:
+                return batch, request
+            batch.append(request)
+            n_samples += len(request.samples)
+        return batch, None
+
+    def _run(self, batch):
+        start = time.perf_counter()
+        samples = [sample for r in batch for sample in r.samples]
+        try:
+            prob = self.runner(batch_inputs(samples, getattr(self.runner, 'history', None)))
+        except Exception as e:
+            for r in batch:
+                r.future.set_exception(e)
+        else:
+            offset = 0
+            for r in batch:
+                r.future.set_result(prob[offset:offset + len(r.samples)].tolist())
+                offset += len(r.samples)
+        end = time.perf_counter()
+
+        with self.lock:
+            self.n_requests += len(batch)
+            self.n_batches += 1
+            self.batch_sizes.append(len(samples))
+            self.wait.extend(start - r.arrival for r in batch)
+            self.service.append(end - start)
+
+    def _loop(self):
+        request = None
+        while True:
+            if request is None:
+                request = self.queue.get()
+            if request is STOP:
+                return
+            batch, request = self._collect(request)
+            self._run(batch)
+
+    def stats(self):
+        '''Num of requests and batches, mean batch size and p50/p99 of the queueing and scoring time in ms.'''
+        with self.lock:
+            sizes, wait, service = list(self.batch_sizes), list(self.wait), list(self.service)
+            stats = {'requests': self.n_requests, 'batches': self.n_batches}
+        stats['mean_batch'] = float(np.mean(sizes)) if sizes else 0.
+        for name, values in (('wait', wait), ('service', service)):
+            if values:
+                p50, p99 = np.percentile(np.array(values) * 1e3, [50, 99])
+                stats[f'{name}_p50_ms'], stats[f'{name}_p99_ms'] = float(p50), float(p99)
+        return stats
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    '''POST /score with {"samples": [{"poi": 3, "history": [5, 8, 5]}, ...]} returns {"scores": [...]}.
+       GET /stats returns MicroBatcher.stats(), GET /health an empty object.'''
+
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately, Nagle's algorithm would delay the body
+    disable_nagle_algorithm = True
+    batcher = None
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.batcher.stats())
+        elif self.path == '/health':
+            self._reply(200, {})
+        else:
+            self._reply(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._reply(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            samples = [(int(s['poi']), [int(p) for p in s['history']]) for s in body['samples']]
+            if not samples or not all(history for _, history in samples):
+                raise ValueError('Every sample needs a non-empty history.')
+            # a bad id would fail the whole micro-batch, so it is rejected here
+            n_poi = self.batcher.runner.n_poi
+            if not all(0 <= p < n_poi for poi, history in samples for p in [poi] + history):
+                raise ValueError(f'POI ids must be in [0, {n_poi}).')
+        except (KeyError, TypeError, ValueError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        try:
+            scores = self.batcher.submit(samples).result()
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+            return
+        self._reply(200, {'scores': scores})
+
+    def address_string(self):
+        # the client address of a Unix socket is not a (host, port) pair
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class TCPHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(batcher, host='127.0.0.1', port=8000, unix=None):
+    handler = type('Handler', (ScoringHandler,), {'batcher': batcher})
+    if unix is not None:
+        if os.path.exists(unix):
+            os.remove(unix)
+        return UnixHTTPServer(unix, handler)
+    return TCPHTTPServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    ARG = argparse.ArgumentParser(description='HTTP scoring server of a model exported by export.py.')
+    ARG.add_argument('--model', type=str, required=True,
+                     help='Model written by export.py, TorchScript or .onnx.')
+    ARG.add_argument('--host', type=str, default='127.0.0.1',
+                     help='Host of the TCP socket.')
+    ARG.add_argument('--port', type=int, default=8000,
+                     help='Port of the TCP socket.')
+    ARG.add_argument('--unix', type=str, default=None,
+                     help='Listen on this Unix socket instead of TCP.')
+    ARG.add_argument('--max_batch', type=int, default=64,
+                     help='Max num of samples per micro-batch.')
+    ARG.add_argument('--max_wait_ms', type=float, default=5.,
+                     help='Max time in ms a request waits for others to join its micro-batch.')
+    ARG.add_argument('--threads', type=int, default=None,
+                     help='Num of intra-op threads of the model.')
+    ARG = ARG.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if ARG.threads is not None:
+        torch.set_num_threads(ARG.threads)
+
+    batcher = MicroBatcher(load_runner(ARG.model, ARG.threads), ARG.max_batch, ARG.max_wait_ms / 1e3)
+    server = make_server(batcher, ARG.host, ARG.port, ARG.unix)
+    logging.info(f'Serving {ARG.model} on {ARG.unix or f"http://{ARG.host}:{ARG.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import os.path as osp
+import numpy as np
+import torch
+import torch.nn as nn
+from torch_geometric.data import Batch
+from dataset import load_dist_graph, seq_to_graph
+from history import HistoryPolicy
+from model import build_encoders, load_checkpoint, load_modules
+
+
+TABLE_META = 'tables.json'
+ENCODER_FILE = 'encoders.pt'
+
+
+class MmapTable:
+    '''Read-only table memory-mapped from a flat row-major binary file.
+       Indexing gathers only the requested rows, the rest of the file stays on disk.
+       Processes mapping the same file share one copy in the page cache.
+
+    Args:
+        path (str): Path of the binary file.
+        n_rows (int): Number of rows.
+        n_cols (int): Number of columns.
+        dtype (str): Element type of the file, 'float32' or 'float16'.
+
+    Input:
+        torch.Tensor: Row indices.
+
+    Output:
+        torch.Tensor: The gathered rows as float32.
+    '''
+
+    def __init__(self, path, n_rows, n_cols, dtype='float32'):
+        self.path = path
+        self.array = np.memmap(path, dtype=dtype, mode='r', shape=(n_rows, n_cols))
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.cpu().numpy()
+        # fancy indexing copies only the selected rows out of the mapping
+        rows = self.array[idx]
+        return torch.from_numpy(np.ascontiguousarray(rows, dtype=np.float32))
+
+
+class MmapEmbeddingLayer(nn.Module):
+    '''POI embedding layer backed by a MmapTable, used in place of EmbeddingLayer for inference.
+
+    Args:
+        table (MmapTable): The POI embedding table.
+
+    Input:
+        torch.Tensor: Index of POI.
+
+    Output:
+        torch.Tensor: Embedding vector of POI.
+    '''
+
+    def __init__(self, table):
+        super(MmapEmbeddingLayer, self).__init__()
+        self.table = table
+
+    def forward(self, idx):
+        return self.table[idx].to(idx.device)
+
+
+def write_table(path, tensor, dtype='float32'):
+    '''Write a 2-d tensor to a flat row-major binary file.'''
+    tensor.detach().cpu().numpy().astype(dtype).tofile(path)
+
+
+def export_tables(ckpt_path, dist_edges, dist_vec, out_dir, dtype='float32'):
+    '''Export a checkpoint for memory-mapped serving.
+
+    The POI embedding table and the GeoGraph encodings of all the POIs (the output of the GCN layers)
+    are written to flat binary files, the remaining small modules are saved to encoders.pt.
+
+    Args:
+        ckpt_path (str): Checkpoint written by main.py --ckpt.
+        dist_edges (torch.Tensor): Edges of the distance graph, size (2, num_edges).
+        dist_vec (np.ndarray): Distance of the edges, size (num_edges,).
+        out_dir (str): Output directory.
+        dtype (str): Element type of the tables, 'float32' or 'float16'.
+    '''
+    ckpt = load_checkpoint(ckpt_path)
+    arg, n_poi = ckpt['args'], ckpt['n_poi']
+    Seq_encoder, Geo_encoder, Poi_embeds, Predictor = load_modules(ckpt, dist_edges, dist_vec)
+
+    os.makedirs(out_dir, exist_ok=True)
+    with torch.no_grad():
+        write_table(osp.join(out_dir, 'poi_embeds.bin'), Poi_embeds.weight, dtype)
+        write_table(osp.join(out_dir, 'poi_enc.bin'), Geo_encoder.encode(Poi_embeds), dtype)
+
+    torch.save({
+        'args': vars(arg),
+        'n_poi': n_poi,
+        'seq_encoder': Seq_encoder.state_dict(),
+        'geo_encoder': Geo_encoder.state_dict(),
+        'predictor': Predictor.state_dict(),
+    }, osp.join(out_dir, ENCODER_FILE))
+
+    with open(osp.join(out_dir, TABLE_META), 'w') as f:
+        json.dump({
+            'n_poi': n_poi,
+            'embed_dim': arg.embed,
+            'dtype': dtype,
+            'tables': {'poi_embeds': 'poi_embeds.bin', 'poi_enc': 'poi_enc.bin'},
+        }, f, indent=2)
+
+
+def make_batch(samples, device='cpu', history=None):
+    '''Collate (uid, poi, seq, coord, y) samples into a Batch, as MyDataset does for the pickled splits,
+       with the histories bounded by the HistoryPolicy of the model.'''
+    if history:
+        samples = [(uid, poi, history(seq), coord, y) for uid, poi, seq, coord, y in samples]
+    return Batch.from_data_list([seq_to_graph(*sample) for sample in samples]).to(device)
+
+
+class ServingModel:
+    '''Inference-only model reading the POI tables exported by export_tables through memory maps.
+
+    Args:
+        table_dir (str): Directory written by export_tables.
+        device (torch.device): Device of the encoders and predictor.
+
+    The batches are built by make_batch(samples, history=model.history), the history policy of the
+    checkpoint.
+    '''
+
+    def __init__(self, table_dir, device='cpu'):
+        with open(osp.join(table_dir, TABLE_META)) as f:
+            meta = json.load(f)
+        self.n_poi, self.embed_dim = meta['n_poi'], meta['embed_dim']
+        self.device = device
+
+        tables = {name: MmapTable(osp.join(table_dir, file), self.n_poi, self.embed_dim, meta['dtype'])
+                  for name, file in meta['tables'].items()}
+        self.poi_embeds = MmapEmbeddingLayer(tables['poi_embeds'])
+        self.poi_enc = tables['poi_enc']
+
+        ckpt = load_checkpoint(osp.join(table_dir, ENCODER_FILE))
+        self.arg = ckpt['args']
+        self.history = HistoryPolicy.from_arg(self.arg)
+        # the encodings are precomputed, so the GeoGraph does not need the distance graph
+        self.Seq_encoder, self.Geo_encoder, self.Predictor = build_encoders(
+            self.arg, self.n_poi, None, None, device)
+        self.Seq_encoder.load_state_dict(ckpt['seq_encoder'])
+        self.Geo_encoder.load_state_dict(ckpt['geo_encoder'])
+        self.Predictor.load_state_dict(ckpt['predictor'])
+        self.Seq_encoder.eval()
+        self.Geo_encoder.eval()
+        self.Predictor.eval()
+
+    def encode(self, batch):
+        '''Return the user representations e_g, e_s and the target encodings h_t of a batch, each sample
+           independently of the others (see GeoGraph.forward per_sample).'''
+        with torch.no_grad():
+            e_s = self.Seq_encoder(batch, self.poi_embeds)
+            e_g, h_t = self.Geo_encoder(batch, None, poi_enc=self.poi_enc, per_sample=True)
+        return e_g, e_s, h_t.to(e_g.device)
+
+    def score(self, batch):
+        '''Return the probability of visiting the target POI for each sample in the batch.'''
+        e_g, e_s, h_t = self.encode(batch)
+        with torch.no_grad():
+            return torch.sigmoid(self.Predictor(e_g, e_s, h_t)).squeeze(-1)
+
+
+if __name__ == '__main__':
+    ARG = argparse.ArgumentParser()
+    ARG.add_argument('--ckpt', type=str, required=True,
+                     help='Checkpoint written by main.py --ckpt.')
+    ARG.add_argument('--data', type=str, default='nyc',
+                     help='Dataset of the checkpoint. nyc or tky.')
+    ARG.add_argument('--out', type=str, required=True,
+                     help='Output directory of the exported tables.')
+    ARG.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'],
+                     help='Element type of the exported tables.')
+    ARG = ARG.parse_args()
+
+    dist_edges, dist_vec = load_dist_graph(f'./processed_data/{ARG.data}')
+
+    export_tables(ARG.ckpt, dist_edges, dist_vec, ARG.out, ARG.dtype)
+    print(f'Tables exported to {ARG.out}')
@@ -0,0 +1,180 @@
+import argparse
+import copy
+import csv
+import itertools
+import logging
+import os
+import random
+import time
+import torch
+import torch.multiprocessing as mp
+from dataset import share_memory
+from evaluation import Evaluator
+from trainer import (Variant, build_parser, load_data, make_loaders, make_resampler, rng_state, set_rng_state,
+                     set_seed, setup_logging, train_epoch)
+
+
+SWEEP = argparse.ArgumentParser(
+    description='Hyperparameter sweep with successive halving. The datasets are loaded once and shared '
+                'with a pool of worker processes. Other arguments are passed to every trial, see main.py --help.')
+SWEEP.add_argument('--space', type=str, nargs='+', required=True,
+                   help='Values of each swept argument, e.g. embed=32,64 gcn_num=1,2,3 con_weight=0.01,0.1')
+SWEEP.add_argument('--n_trials', type=int, default=0,
+                   help='Num of configurations sampled from the grid, 0 runs the whole grid.')
+SWEEP.add_argument('--processes', type=int, default=4,
+                   help='Num of worker processes.')
+SWEEP.add_argument('--threads', type=int, default=1,
+                   help='Num of intra-op threads of each worker.')
+SWEEP.add_argument('--min_epochs', type=int, default=1,
+                   help='Epoch budget of the first rung of successive halving.')
+SWEEP.add_argument('--max_epochs', type=int, default=27,
+                   help='Epoch budget of the last rung.')
+SWEEP.add_argument('--eta', type=int, default=3,
+                   help='Only the best 1/eta trials of a rung are promoted to the next one.')
+SWEEP.add_argument('--out_dir', type=str, default='./sweep',
+                   help='Directory of the trial states and the result table.')
+
+SWEEP, TRAIN_ARGS = SWEEP.parse_known_args()
+
+# (n_user, n_poi, train_set, val_set, test_set, dist_edges, dist_vec), set in every worker
+DATA = None
+
+# arguments of the data, which is loaded once with the base arguments, so they cannot be swept
+DATA_ARGS = ('data', 'train_percentage', 'history_last', 'history_unique', 'history_window')
+
+
+def parse_space(space):
+    '''Map "name=v1,v2" strings to (name, [v1, v2]).'''
+    names, values = [], []
+    for item in space:
+        name, vals = item.split('=', 1)
+        names.append(name)
+        values.append(vals.split(','))
+    return names, values
+
+
+def halving_budgets(min_epochs, max_epochs, eta):
+    budgets = []
+    budget = min_epochs
+    while budget < max_epochs:
+        budgets.append(budget)
+        budget *= eta
+    budgets.append(max_epochs)
+    return budgets
+
+
+def init_worker(data, threads):
+    global DATA
+    DATA = data
+    torch.set_num_threads(threads)
+    # the log file handler is inherited from the parent, only the parent writes to it
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def own_negatives(dataset):
+    '''Shallow copy of a dataset with its own POIs and coordinates, which a NegativeResampler redraws in
+       place: the storage of DATA is shared by all the trials.'''
+    dataset = copy.copy(dataset)
+    dataset._data = copy.copy(dataset._data)
+    dataset._data.poi, dataset._data.coord = dataset._data.poi.clone(), dataset._data.coord.clone()
+    dataset._data_list = None
+    return dataset
+
+
+def run_trial(trial_id, argv, epochs, state_path):
+    '''Train a trial up to `epochs` epochs, resuming from its state of the previous rung, random generators
+       included, so a promoted trial goes on as if it had never stopped.'''
+    arg = build_parser().parse_args(argv)
+    n_user, n_poi, train_set, val_set, test_set, dist_edges, dist_vec = DATA
+    device = torch.device('cpu')
+    set_seed(arg.seed)
+
+    variant = Variant(arg.variants[0], arg, n_poi, dist_edges, dist_vec, device)
+    done = 0
+    if os.path.exists(state_path):
+        state = torch.load(state_path)
+        variant.load_state_dict(state['variant'])
+        set_rng_state(state['rng'])
+        done = state['epochs']
+
+    resampler = None
+    if arg.resample_negatives:
+        train_set = own_negatives(train_set)
+        resampler = make_resampler(train_set, arg, dist_edges)
+    train_loader, bank_loader, samplers = make_loaders(train_set, arg)
+    val_evaluator = Evaluator(val_set, arg, device)
+
+    start = time.perf_counter()
+    for epoch in range(done, epochs):
+        train_epoch([variant], train_loader, bank_loader, samplers, epoch, arg, device, resampler)
+        auc, _ = val_evaluator(variant.model)
+        if auc > variant.best_auc:
+            variant.best_auc, variant.best_epoch = auc, epoch
+
+    torch.save({'variant': variant.state_dict(), 'epochs': epochs, 'rng': rng_state()}, state_path)
+    return {'trial': trial_id, 'epochs': epochs, 'val_auc': variant.best_auc,
+            'best_epoch': variant.best_epoch + 1, 'time': time.perf_counter() - start}
+
+
+if __name__ == '__main__':
+    base_arg = build_parser().parse_args(TRAIN_ARGS)
+    set_seed(base_arg.seed)
+    setup_logging()
+    os.makedirs(SWEEP.out_dir, exist_ok=True)
+
+    names, values = parse_space(SWEEP.space)
+    swept_data = [name for name in names if name in DATA_ARGS]
+    if swept_data:
+        raise ValueError(f'--space cannot sweep {", ".join(swept_data)}: the data are loaded once for all the '
+                         'trials. Run one sweep per value instead.')
+    configs = list(itertools.product(*values))
+    if 0 < SWEEP.n_trials < len(configs):
+        configs = random.sample(configs, SWEEP.n_trials)
+    argvs = [TRAIN_ARGS + [arg for name, value in zip(names, config) for arg in (f'--{name}', value)]
+             for config in configs]
+    for argv in argvs:
+        # fail early on a bad name or value
+        build_parser().parse_args(argv)
+    logging.info(f'Sweep: {SWEEP}, base arguments: {base_arg}')
+    logging.info(f'{len(configs)} trials')
+
+    # the datasets are loaded once and shared with the workers
+    data = load_data(base_arg)
+    for dataset in data[2:5]:
+        share_memory(dataset)
+    logging.info('Data loaded.')
+
+    results = {}
+    survivors = list(range(len(configs)))
+    budgets = halving_budgets(SWEEP.min_epochs, SWEEP.max_epochs, SWEEP.eta)
+    ctx = mp.get_context('fork')
+    with ctx.Pool(SWEEP.processes, initializer=init_worker, initargs=(data, SWEEP.threads)) as pool:
+        for rung, budget in enumerate(budgets):
+            tasks = [(t, argvs[t], budget, os.path.join(SWEEP.out_dir, f'trial_{t}.pt')) for t in survivors]
+            for result in pool.starmap(run_trial, tasks):
+                t = result['trial']
+                result['time'] += results.get(t, {}).get('time', 0.)
+                results[t] = result
+                logging.info(f'Rung {rung + 1} / {len(budgets)}, trial {t} {dict(zip(names, configs[t]))}: '
+                             f'validation AUC {result["val_auc"]} after {budget} epochs')
+
+            if rung < len(budgets) - 1:
+                survivors.sort(key=lambda t: results[t]['val_auc'], reverse=True)
+                survivors = survivors[:max(1, len(survivors) // SWEEP.eta)]
+                logging.info(f'Promoted trials: {survivors}')
+
+    # one table with the last rung reached by every trial
+    rows = sorted(results.values(), key=lambda r: (r['epochs'], r['val_auc']), reverse=True)
+    fields = ['trial'] + names + ['epochs', 'val_auc', 'best_epoch', 'time']
+    with open(os.path.join(SWEEP.out_dir, 'results.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for r in rows:
+            writer.writerow([r['trial'], *configs[r['trial']], r['epochs'], r['val_auc'], r['best_epoch'],
+                             f'{r["time"]:.1f}'])
+
+    print(''.join(f'{field:>12}' for field in fields))
+    for r in rows:
+        print(''.join(f'{str(v):>12}' for v in [r['trial'], *configs[r['trial']], r['epochs']]) +
+              f'{r["val_auc"]:>12.5f}{r["best_epoch"]:>12}{r["time"]:>12.1f}')
+    logging.info(f'Results written to {os.path.join(SWEEP.out_dir, "results.csv")}')
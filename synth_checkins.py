@@ -0,0 +1,157 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+
+ARG = argparse.ArgumentParser(
+    description='Generate a synthetic check-in file in the column layout of dataset_TSMC2014_*.txt.')
+ARG.add_argument('--out', type=str, default='./dataset_synth/dataset_TSMC2014_SYNTH.txt',
+                 help='Path of the generated TSV file.')
+ARG.add_argument('--users', type=int, default=10000,
+                 help='Num of users.')
+ARG.add_argument('--pois', type=int, default=40000,
+                 help='Num of POIs.')
+ARG.add_argument('--clusters', type=int, default=200,
+                 help='Num of spatial clusters (neighbourhoods) of POIs.')
+ARG.add_argument('--cluster_std', type=float, default=0.3,
+                 help='Standard deviation in km of the POIs around their cluster centre.')
+ARG.add_argument('--extent', type=float, default=20.,
+                 help='Radius in km of the area of the cluster centres.')
+ARG.add_argument('--center', type=float, nargs=2, default=[40.73, -73.99], metavar=('LAT', 'LON'),
+                 help='Centre of the city.')
+ARG.add_argument('--hist_mean', type=float, default=50.,
+                 help='Mean num of check-ins per user.')
+ARG.add_argument('--hist_sigma', type=float, default=0.8,
+                 help='Sigma of the log-normal distribution of the num of check-ins per user.')
+ARG.add_argument('--min_hist', type=int, default=3,
+                 help='Min num of check-ins per user, preprocess.py needs at least 3.')
+ARG.add_argument('--max_hist', type=int, default=2000,
+                 help='Max num of check-ins per user.')
+ARG.add_argument('--revisit', type=float, default=0.4,
+                 help='Probability that a check-in copies an earlier check-in of the user. Draws of new POIs '
+                      'can also hit visited POIs, so the observed revisit rate is higher.')
+ARG.add_argument('--locality', type=float, default=0.8,
+                 help='Probability that a new POI is drawn from the home cluster of the user.')
+ARG.add_argument('--pop_alpha', type=float, default=1.0,
+                 help='Exponent of the Zipf popularity of the POIs.')
+ARG.add_argument('--categories', type=int, default=250,
+                 help='Num of venue categories.')
+ARG.add_argument('--seed', type=int, default=42,
+                 help='Random seed.')
+
+KM_PER_DEG = 111.2
+
+
+def categorical(rng, cum, groups, size):
+    '''Draw from the categorical distribution of each group. cum[i] is the group of item i plus the
+       cumulative probability of the items of its group up to i, so draws are a single searchsorted.'''
+    idx = np.searchsorted(cum, groups + rng.random(size), side='right')
+    return np.minimum(idx, len(cum) - 1)
+
+
+def hex_ids(rng, n):
+    '''n random ids of 24 hex digits, like the venue and category ids of Foursquare.'''
+    digits = rng.bytes(12 * n).hex()
+    return np.array([digits[24 * i:24 * (i + 1)] for i in range(n)])
+
+
+def generate(arg):
+    '''Generate the check-ins, sorted by time as in the TSMC2014 files.
+
+    POIs are scattered around cluster centres with Zipf popularity. Each user has a home cluster and a
+    log-normal num of check-ins. A check-in revisits a previous check-in of the user with probability
+    --revisit, otherwise it is a POI of the home cluster (--locality) or of the whole city, by popularity.
+
+    Returns:
+        pd.DataFrame: The check-ins in the column layout of the TSMC2014 files.
+    '''
+    rng = np.random.default_rng(arg.seed)
+    lat0, lon0 = arg.center
+    km_lon = KM_PER_DEG * np.cos(np.radians(lat0))
+
+    # cluster centres uniform in a disk, cluster sizes log-normal
+    r = arg.extent * np.sqrt(rng.random(arg.clusters))
+    theta = 2 * np.pi * rng.random(arg.clusters)
+    centers = np.stack((lat0 + r * np.sin(theta) / KM_PER_DEG, lon0 + r * np.cos(theta) / km_lon), axis=1)
+    cluster_weight = rng.lognormal(0., 1., arg.clusters)
+
+    # POIs sorted by cluster, with Zipf popularity
+    poi_cluster = np.sort(rng.choice(arg.clusters, arg.pois, p=cluster_weight / cluster_weight.sum()))
+    noise = rng.normal(0., arg.cluster_std, size=(arg.pois, 2))
+    poi_lat = centers[poi_cluster, 0] + noise[:, 0] / KM_PER_DEG
+    poi_lon = centers[poi_cluster, 1] + noise[:, 1] / km_lon
+    popularity = 1. / rng.permutation(np.arange(1, arg.pois + 1)) ** arg.pop_alpha
+
+    # cumulative popularity within each cluster, and over all the POIs
+    cluster_sum = np.bincount(poi_cluster, popularity, minlength=arg.clusters)
+    cluster_start = np.concatenate(([0.], np.cumsum(cluster_sum)))[poi_cluster]
+    within = (np.cumsum(popularity) - cluster_start) / cluster_sum[poi_cluster]
+    within[np.append(poi_cluster[1:] != poi_cluster[:-1], True)] = 1.
+    cluster_cum = poi_cluster + within
+    global_cum = np.cumsum(popularity) / popularity.sum()
+    global_cum[-1] = 1.
+
+    # home cluster and history length of each user, homes follow the POIs
+    home = poi_cluster[rng.integers(0, arg.pois, arg.users)]
+    mu = np.log(arg.hist_mean) - arg.hist_sigma ** 2 / 2
+    lengths = np.clip(rng.lognormal(mu, arg.hist_sigma, arg.users).astype(np.int64), arg.min_hist, arg.max_hist)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    n = int(offsets[-1])
+    user = np.repeat(np.arange(arg.users), lengths)
+    pos = np.arange(n) - offsets[user]
+
+    # new POIs, from the home cluster or from the whole city
+    local = rng.random(n) < arg.locality
+    poi = np.empty(n, dtype=np.int64)
+    poi[local] = categorical(rng, cluster_cum, home[user[local]], int(local.sum()))
+    poi[~local] = categorical(rng, global_cum, np.zeros((~local).sum()), int((~local).sum()))
+
+    # a revisit copies a uniformly chosen earlier check-in of the user, the copies are resolved by
+    # pointer jumping since every source is earlier than its check-in
+    revisit = (rng.random(n) < arg.revisit) & (pos > 0)
+    src = np.arange(n)
+    src[revisit] = offsets[user[revisit]] + (rng.random(int(revisit.sum())) * pos[revisit]).astype(np.int64)
+    while True:
+        nxt = src[src]
+        if np.array_equal(nxt, src):
+            break
+        src = nxt
+    poi = poi[src]
+
+    # timestamps: users start within the first half of the period, check-ins every ~day
+    start = pd.Timestamp('2012-04-03').value // 10 ** 9
+    user_start = start + rng.integers(0, 150 * 86400, arg.users)
+    gaps = rng.exponential(86400., n).astype(np.int64) + 60
+    gaps[offsets[:-1]] = 0
+    seconds = user_start[user] + np.cumsum(gaps) - np.cumsum(gaps)[offsets[:-1]][user]
+    order = np.argsort(seconds, kind='stable')
+
+    # venue ids and categories in the TSMC2014 format
+    venue_ids, cat_ids = hex_ids(rng, arg.pois), hex_ids(rng, arg.categories)
+    poi_cat = rng.integers(0, arg.categories, arg.pois)
+
+    poi, user, seconds = poi[order], user[order], seconds[order]
+    times = pd.to_datetime(seconds, unit='s').strftime('%a %b %d %H:%M:%S +0000 %Y')
+    return pd.DataFrame({
+        'uid': user + 1,
+        'poi': venue_ids[poi],
+        'cat_id': cat_ids[poi_cat[poi]],
+        'cat_name': np.char.add('Category ', poi_cat[poi].astype(str)),
+        'latitude': poi_lat[poi],
+        'longitude': poi_lon[poi],
+        'offset': -240,
+        'time': times,
+    })
+
+
+def write_tsv(data, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    data.to_csv(path, sep='\t', header=False, index=False)
+
+
+if __name__ == '__main__':
+    arg = ARG.parse_args()
+    data = generate(arg)
+    write_tsv(data, arg.out)
+    print(f'{len(data)} check-ins of {arg.users} users at {data["poi"].nunique()} POIs written to {arg.out}')
@@ -0,0 +1,122 @@
+import contextlib
+import functools
+import time
+from collections import defaultdict, deque
+import numpy as np
+import torch
+
+
+class StageTimer:
+    '''Named timing regions of the training step, with rolling latency percentiles.
+
+    The timer is disabled by default and region() is then a no-op. Regions are only recorded within a step,
+    between begin_step() and end_step(); regions of the same name add up within a step (e.g. over the variants).
+    The time of the step not covered by any region is reported as "other". Every region is also a
+    torch.profiler.record_function range, so the stages are named in profiler traces.
+
+    Args:
+        window (int): Num of recent steps of the percentiles.
+    '''
+
+    def __init__(self, window=200):
+        self.enabled = False
+        self.sync = False
+        self.window = window
+        self.history = defaultdict(lambda: deque(maxlen=self.window))
+        self.samples = deque(maxlen=window)
+        self.n_steps = 0
+        self.current = None
+        self.step_start = 0.
+        self.profiler = None
+        self.trace_start, self.trace_steps, self.trace_path = 0, 0, None
+
+    def enable(self, sync=False, window=200):
+        '''Start recording. With sync, CUDA is synchronised at the region boundaries, so that the
+           asynchronous kernels are attributed to the region that launched them.'''
+        self.enabled, self.sync, self.window = True, sync, window
+        self.samples = deque(maxlen=window)
+
+    def trace(self, path, start, n_steps):
+        '''Capture a torch.profiler Chrome trace of steps [start, start + n_steps) to path.'''
+        self.enabled = True
+        self.trace_path, self.trace_start, self.trace_steps = path, start, n_steps
+
+    def _sync(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def _region(self, name):
+        with torch.profiler.record_function(name):
+            self._sync()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._sync()
+                self.current[name] += time.perf_counter() - start
+
+    def region(self, name):
+        if self.current is None:
+            return contextlib.nullcontext()
+        return self._region(name)
+
+    def begin_step(self):
+        if not self.enabled:
+            return
+        if self.trace_path is not None and self.n_steps == self.trace_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.__enter__()
+        self._sync()
+        self.current = defaultdict(float)
+        self.step_start = time.perf_counter()
+
+    def end_step(self, n_samples):
+        if self.current is None:
+            return
+        self._sync()
+        total = time.perf_counter() - self.step_start
+        for name, seconds in self.current.items():
+            self.history[name].append(seconds)
+        self.history['other'].append(total - sum(self.current.values()))
+        self.history['step'].append(total)
+        self.samples.append(n_samples)
+        self.current = None
+        self.n_steps += 1
+
+        if self.profiler is not None and self.n_steps == self.trace_start + self.trace_steps:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(self.trace_path)
+            self.profiler = None
+
+    def summary(self):
+        '''p50/p90/p99 latency of every stage in ms over the window, and the throughput in samples/sec.'''
+        stages = {}
+        for name, values in self.history.items():
+            p50, p90, p99 = np.percentile(np.array(values) * 1e3, [50, 90, 99])
+            stages[name] = {'p50': p50, 'p90': p90, 'p99': p99}
+        steps = list(self.history['step'])[-len(self.samples):]
+        samples_per_sec = sum(self.samples) / sum(steps) if steps else 0.
+        return {'step': self.n_steps, 'samples_per_sec': samples_per_sec, 'stages': stages}
+
+
+TIMER = StageTimer()
+
+
+def region(name):
+    '''Time the enclosed code as the stage `name` of the current step, see StageTimer.'''
+    return TIMER.region(name)
+
+
+def timed(name):
+    '''Decorator timing every call of a function as the stage `name`.'''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with TIMER.region(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
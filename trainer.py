@@ -0,0 +1,799 @@
+import os
+import torch
+import random
+import argparse
+import logging
+import pickle
+import json
+import queue
+import time
+import torch.multiprocessing as mp
+from dataset import MyDataset, NegativeResampler, Prefetcher, load_dist_graph, make_loader, static_inputs
+from torch.utils.data.distributed import DistributedSampler
+import numpy as np
+from consistency import ConsistencyLoss
+import torch.nn as nn
+from datetime import datetime
+from distributed import (allreduce_grads, barrier, broadcast_module, broadcast_object, init_distributed,
+                         is_distributed, is_main_process)
+from evaluation import Evaluator, eval_ranking
+from history import HistoryPolicy
+from misc import QuantizedEmbeddingLayer, autocast
+from model import KBGNN, VARIANTS, save_checkpoint
+from timing import TIMER, region
+
+
+BEST_STATS = ('best_auc', 'best_epoch', 'test_auc', 'test_loss', 'rank_results', 'quant_results',
+              'precision_results')
+
+
+def build_parser(variants=('full',)):
+    '''Arguments of the training scripts. `variants` is the default of --variants.'''
+    ARG = argparse.ArgumentParser()
+    ARG.add_argument('--epoch', type=int, default=100,
+                     help='Max epoch num.')
+    ARG.add_argument('--seed', type=int, default=42,
+                     help='Random seed.')
+    ARG.add_argument('--batch', type=int, default=128,
+                     help='Training batch size.')
+    ARG.add_argument('--eval_batch', type=int, default=1024,
+                     help='Evaluation batch size.')
+    ARG.add_argument('--data', type=str, default='nyc',
+                     help='Training dataset. nyc or tky.')
+    ARG.add_argument('--gpu', type=int, default=None,
+                     help='Denote training device. GPU is denoted by the index (e.g., 0, 1).')
+    ARG.add_argument('--patience', type=int, default=10,
+                     help='Early stopping patience.')
+    ARG.add_argument('--embed', type=int, default=64,
+                     help='Embedding dimension.')
+    ARG.add_argument('--gcn_num', type=int, default=2,
+                     help='Num of GCN.')
+    ARG.add_argument('--max_step', type=int, default=2,
+                     help='Steps of random walk.')
+    ARG.add_argument('--hid_graph_num', type=int, default=16,
+                     help='Num of hidden graphs.')
+    ARG.add_argument('--hid_graph_size', type=int, default=10,
+                     help='Size of hidden graphs')
+    ARG.add_argument('--lr', type=float, default=1e-3,
+                     help='Learning rate.')
+    ARG.add_argument('--con_weight', type=float, default=0.01,
+                     help='Weight of consistency loss')
+    ARG.add_argument('--compress_memory_size', type=int, default=12800,
+                     help='Memory bank size')
+    ARG.add_argument('--compress_t', type=float, default=0.01,
+                     help='Softmax temperature')
+    ARG.add_argument('--train_percentage', type=float, default=1,
+                     help='Percentage used of training set')
+    ARG.add_argument('--num_heads', type=int, default=1,
+                     help='Num of heads in multi-head attention')
+    ARG.add_argument('--variants', type=str, nargs='+', default=list(variants), choices=list(VARIANTS),
+                     help='Model variants trained side by side on the same batches: '
+                          'full, geo (without the sequential component) or seq (without the geographical component).')
+    ARG.add_argument('--ddp', action='store_true',
+                     help='Distributed data-parallel training on CPU over gloo, launch with torchrun. '
+                          '--batch is the batch size of each process.')
+    ARG.add_argument('--threads', type=int, default=None,
+                     help='Num of intra-op threads of each process.')
+    ARG.add_argument('--poi_embed', type=str, default='dense', choices=['dense', 'qr'],
+                     help='POI embedding table. dense or qr (quotient-remainder compositional).')
+    ARG.add_argument('--qr_buckets', type=int, default=1024,
+                     help='Num of remainder buckets of the qr embedding.')
+    ARG.add_argument('--ckpt', type=str, default=None,
+                     help='Path to save the checkpoint of the best model. '
+                          'With several variants the variant name is appended to the file name.')
+    ARG.add_argument('--rank_eval', action='store_true',
+                     help='Also evaluate the best model on the test set with ranking metrics.')
+    ARG.add_argument('--topk', type=int, nargs='+', default=[1, 5, 10, 20],
+                     help='Cut-offs of Recall@K and NDCG@K.')
+    ARG.add_argument('--rank_candidates', type=int, default=0,
+                     help='Num of candidates per user in ranking evaluation, distinct POIs other than the visited one '
+                          'drawn uniformly. 0 ranks the whole catalogue.')
+    ARG.add_argument('--rank_block', type=int, default=2048,
+                     help='Num of candidates scored at a time in ranking evaluation.')
+    ARG.add_argument('--quant_eval', type=str, nargs='*', default=[], choices=['int8', 'fp16'],
+                     help='Also evaluate the best model on the test set with quantised POI embeddings.')
+    ARG.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                     help='Precision of training and evaluation. bf16 autocasts the matmuls, the softmax/KL of the '
+                          'consistency loss, the normalisation of GeoGraph and the BatchNorm of SeqGraph stay fp32.')
+    ARG.add_argument('--checkpoint_gcn', action='store_true',
+                     help='Recompute the activations of the GCN layers of GeoGraph in backward instead of keeping '
+                          'them, less peak memory for more time, see bench_checkpoint.py.')
+    ARG.add_argument('--static_shapes', type=str, nargs='?', const='eager', default=None,
+                     choices=['eager', 'compile'],
+                     help='Pad the training batches to bucketed shapes and run the static-shape forward of the '
+                          'encoders and predictor, see dataset.static_inputs. With compile it is torch.compiled, '
+                          'into one graph per bucket.')
+    ARG.add_argument('--precision_eval', type=str, nargs='*', default=[], choices=['bf16', 'int8'],
+                     help='Also evaluate the best model on the test set in bf16 autocast or with int8 dynamic '
+                          'quantised Linear layers (CPU), with the AUC change and the speedup over fp32.')
+    ARG.add_argument('--prefetch', type=int, default=2,
+                     help='Num of training steps whose batches are collated, padded and copied to the device ahead '
+                          'by a background thread, on CUDA into pinned memory with non-blocking transfers. '
+                          '0 loads the batches of each step at its start.')
+    ARG.add_argument('--loader_workers', type=int, default=0,
+                     help='Num of worker processes of each training loader. They draw their seeds from the '
+                          'random generator, so the batches differ from those of 0 workers.')
+    ARG.add_argument('--resample_negatives', action='store_true',
+                     help='Redraw the negative training samples at the start of every epoch, see '
+                          'dataset.NegativeResampler, instead of keeping those of preprocess.py.')
+    ARG.add_argument('--neg_sampler', type=str, default='uniform', choices=['uniform', 'popularity'],
+                     help='Distribution of the redrawn negatives, uniform or by num of check-ins.')
+    ARG.add_argument('--hard_negatives', type=float, default=0.,
+                     help='Share of the redrawn negatives drawn among the neighbors of the positive POI '
+                          'in the distance graph.')
+    ARG.add_argument('--history_last', type=int, default=0,
+                     help='Max num of check-ins in the history of a sample, the most recent are kept, '
+                          'see history.HistoryPolicy. Saved in the checkpoint and applied at inference. '
+                          '0 keeps them all.')
+    ARG.add_argument('--history_unique', type=int, default=0,
+                     help='Max num of distinct POIs in the history of a sample, the most recent are kept. '
+                          '0 keeps them all.')
+    ARG.add_argument('--timing', action='store_true',
+                     help='Time the stages of the training steps and log their latency percentiles.')
+    ARG.add_argument('--timing_every', type=int, default=100,
+                     help='Num of steps between timing reports, which cover the last --timing_window steps.')
+    ARG.add_argument('--timing_window', type=int, default=200,
+                     help='Num of recent steps of the timing percentiles.')
+    ARG.add_argument('--timing_file', type=str, default=None,
+                     help='Also append the timing reports to this JSON-lines file.')
+    ARG.add_argument('--trace', type=str, default=None,
+                     help='Path to save a torch.profiler Chrome trace of --trace_steps training steps.')
+    ARG.add_argument('--trace_steps', type=int, nargs=2, default=[10, 5], metavar=('START', 'N'),
+                     help='Trace N steps from step START (counted over all epochs).')
+    ARG.add_argument('--async_eval', action='store_true',
+                     help='Evaluate the snapshot of each epoch in a background process while training goes on. '
+                          'Early stopping then acts up to one epoch late.')
+    ARG.add_argument('--eval_threads', type=int, default=1,
+                     help='Num of intra-op threads of the background evaluation process.')
+    ARG.add_argument('--state', type=str, default=None,
+                     help='Path to save the training state (weights, optimizer, memory bank, early stopping) '
+                          'after the evaluation of every epoch.')
+    ARG.add_argument('--resume', type=str, default=None,
+                     help='Resume training from a state saved with --state.')
+    return ARG
+
+
+def set_seed(seed):
+    random.seed(seed)
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+
+
+def data_history(arg, root):
+    '''The history policy of a run: the tightest of --history_last/--history_unique and of the bounds the
+       data were preprocessed with (from raw/state.pkl). The combined bounds are written back to arg, so
+       that the checkpoint carries the bounds the model was trained with.'''
+    history = HistoryPolicy.from_arg(arg)
+    path = f'{root}/raw/state.pkl'
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            preprocessed = HistoryPolicy.from_dict(pickle.load(f).get('history', {}))
+        if preprocessed.window > 0:
+            logging.warning(f'The data were preprocessed with a history window of {preprocessed.window:g} hours, '
+                            'which inference cannot apply: the requests carry no check-in times.')
+        history = history.tightest(preprocessed)
+    arg.history_last, arg.history_unique = history.last, history.unique
+    return HistoryPolicy(history.last, history.unique)
+
+
+def load_data(arg):
+    '''Load the dataset info, the three splits and the distance graph of arg.data. The histories of the
+       splits are bounded by data_history, which also updates arg.
+
+    Returns:
+        tuple: (n_user, n_poi, train_set, val_set, test_set, dist_edges, dist_vec)
+    '''
+    root = f'./processed_data/{arg.data}'
+    with open(f'{root}/raw/info.pkl', 'rb') as f:
+        n_user, n_poi = pickle.load(f)
+
+    history = data_history(arg, root)
+    train_set = MyDataset(root, set='train', history=history)
+    train_set = train_set[:int(len(train_set) * arg.train_percentage)]
+    test_set = MyDataset(root, set='test', history=history)
+    val_set = MyDataset(root, set='val', history=history)
+
+    dist_edges, dist_vec = load_dist_graph(root)
+
+    return n_user, n_poi, train_set, val_set, test_set, dist_edges, dist_vec
+
+
+class Variant:
+    '''A model variant with its own optimizer, consistency loss and early stopping state.
+
+    Args:
+        name (str): Key of model.VARIANTS.
+        arg (argparse.Namespace): Hyperparameters.
+        n_poi (int): Number of POI.
+        dist_edges (torch.Tensor): Edges of the distance graph, size (2, num_edges).
+        dist_vec (np.ndarray): Distance of the edges, size (num_edges,).
+        device (torch.device): Training device.
+    '''
+
+    def __init__(self, name, arg, n_poi, dist_edges, dist_vec, device):
+        config = VARIANTS[name]
+        self.name = name
+        self.model = KBGNN(arg, n_poi, dist_edges, dist_vec,
+                           config['use_seq'], config['use_geo']).to(device)
+        self.sim_criterion = None
+        if config['use_con']:
+            self.sim_criterion = ConsistencyLoss(
+                arg.embed, arg.compress_memory_size, arg.compress_t, device).to(device)
+        if is_distributed():
+            # all the ranks start from the weights and memory bank of rank 0
+            broadcast_module(self.model)
+            if self.sim_criterion is not None:
+                broadcast_module(self.sim_criterion)
+        self.opt = torch.optim.Adam(self.model.parameters(), lr=arg.lr)
+        self.criterion = nn.BCEWithLogitsLoss()
+
+        self.forward_static = self.model.forward_static
+        self.bank_static = self.model.bank_embeds_static
+        if arg.static_shapes == 'compile':
+            # one graph per bucket, without dynamic shapes
+            torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, 64)
+            self.forward_static = torch.compile(self.forward_static, dynamic=False)
+            self.bank_static = torch.compile(self.bank_static, dynamic=False)
+
+        self.best_auc, self.best_epoch = 0.0, 0
+        self.test_auc, self.test_loss = 0.0, 0.0
+        self.quant_results, self.rank_results, self.precision_results = {}, {}, {}
+        self.stopped = False
+
+    def train_step(self, trn_batch, bnk_batch, arg, static=None):
+        '''One optimisation step, returns the total, recommendation and consistency (or None) losses.
+           static is the static_inputs of both batches with --static_shapes, built here if None.'''
+        model = self.model
+        label = trn_batch.y.float()
+        if arg.static_shapes and static is None:
+            static = static_inputs(trn_batch, arg.batch), static_inputs(bnk_batch, arg.batch)
+
+        with autocast(arg.precision, label.device):
+            # the GCN layers run once and are shared by the training and the memory bank batch
+            poi_enc = model.encode_pois()
+
+            if arg.static_shapes:
+                pred = self.forward_static(static[0], poi_enc)[:trn_batch.num_graphs]
+            else:
+                pred = model(trn_batch, poi_enc)
+            loss_rec = self.criterion(pred.squeeze().float(), label)
+
+            loss, unsup_loss = loss_rec, None
+            if self.sim_criterion is not None:
+                if arg.static_shapes:
+                    seq_bnk_enc, geo_bnk_enc = self.bank_static(static[1], poi_enc)
+                    seq_bnk_enc = seq_bnk_enc[:bnk_batch.num_graphs]
+                    geo_bnk_enc = geo_bnk_enc[:bnk_batch.num_graphs]
+                else:
+                    seq_bnk_enc = model.seq_encoder(bnk_batch, model.poi_embeds)
+                    geo_bnk_enc, _ = model.geo_encoder(bnk_batch, model.poi_embeds, poi_enc=poi_enc)
+                unsup_loss = self.sim_criterion(seq_bnk_enc, geo_bnk_enc)
+                loss = loss_rec + arg.con_weight * unsup_loss
+
+        self.opt.zero_grad()
+        with region('backward'):
+            loss.backward()
+        if is_distributed():
+            with region('allreduce'):
+                allreduce_grads(self.model.parameters())
+        with region('optimizer'):
+            self.opt.step()
+
+        return loss, loss_rec, unsup_loss
+
+    def best_stats(self):
+        '''Validation and test results of the best epoch.'''
+        return {name: getattr(self, name) for name in BEST_STATS}
+
+    def state_dict(self):
+        '''Everything needed to resume training: weights, optimizer, memory bank and early stopping state.'''
+        state = {
+            'model': self.model.state_dict(),
+            'opt': self.opt.state_dict(),
+            'stopped': self.stopped,
+            **self.best_stats(),
+        }
+        if self.sim_criterion is not None:
+            state['sim_criterion'] = self.sim_criterion.state_dict()
+            state['memory_index'] = self.sim_criterion.calculate_sampleSimilarities.index
+        return state
+
+    def load_state_dict(self, state):
+        self.model.load_state_dict(state['model'])
+        self.opt.load_state_dict(state['opt'])
+        for name in BEST_STATS:
+            setattr(self, name, state[name])
+        self.stopped = state['stopped']
+        if self.sim_criterion is not None:
+            self.sim_criterion.load_state_dict(state['sim_criterion'])
+            self.sim_criterion.calculate_sampleSimilarities.index = state['memory_index']
+
+
+def variant_ckpt_path(arg, name):
+    '''--ckpt, with the variant name appended when several variants are trained.'''
+    if len(arg.variants) == 1:
+        return arg.ckpt
+    root, ext = os.path.splitext(arg.ckpt)
+    return f'{root}_{name}{ext}'
+
+
+def eval_quantized(model, evaluator, dtype):
+    '''Evaluate with the POI embeddings quantised to dtype, the trained table is restored after.'''
+    dense = model.poi_embeds
+    model.poi_embeds = QuantizedEmbeddingLayer.from_float(dense, dtype).to(dense.weight.device)
+    try:
+        return evaluator(model)
+    finally:
+        model.poi_embeds = dense
+
+
+def eval_precision(model, evaluator, precisions):
+    '''Test AUC, logloss and evaluation time in seconds of the model in fp32 and in each of precisions.
+       int8 quantises the Linear layers of a copy of the model dynamically, the attention projections
+       of nn.MultiheadAttention are not nn.Linear modules and stay fp32.'''
+    results = {}
+    for precision in ['fp32'] + list(precisions):
+        if precision == 'int8':
+            if evaluator.device.type != 'cpu':
+                logging.warning('int8 dynamic quantisation only runs on the CPU, skipped.')
+                continue
+            eval_model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+            forward_precision = 'fp32'
+        else:
+            eval_model, forward_precision = model, precision
+        # the first run collates the batches and warms up the kernels
+        evaluator(eval_model, forward_precision)
+        start = time.perf_counter()
+        auc, logloss = evaluator(eval_model, forward_precision)
+        results[precision] = (auc, logloss, time.perf_counter() - start)
+    return results
+
+
+def _copy_state(obj):
+    '''Copy the tensors of a (nested) state dict to the CPU.'''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _copy_state(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_state(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    '''State of the torch, numpy and random generators, see set_rng_state.'''
+    np_state = np.random.get_state()
+    return {
+        'torch': torch.get_rng_state(),
+        'numpy': (np_state[0], np_state[1].tolist(), *np_state[2:]),
+        'random': random.getstate(),
+    }
+
+
+def set_rng_state(state):
+    '''Restore the generators from rng_state().'''
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+
+
+def snapshot(variants, epoch):
+    '''Training state at the end of `epoch`. The tensors are copied, so training can go on
+       while the snapshot is evaluated and saved.'''
+    return {
+        'epoch': epoch,
+        'active': [v.name for v in variants if not v.stopped],
+        'variants': {v.name: _copy_state(v.state_dict()) for v in variants},
+        'rng': rng_state(),
+    }
+
+
+def save_state(path, state):
+    '''Write the training state atomically, an interrupted write keeps the previous state.'''
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def resume(variants, path):
+    '''Restore the variants and the random generators from a saved state, returns the next epoch.'''
+    state = torch.load(path, map_location='cpu')
+    for v in variants:
+        if v.name not in state['variants']:
+            raise ValueError(f'{path} has no state of the {v.name} variant.')
+        v.load_state_dict(state['variants'][v.name])
+    set_rng_state(state['rng'])
+    return state['epoch'] + 1
+
+
+class SnapshotEvaluator:
+    '''Validation of the training snapshots of every epoch.
+
+    When the validation AUC of a variant improves, the snapshot is also evaluated on the test set and
+    saved as the --ckpt checkpoint. The snapshot is then saved as the --state training state, with the
+    updated results of the best epochs.
+
+    Args:
+        arg (argparse.Namespace): Hyperparameters.
+        n_poi (int): Number of POI.
+        dist_edges (torch.Tensor): Edges of the distance graph, size (2, num_edges).
+        dist_vec (np.ndarray): Distance of the edges, size (num_edges,).
+        va_set (MyDataset): Validation set.
+        te_set (MyDataset): Test set.
+        device (torch.device): Evaluation device.
+        best (dict): Variant.best_stats() of each variant.
+    '''
+
+    def __init__(self, arg, n_poi, dist_edges, dist_vec, va_set, te_set, device, best):
+        self.arg, self.n_poi, self.te_set, self.device = arg, n_poi, te_set, device
+        self.models = {}
+        for name in arg.variants:
+            config = VARIANTS[name]
+            self.models[name] = KBGNN(arg, n_poi, dist_edges, dist_vec,
+                                      config['use_seq'], config['use_geo']).to(device)
+        self.best = {name: dict(stats) for name, stats in best.items()}
+        self.val_evaluator = Evaluator(va_set, arg, device)
+        self.test_evaluator = Evaluator(te_set, arg, device)
+        self.results = []
+
+    def __call__(self, snap):
+        '''Evaluate a snapshot, returns one result per active variant.'''
+        arg, epoch = self.arg, snap['epoch']
+        results = []
+        for name in snap['active']:
+            state, model, best = snap['variants'][name], self.models[name], self.best[name]
+            model.load_state_dict(state['model'])
+
+            auc, logloss = self.val_evaluator(model)
+            improved = auc > best['best_auc']
+            if improved:
+                best['best_auc'], best['best_epoch'] = auc, epoch
+                best['test_auc'], best['test_loss'] = self.test_evaluator(model)
+                if arg.rank_eval:
+                    best['rank_results'] = eval_ranking(model, self.te_set, arg, self.device)
+                if arg.ckpt is not None:
+                    save_checkpoint(variant_ckpt_path(arg, name), arg, self.n_poi, model)
+                best['quant_results'] = {dtype: eval_quantized(model, self.test_evaluator, dtype)
+                                         for dtype in arg.quant_eval}
+                if arg.precision_eval:
+                    best['precision_results'] = eval_precision(model, self.test_evaluator, arg.precision_eval)
+
+            state.update(best)
+            state['stopped'] = epoch - best['best_epoch'] >= arg.patience
+            results.append(dict(name=name, epoch=epoch, auc=auc, logloss=logloss, improved=improved, **best))
+
+        if arg.state is not None:
+            save_state(arg.state, snap)
+        return results
+
+    def submit(self, snap):
+        # the evaluation loaders draw from the random generator, training must not depend on them
+        with torch.random.fork_rng(devices=[]):
+            self.results.extend(self(snap))
+
+    def poll(self, wait=False):
+        '''Results of the evaluated snapshots, in order.'''
+        results, self.results = self.results, []
+        return results
+
+    def close(self):
+        pass
+
+
+def eval_worker(arg, n_poi, best, jobs, results):
+    '''Background evaluation process, evaluates the snapshots of `jobs` until it gets None.'''
+    torch.set_num_threads(arg.eval_threads)
+    root = f'./processed_data/{arg.data}'
+    dist_edges, dist_vec = load_dist_graph(root)
+    history = HistoryPolicy.from_arg(arg)
+    evaluator = SnapshotEvaluator(arg, n_poi, dist_edges, dist_vec, MyDataset(root, set='val', history=history),
+                                  MyDataset(root, set='test', history=history), get_device(arg), best)
+    while True:
+        snap = jobs.get()
+        if snap is None:
+            break
+        results.put(evaluator(snap))
+
+
+class AsyncEvaluator:
+    '''SnapshotEvaluator in a background process. The snapshot of an epoch is evaluated while the next
+       epoch trains, training waits only when the previous snapshot is still being evaluated.
+
+    Args:
+        arg (argparse.Namespace): Hyperparameters.
+        n_poi (int): Number of POI.
+        best (dict): Variant.best_stats() of each variant.
+    '''
+
+    def __init__(self, arg, n_poi, best, max_pending=1):
+        ctx = mp.get_context('spawn')
+        self.jobs, self.results = ctx.Queue(), ctx.Queue()
+        self.process = ctx.Process(target=eval_worker, args=(arg, n_poi, best, self.jobs, self.results),
+                                   daemon=True)
+        self.process.start()
+        self.pending = 0
+        self.max_pending = max_pending
+
+    def submit(self, snap):
+        self.jobs.put(snap)
+        self.pending += 1
+
+    def _get(self):
+        while True:
+            try:
+                results = self.results.get(timeout=1.)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('The background evaluation process exited unexpectedly.')
+                continue
+            self.pending -= 1
+            return results
+
+    def poll(self, wait=False):
+        '''Results of the evaluated snapshots, in order. Blocks while more than max_pending
+           snapshots are waiting, or until all of them are evaluated if wait.'''
+        results = []
+        while self.pending > (0 if wait else self.max_pending):
+            results.extend(self._get())
+        while self.pending > 0:
+            try:
+                results.extend(self.results.get_nowait())
+            except queue.Empty:
+                break
+            self.pending -= 1
+        return results
+
+    def close(self):
+        self.jobs.put(None)
+        self.process.join()
+
+
+def make_loaders(tr_set, arg):
+    '''Loaders of the training and memory bank batches, and their samplers (None if not distributed).'''
+    if is_distributed():
+        # every rank trains on its own shard, the shards are reshuffled each epoch
+        train_sampler = DistributedSampler(tr_set, shuffle=True, seed=arg.seed)
+        bank_sampler = DistributedSampler(tr_set, shuffle=True, seed=arg.seed + 1)
+    else:
+        train_sampler, bank_sampler = None, None
+    workers = dict(num_workers=arg.loader_workers, persistent_workers=arg.loader_workers > 0)
+    train_loader = make_loader(tr_set, arg.batch, shuffle=train_sampler is None, sampler=train_sampler, **workers)
+    bank_loader = make_loader(tr_set, arg.batch, shuffle=bank_sampler is None, sampler=bank_sampler, **workers)
+    return train_loader, bank_loader, (train_sampler, bank_sampler)
+
+
+def make_resampler(tr_set, arg, dist_edges):
+    '''NegativeResampler of the training set, from the state.pkl of preprocess.py.'''
+    path = f'./processed_data/{arg.data}/raw/state.pkl'
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'--resample_negatives needs {path}, run preprocess.py again.')
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    return NegativeResampler(tr_set, state, dist_edges, arg.neg_sampler == 'popularity', arg.hard_negatives,
+                             arg.seed)
+
+
+def train_epoch(variants, train_loader, bank_loader, samplers, epoch, arg, device, resampler=None):
+    '''Train the variants for one epoch, every batch is collated once and shared by all of them.
+       The negatives are redrawn first with a resampler.'''
+    batch_num = len(train_loader)
+    if resampler is not None:
+        resampler(epoch)
+    for sampler in samplers:
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+
+    for v in variants:
+        v.model.train()
+    batches = zip(train_loader, bank_loader)
+    if arg.prefetch > 0:
+        if arg.static_shapes:
+            # padded on the CPU by the background thread
+            batches = ((trn, bnk, (static_inputs(trn, arg.batch), static_inputs(bnk, arg.batch)))
+                       for trn, bnk in batches)
+        batches = Prefetcher(batches, device, arg.prefetch)
+
+    # time the training step waits for its batches, after the first one
+    stalls = []
+    start = time.perf_counter()
+    try:
+        for bn in range(batch_num):
+            TIMER.begin_step()
+            wait = time.perf_counter()
+            if arg.prefetch > 0:
+                with region('data'):
+                    trn_batch, bnk_batch, *static = next(batches)
+                static = static[0] if static else None
+            else:
+                with region('data'):
+                    trn_batch, bnk_batch = next(batches)
+                with region('to_device'):
+                    trn_batch, bnk_batch = trn_batch.to(device), bnk_batch.to(device)
+                static = None
+                if arg.static_shapes:
+                    with region('pad'):
+                        static = static_inputs(trn_batch, arg.batch), static_inputs(bnk_batch, arg.batch)
+            if bn > 0:
+                stalls.append(time.perf_counter() - wait)
+            else:
+                start = time.perf_counter()
+
+            for v in variants:
+                loss, loss_rec, unsup_loss = v.train_step(trn_batch, bnk_batch, arg, static)
+
+                if (bn + 1) % 20 == 0:
+                    msg = f'[{v.name}] Epoch: {epoch + 1} / {arg.epoch} Batch: {bn + 1} / {batch_num}, loss: {loss.item()} = Rec: {loss_rec.item()}'
+                    if unsup_loss is not None:
+                        msg += f' + {arg.con_weight} * Con: {unsup_loss.item()}'
+                    logging.info(msg)
+
+            TIMER.end_step(trn_batch.num_graphs)
+            if arg.timing and TIMER.n_steps % arg.timing_every == 0:
+                log_timing(arg, epoch)
+    finally:
+        if isinstance(batches, Prefetcher):
+            batches.close()
+    log_stalls(stalls, time.perf_counter() - start, epoch)
+
+
+def log_stalls(stalls, elapsed, epoch):
+    '''Log the steady-state time the training steps waited for their batches, the first step is left out.'''
+    if not stalls:
+        return
+    p50, p99 = np.percentile(np.array(stalls) * 1e3, [50, 99])
+    logging.info(f'Epoch: {epoch + 1} data stall: {sum(stalls) / len(stalls) * 1e3:.2f} ms/step '
+                 f'(p50 {p50:.2f}, p99 {p99:.2f}), {sum(stalls) / elapsed * 100:.1f}% of the epoch')
+
+
+def log_timing(arg, epoch):
+    '''Log the stage latency percentiles and throughput, and append them to --timing_file.'''
+    stats = TIMER.summary()
+    stages = ', '.join(f'{name} {s["p50"]:.2f}/{s["p90"]:.2f}/{s["p99"]:.2f}'
+                       for name, s in stats['stages'].items())
+    logging.info(f'Timing at step {stats["step"]}, p50/p90/p99 ms: {stages}; '
+                 f'{stats["samples_per_sec"]:.1f} samples/sec')
+    if arg.timing_file is not None and is_main_process():
+        with open(arg.timing_file, 'a') as f:
+            f.write(json.dumps({'epoch': epoch + 1, **stats}) + '\n')
+
+
+def apply_results(variants, evaluator, arg, wait=False):
+    '''Log the evaluated snapshots and update the best epochs and early stopping of the variants.
+       Only the main process evaluates, the other ranks follow its results.'''
+    results = evaluator.poll(wait) if is_main_process() else None
+    if is_distributed():
+        results = broadcast_object(results)
+
+    by_name = {v.name: v for v in variants}
+    for r in results:
+        v = by_name[r['name']]
+        logging.info(
+            f'[{v.name}] Epoch: {r["epoch"] + 1} / {arg.epoch}, validation AUC: {r["auc"]}, validation logloss: {r["logloss"]}')
+        for name in BEST_STATS:
+            setattr(v, name, r[name])
+
+        # early stopping
+        if r['epoch'] - v.best_epoch >= arg.patience:
+            if not v.stopped:
+                logging.info(
+                    f'[{v.name}] Stop training after {arg.patience} epochs without improvement.')
+            v.stopped = True
+            continue
+
+        logging.info(
+            f'[{v.name}] Best validation AUC: {v.best_auc} at epoch {v.best_epoch + 1}')
+
+
+def train_test(variants, tr_set, va_set, te_set, arg, n_poi, device, dist_edges, dist_vec):
+    '''Train the variants side by side on the same batches, with early stopping on validation AUC.
+       The snapshot of every epoch is evaluated in process, or in a background process with --async_eval.'''
+    # before the loaders, whose workers share the storage of the redrawn negatives
+    resampler = make_resampler(tr_set, arg, dist_edges) if arg.resample_negatives else None
+    train_loader, bank_loader, samplers = make_loaders(tr_set, arg)
+    start_epoch = 0
+    if arg.resume is not None:
+        start_epoch = resume(variants, arg.resume)
+        logging.info(f'Resumed from {arg.resume} at epoch {start_epoch + 1}')
+
+    evaluator = None
+    if is_main_process():
+        best = {v.name: v.best_stats() for v in variants}
+        if arg.async_eval:
+            evaluator = AsyncEvaluator(arg, n_poi, best)
+        else:
+            with torch.random.fork_rng(devices=[]):
+                evaluator = SnapshotEvaluator(arg, n_poi, dist_edges, dist_vec, va_set, te_set, device, best)
+
+    for epoch in range(start_epoch, arg.epoch):
+        active = [v for v in variants if not v.stopped]
+        if not active:
+            break
+
+        train_epoch(active, train_loader, bank_loader, samplers, epoch, arg, device, resampler)
+
+        logging.info('')
+        if evaluator is not None:
+            evaluator.submit(snapshot(variants, epoch))
+        apply_results(variants, evaluator, arg)
+        logging.info('')
+
+    apply_results(variants, evaluator, arg, wait=True)
+    if evaluator is not None:
+        evaluator.close()
+
+    for v in variants:
+        logging.info(f'[{v.name}] Training finished, best epoch {v.best_epoch + 1}')
+        logging.info(
+            f'[{v.name}] Validation AUC: {v.best_auc}, Test AUC: {v.test_auc}, Test logloss: {v.test_loss}')
+        if v.rank_results:
+            logging.info(f'[{v.name}] Test ranking: ' +
+                         ', '.join(f'{name}: {value:.5f}' for name, value in v.rank_results.items()))
+        for dtype, (q_auc, q_loss) in v.quant_results.items():
+            logging.info(
+                f'[{v.name}] {dtype} POI embeddings: Test AUC: {q_auc} ({q_auc - v.test_auc:+.5f}), Test logloss: {q_loss}')
+        if v.precision_results:
+            base_auc, _, base_time = v.precision_results['fp32']
+            for precision, (p_auc, p_loss, seconds) in v.precision_results.items():
+                logging.info(
+                    f'[{v.name}] {precision}: Test AUC: {p_auc} ({p_auc - base_auc:+.5f}), Test logloss: {p_loss}, '
+                    f'eval {seconds:.3f}s ({base_time / seconds:.2f}x)')
+
+
+def setup_logging():
+    LOG_FORMAT = "%(asctime)s  %(message)s"
+    DATE_FORMAT = "%m/%d %H:%M:%S"
+    if not is_main_process():
+        # only the main process writes the log file
+        logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT, datefmt=DATE_FORMAT)
+        return
+    if not os.path.exists('./log'):
+        os.makedirs('./log')
+    current_datetime = datetime.now().strftime('%m%d_%H_%M_%S')
+    logging.basicConfig(filename=f'./log/{current_datetime}.log', level=logging.DEBUG,
+                        format=LOG_FORMAT, datefmt=DATE_FORMAT)
+
+
+def get_device(arg):
+    if arg.gpu is None or not torch.cuda.is_available():
+        return torch.device('cpu')
+    return torch.device(f'cuda:{arg.gpu}')
+
+
+def main(variants=('full',)):
+    '''Entry point of main.py, ablation_geo.py and ablation_seq.py.'''
+    arg = build_parser(variants).parse_args()
+    if arg.threads is not None:
+        torch.set_num_threads(arg.threads)
+    if arg.ddp:
+        rank, world_size = init_distributed()
+    set_seed(arg.seed)
+    setup_logging()
+
+    logging.info(f'Arguments: {arg}')
+
+    # the main process builds the processed files of the datasets first, the other ranks then load them
+    if not is_main_process():
+        barrier()
+    n_user, n_poi, train_set, val_set, test_set, dist_edges, dist_vec = load_data(arg)
+    if is_main_process():
+        barrier()
+
+    logging.info(f'Data loaded.')
+    logging.info(f'user: {n_user}\tpoi: {n_poi}')
+
+    device = get_device(arg)
+    logging.info(f'Device: {device}')
+    if arg.timing:
+        TIMER.enable(sync=device.type == 'cuda', window=arg.timing_window)
+    if arg.trace is not None:
+        TIMER.trace(arg.trace, *arg.trace_steps)
+    if arg.ddp:
+        logging.info(f'Data-parallel training with {world_size} processes')
+
+    models = [Variant(name, arg, n_poi, dist_edges, dist_vec, device) for name in arg.variants]
+    train_test(models, train_set, val_set, test_set, arg, n_poi, device, dist_edges, dist_vec)
+
+
+if __name__ == '__main__':
+    main()